@@ -1,64 +1,315 @@
 #!/usr/bin/env python
 """
-Simple command-line based controller application for Lightware and Extron
-DVI or HDMI crossbar video switches. Supports up to 10 macros.
+Controller for Lightware and Extron DVI or HDMI crossbar video switches
+(and others, through protocol plugins), connected over the network or a
+serial port. Supports macros, timed cue lists and device presets, and can
+be controlled from the command line or over the network (see --server).
 """
 from __future__ import print_function
-import sys, os, time, threading, socket
+import time
+STARTUP_TIME = getattr(time, 'monotonic', time.time)()
+import sys, os, re, threading, socket, select
+from collections import deque
+# imported on first use, because they take a while to load (see load_serial and load_server_modules);
+# json, zlib, importlib and argparse are imported by the functions that use them
+serial = base64 = hashlib = struct = json = None
 
 DEFAULT_CONFIGFILE = "dvi_matrix_control.conf"
+SNAPSHOT_SUFFIX = ".snapshot"
+JOURNAL_COMPACT_MIN = 64  # don't compact the configuration file before it has this many lines
 
 MAX_CONNECT_TIMEOUT = 1.0
-MAX_COMMAND_TIMEOUT = 0.1
-POLL_INTERVAL = 0.05
+MAX_COMMAND_TIMEOUT = 0.5
+MIN_REPLY_TIMEOUT = 0.05  # before the tie state is queried for a switch command without a reply
+REPLY_TIMEOUT_FACTOR = 4  # ... relative to the longest recent round-trip time
+REPLY_TIMEOUT_HISTORY = 20
+RESYNC_ATTEMPTS = 2  # tie queries for a frame whose reply was lost
+DEFAULT_PIPELINE_DEPTH = 4
+KEEPALIVE_INTERVAL = 2.0
+KEEPALIVE_MAX_RTT = 0.25
+KEEPALIVE_HISTORY = 100
+RECEIVER_WAKEUP_INTERVAL = 0.5
+MAX_LINE_LENGTH = 4096
+CUE_SPIN_TIME = 0.002
+SERIAL_INTER_BYTE_TIMEOUT = 0.1
+SERIAL_POLL_INTERVAL = 0.001
 
 try: # Python 2/3 compatibility
     input = raw_input
 except:
     pass
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+try:
+    import socketserver
+    import queue
+except ImportError:
+    import SocketServer as socketserver
+    import Queue as queue
+
+def load_serial():
+    global serial
+    if not serial:
+        import serial
+
+def load_server_modules():
+    global base64, hashlib, struct, json
+    import base64, hashlib, struct, json
+
+class StartupProfile(object):
+    "records how long each phase of the startup takes (see --profile-startup)"
+    def __init__(self):
+        self.last = STARTUP_TIME
+        self.phases = []
+
+    def mark(self, phase):
+        now = monotonic()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def elapsed(self):
+        return monotonic() - STARTUP_TIME
+
+    def report(self):
+        print("----- startup profile (in ms, since the script started loading) -----")
+        t = 0.0
+        for phase, duration in self.phases:
+            t += duration
+            print("{:>8.1f} {:>8.1f}  {}".format(duration * 1000.0, t * 1000.0, phase))
 
 ###############################################################################
 
 class ProtocolBase(object):
+    """
+    Base class of the device protocols. A protocol turns ties into command
+    messages and parses the device's replies; it doesn't do any I/O itself.
+    Protocols for other devices can be added by plugins (see
+    register_protocol), which implement at least switch_single and receive,
+    and declare the capabilities of the device:
+    - max_ties: the maximum number of ties in a single switch message
+      (1 = single ties only, None = no limit); if it's not 1, switch_multi
+      encodes such a message
+    - presets: the number of tie presets (salvos) the device can store and
+      recall; 0 if not supported, otherwise save_preset and recall_preset
+      encode the commands
+    """
     default_ip = [192, 168, 254, 254]
     default_port = 0
     default_baud = 9600
     default_bits = 801
-    def __init__(self):  self.result = None
+    max_ties = 1
+    presets = 0
+    def __init__(self):
+        self.result = None
+        self.cond = threading.Condition()
+        self.ties = {}  # known tie state: output -> input
+        self.on_tie = None  # callback(input, output) for tie state changes
+        self.on_result = None  # callback(result, key) for command acknowledgments
     def connect(self): pass
-    def receive(self, line): pass
+    def receive(self, line): pass  # may return data to be sent back
+    def query_ties(self): pass     # may return a command requesting the tie state
+    def status_query(self): pass   # may return a cheap command that is acknowledged like a switch command
+    def query_outputs(self, outputs): pass  # may return (command, expected replies) requesting the inputs tied to these outputs
     def switch_single(self, pin, pout): pass
-    def switch_multi(self, ties):
+    def switch_multi(self, ties): pass  # only used if max_ties isn't 1
+    def save_preset(self, n): pass    # may return a command storing the current ties as preset n (1..presets)
+    def recall_preset(self, n): pass  # may return a command recalling preset n
+    def replies(self, ties):
+        """
+        the replies the device sends to a switch message with these ties: for
+        each reply, the (input, output) tie it names, another key it can be
+        recognized by (e.g. a keyword like "qik"), or None if it can't be told
+        apart from other replies
+        """
+        return [None]
+
+    def encode(self, ties):
+        """
+        encode a list of (input, output) ties into as few switch messages as
+        max_ties allows; returns the data of all messages, which are sent in
+        one go, and the list of expected replies (see replies())
+        """
+        step = self.max_ties or len(ties)
+        data = []
+        expect = []
+        for pos in range(0, len(ties), step):
+            chunk = ties[pos:pos+step]
+            data.append(self.switch_multi(chunk) if (len(chunk) > 1) else self.switch_single(*chunk[0]))
+            expect.extend(self.replies(chunk))
+        return b''.join(data), expect
+
+    @classmethod
+    def capabilities(cls):
+        caps = ["{} per message".format("1 tie" if cls.max_ties == 1 else
+                                        "{} ties".format(cls.max_ties or "any number of"))]
+        if cls.presets:
+            caps.append("{} presets".format(cls.presets))
+        return ", ".join(caps)
+
+    def notify_success(self, key=None): self.set_result(True, key)  # key = (input, output) if the reply names it (see replies())
+    def notify_error(self): self.set_result(False)
+    def clear_status(self): self.set_result(None)
+    def update_tie(self, pin, pout):
+        changed = (self.ties.get(pout) != pin)
+        self.ties[pout] = pin
+        if changed and self.on_tie:
+            self.on_tie(pin, pout)
+    def update_ties(self, ties):
         for pin, pout in ties:
-            self.switch_single(pin, pout)
-    def notify_success(self): self.result = True
-    def notify_error(self): self.result = False
-    def clear_status(self): self.result = None
+            self.update_tie(pin, pout)
+
+    def set_result(self, result, key=None):
+        with self.cond:
+            self.result = result
+            self.cond.notify_all()
+        if (result is not None) and self.on_result:
+            self.on_result(result, key)
+
+    def wait_result(self, timeout):
+        "wait until the device reported success or error; returns None on timeout"
+        t1 = monotonic() + timeout
+        with self.cond:
+            while self.result is None:
+                remaining = t1 - monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.result
 
 class LightwareProtocol(ProtocolBase):
     "Lightware LW1 Protocol"
     default_port = 10001
+    presets = 32
 
     def connect(self):
         self.notify_success()
 
     def receive(self, line):
         if line.startswith(b'(') and line.endswith(b')'):
-            self.notify_success()
+            m = re.match(br'\(O(\d+) I(\d+)\)', line, flags=re.I)
+            if m:
+                self.update_tie(int(m.group(2)), int(m.group(1)))
+                self.notify_success((int(m.group(2)), int(m.group(1))))
+                return
+            elif line[1:4].upper() == b'ALL':
+                # connection state: input number for each output
+                for pout, pin in enumerate(line[4:-1].split(), 1):
+                    self.update_tie(int(pin), pout)
+                self.notify_success("all")  # reply to a tie query
+                return
+            if line[1:4].upper() == b'ERR':
+                self.notify_error()
+            else:
+                self.notify_success()
+
+    def query_ties(self):
+        return b'{VC}\r\n'
+
+    def status_query(self):
+        return b'{i}\r\n'
+
+    def query_outputs(self, outputs):
+        return b'{VC}\r\n', ["all"]  # (ALL ...) for all outputs
 
     def switch_single(self, pin, pout):
         return b'{%d@%d}\r\n' % (pin, pout)
 
+    def replies(self, ties):
+        return list(ties)  # (Oxx Iyy)
+
+    def save_preset(self, n):
+        return b'{$%d}\r\n' % n  # (SPRxx)
+
+    def recall_preset(self, n):
+        return b'{%%%d}\r\n' % n  # (LPRxx)
+
 class ExtronProtocol(ProtocolBase):
     "Extron DXP SIS Protocol"
     default_port = 23
+    max_ties = None
+    presets = 32
+
+    def __init__(self):
+        ProtocolBase.__init__(self)
+        self.tie_queries = deque()  # batches of tie queries: (outputs, whether a command waits for the result)
+        self.tie_replies = []       # inputs reported since the last batch ended
 
     def connect(self):
+        self.tie_queries.clear()
+        del self.tie_replies[:]
         self.notify_success()
 
     def receive(self, line):
-        if line.lower().startswith((b"login ", b"qik", b"out")):
-            self.notify_success()
+        line = line.lower()
+        m = re.match(br'out(\d+) in(\d+) (all|vid|rgb)', line)
+        if m:
+            self.update_tie(int(m.group(2)), int(m.group(1)))
+            self.notify_success((int(m.group(2)), int(m.group(1))))
+            return
+        if line.startswith(b"qik"):
+            self.notify_success("qik")  # reply to a multi-tie message
+            return
+        if line.startswith(b"login ") or re.match(br'(?:ver\d+\*)?\d+\.\d+', line):
+            self.notify_success()  # (firmware version: reply to the status query)
+            return
+        if re.match(br'[sr]pr ?\d+$', line):
+            self.notify_success()  # preset saved or recalled
+            return
+        if re.match(br'e\d\d$', line):
+            self.notify_error()
+            return
+        # response to the information request: matrix size -> query all outputs
+        m = re.match(br'v(\d+)x(\d+)', line)
+        if m:
+            return self.query_outputs(range(1, int(m.group(2)) + 1), acknowledge=False)[0]
+        # response to a single output's tie query
+        m = re.match(br'(?:in)?(\d+)(?: \w+)?$', line)
+        if m and self.tie_queries:
+            self.tie_replies.append(int(m.group(1)))
+            return
+        # response to the part number request that ends each batch of tie queries
+        if re.match(br'60-\w+-\w+$', line) and self.tie_queries:
+            self.end_tie_queries()
+
+    def end_tie_queries(self):
+        """
+        the replies to tie queries don't name the output, so they're only
+        used if their number matches the outputs queried by the oldest
+        batches (the part number reply ending a batch may have been lost);
+        otherwise the batches can't be told apart, so all of them are given
+        up and the tie state of their outputs becomes unknown
+        """
+        replies, self.tie_replies = self.tie_replies, []
+        count = 0
+        for n, (queried, acknowledge) in enumerate(self.tie_queries, 1):
+            count += len(queried)
+            if count >= len(replies):
+                break
+        ok = (count == len(replies))
+        batches = [self.tie_queries.popleft() for i in range(n if ok else len(self.tie_queries))]
+        outputs = [pout for queried, acknowledge in batches for pout in queried]
+        if ok:
+            for pout, pin in zip(outputs, replies):
+                self.update_tie(pin, pout)
+        else:
+            for pout in outputs:
+                self.ties.pop(pout, None)
+        for queried, acknowledge in batches:
+            if acknowledge:
+                self.set_result(ok, "part")
+
+    def query_ties(self):
+        return b'I'
+
+    def status_query(self):
+        return b'Q'
+
+    def query_outputs(self, outputs, acknowledge=True):
+        # the part number request marks the end of the batch (see end_tie_queries)
+        self.tie_queries.append((list(outputs), acknowledge))
+        return b''.join(b'%d%%' % pout for pout in outputs) + b'N', ["part"]
 
     def switch_single(self, pin, pout):
         return b'%d*%d!' % (pin, pout)
@@ -66,97 +317,610 @@ class ExtronProtocol(ProtocolBase):
     def switch_multi(self, ties):
         return b'\x1b+Q' + b''.join(b'%d*%d!' % (pin, pout) for pin, pout in ties) + b'\r\n'
 
-Protocols = {
-    1: LightwareProtocol,
-    2: ExtronProtocol,
-}
+    def replies(self, ties):
+        return list(ties) if (len(ties) == 1) else ["qik"]  # OutXX InYY All, or Qik
+
+    def save_preset(self, n):
+        return b'%d,' % n  # SprXX
+
+    def recall_preset(self, n):
+        return b'%d.' % n  # RprXX
+
+Protocols = {}  # protocol number -> ProtocolBase subclass
+
+def register_protocol(proto_id, cls):
+    "make a protocol class available under a protocol number, e.g. from a plugin"
+    if Protocols.get(proto_id, cls) is not cls:
+        raise ValueError("protocol {} is already registered ({})".format(proto_id, Protocols[proto_id].__doc__))
+    Protocols[proto_id] = cls
+    return cls
+
+register_protocol(1, LightwareProtocol)
+register_protocol(2, ExtronProtocol)
+
+def load_plugin(name):
+    """
+    import a plugin module, given by module or file name; the plugin
+    registers its protocols by calling register_protocol when imported
+    """
+    sys.modules.setdefault("dvi_matrix_control", sys.modules[__name__])  # the plugin must see this module even if it runs as a script
+    if name.endswith(".py") or (os.sep in name):
+        path, name = os.path.split(os.path.abspath(name))
+        name = os.path.splitext(name)[0]
+        if not(path in sys.path):
+            sys.path.insert(0, path)
+    import importlib
+    return importlib.import_module(name)
 
 ###############################################################################
 
 class UnsuitableConnectionParameters(ValueError):
     pass
 
+class LineFramer(object):
+    """
+    Splits a received byte stream into lines. Only newly received data is
+    scanned for line terminators, and the buffer is bounded: a partial line
+    that grows beyond max_length bytes is discarded as garbage.
+    """
+    def __init__(self, max_length=MAX_LINE_LENGTH):
+        self.buf = bytearray()
+        self.max_length = max_length
+
+    def discard(self):
+        "drop a partial line, e.g. after a gap in the data stream"
+        del self.buf[:]
+
+    def feed(self, data):
+        buf = self.buf
+        pos = 0
+        end = len(buf)  # the old data is known to contain no terminator
+        buf += data.replace(b'\r', b'\n')
+        lines = []
+        while True:
+            end = buf.find(b'\n', end)
+            if end < 0:
+                break
+            if end > pos:
+                lines.append(bytes(buf[pos:end]))
+            pos = end = end + 1
+        if pos:
+            del buf[:pos]
+        if len(buf) > self.max_length:
+            del buf[:]
+        return lines
+
+class Command(object):
+    """
+    A set of (input, output) ties submitted to a connection. When the
+    command is finished, result is True (acknowledged by the device), False
+    (device reported an error) or None (no reaction, or it couldn't be sent),
+    and rtt is the round-trip time of the frame that carried it. submitted
+    and finished are monotonic timestamps, so their difference includes the
+    time spent in the queue.
+    """
+    __slots__ = ('ties', 'frame', 'on_done', 'resync', 'done', 'result', 'rtt', 'attempts', 'submitted', 'finished')
+    def __init__(self, ties, frame=None, on_done=None):
+        self.ties = ties
+        self.frame = frame      # precompiled (data, expected replies), if any
+        self.on_done = on_done  # callback(command)
+        self.resync = None      # Frame whose outputs this command queries (see ConnectionBase.missed)
+        self.done = threading.Event()
+        self.result = None
+        self.rtt = None
+        self.attempts = 0
+        self.submitted = monotonic()
+        self.finished = None
+
+    def complete(self, result, rtt=None):
+        self.result = result
+        self.rtt = rtt
+        self.finished = monotonic()
+        self.done.set()
+        if self.on_done:
+            self.on_done(self)
+
+class Frame(object):
+    """
+    a command frame on the wire, carrying one or more coalesced commands;
+    it may consist of several messages, so it's only finished when all
+    expected replies have arrived
+    """
+    __slots__ = ('data', 'ties', 'commands', 'expect', 'result', 'sent', 'seq')
+    def __init__(self, data, ties, commands, expect=None):
+        self.data = data
+        self.ties = ties
+        self.commands = commands
+        self.expect = list(expect or [None])  # replies still expected (see ProtocolBase.replies)
+        self.result = True  # becomes False on an error reply, None if a reply is missing
+        self.sent = None
+        self.seq = None  # sequence number on the connection, for the event log
+
+    def complete(self, result, rtt=None):
+        for cmd in self.commands:
+            cmd.complete(result, rtt)
+
 class ConnectionBase(object):
+    """
+    Commands are sent by a sender thread from an outbound queue. All commands
+    that queue up while the sender is busy are coalesced into a single frame,
+    where later ties to an output supersede earlier ones. Up to
+    pipeline_depth frames may be in flight at the same time; the device
+    acknowledges them in order, so each reply is matched to the oldest frame
+    expecting a reply with that content. If a frame's reply is lost (a later
+    frame was acknowledged first, or none arrived within a few round-trip
+    times), the tie state of its outputs is queried, and the frame only fails
+    if the device doesn't show its ties. Frames without ties fail if they
+    aren't acknowledged within MAX_COMMAND_TIMEOUT, but only a lost
+    connection causes a reconnect.
+    While idle, a status query is sent every keepalive_interval seconds to
+    check the link (reconnecting it if necessary) and track its round-trip
+    time; changes of the connection health are reported to on_health.
+    """
     def __init__(self, proto_id):
         try:
             proto = Protocols[proto_id]
         except KeyError:
             raise UnsuitableConnectionParameters("invalid protocol")
         self.proto = proto()
+        self.proto.on_result = self.acknowledge
+        self.inter_byte_timeout = None  # if set, partial lines older than this are discarded
         self.conn = None
         self.receiver = None
+        self.link_up = False
         self.cancel = False
+        self.send_lock = threading.Lock()
+        self.connect_lock = threading.RLock()
+        self.pipeline_depth = DEFAULT_PIPELINE_DEPTH
+        self.queue_cond = threading.Condition()
+        self.queued = []          # commands waiting to be sent
+        self.inflight = deque()   # frames waiting for acknowledgment
+        self.busy = 0             # commands or frames being transmitted or completed
+        self.sender = None
+        self.closed = False
+        self.connected_before = False
+        self.reconnects = 0
+        self.keepalive_interval = KEEPALIVE_INTERVAL
+        self.last_activity = monotonic()
+        self.rtts = deque(maxlen=KEEPALIVE_HISTORY)  # recent keepalive round-trip times
+        self.frame_rtts = deque(maxlen=REPLY_TIMEOUT_HISTORY)  # recent round-trip times of acknowledged switch commands
+        self.healthy = None    # unknown until the first connection attempt
+        self.on_health = None  # callback(connection, healthy, reason)
+        self.on_event = None   # callback(event, fields), for the event log
+        self.frame_seq = 0
+        self.tied_by = {}  # output -> sequence number of the last frame sent that ties it
 
     def receiver_thread(self):
-        buf = b''
+        conn = self.conn
+        framer = LineFramer()
+        last_rx = 0
         while not self.cancel:
             try:
-                buf += self.do_receive(self.conn).replace(b'\r', b'\n')
+                if not self.do_wait(conn, RECEIVER_WAKEUP_INTERVAL):
+                    continue
+                data = self.do_receive(conn)
+            except socket.timeout:
+                continue
             except EnvironmentError:
-                pass
-            while b'\n' in buf:
-                line, buf = buf.split(b'\n', 1)
-                if line:
-                    self.proto.receive(line)
+                break
+            if not data:
+                break  # connection closed by peer
+            now = monotonic()
+            if self.inter_byte_timeout and (now - last_rx > self.inter_byte_timeout):
+                framer.discard()  # a stale fragment (e.g. line noise) must not corrupt the next reply
+            last_rx = now
+            for line in framer.feed(data):
+                reply = self.proto.receive(line)
+                if reply:
+                    try:
+                        self.write(conn, reply)
+                    except EnvironmentError:
+                        break
+        with self.queue_cond:
+            self.link_up = False
+            self.queue_cond.notify_all()
 
     def connect(self):
-        if self.conn:
-            return
-        t1 = time.time() + MAX_CONNECT_TIMEOUT
-        try:
-            self.conn = self.do_connect(MAX_CONNECT_TIMEOUT)
-        except EnvironmentError:
-            self.conn = None
-            return
-        self.cancel = False
-        self.receiver = threading.Thread(target=self.receiver_thread, name="Receiver")
-        self.receiver.daemon = True
-        self.receiver.start()
-        self.proto.clear_status()
-        self.proto.connect()
-        while (self.proto.result is None) and (time.time() < t1):
-            time.sleep(POLL_INTERVAL)
-        return self.proto.result
+        with self.connect_lock:
+            if self.conn:
+                return
+            t0 = monotonic()
+            try:
+                self.conn = self.do_connect(MAX_CONNECT_TIMEOUT)
+            except EnvironmentError:
+                self.conn = None
+                return
+            if self.connected_before:
+                self.reconnects += 1
+            self.connected_before = True
+            self.cancel = False
+            self.link_up = True
+            self.receiver = threading.Thread(target=self.receiver_thread, name="Receiver")
+            self.receiver.daemon = True
+            self.receiver.start()
+            self.proto.clear_status()
+            self.proto.ties.clear()
+            self.proto.connect()
+            res = self.proto.wait_result(MAX_CONNECT_TIMEOUT - (monotonic() - t0))
+            query = self.proto.query_ties()
+            if res and query:
+                try:
+                    self.write(self.conn, query)
+                except EnvironmentError:
+                    pass
+            self.last_activity = monotonic()
+            self.log("connect", ok=bool(res), reconnects=self.reconnects)
+            self.set_health(bool(res), None if res else "no reaction after connecting")
+            return res
 
     def disconnect(self):
-        if not self.conn:
-            return
-        self.cancel = True
-        self.do_disconnect(self.conn)
-        self.receiver.join(MAX_CONNECT_TIMEOUT)
-        self.receiver = None
-        self.conn = None
+        with self.connect_lock:
+            if not self.conn:
+                return
+            self.cancel = True
+            self.do_disconnect(self.conn)
+            self.receiver.join(MAX_CONNECT_TIMEOUT)
+            self.receiver = None
+            self.conn = None
+        self.requeue_inflight()
+
+    def close(self):
+        "disconnect for good; all pending commands fail"
+        with self.queue_cond:
+            self.closed = True
+            self.queue_cond.notify_all()
+        self.disconnect()
+        with self.queue_cond:
+            pending, self.queued = self.queued, []
+        for cmd in pending:
+            cmd.complete(None)
+
+    def write(self, conn, data):
+        with self.send_lock:
+            while data:
+                n = self.do_send(conn, data)
+                data = data[n:]
+            self.do_flush(conn)
+
+    def submit(self, ties, frame=None, on_done=None):
+        """
+        queue a list of (input, output) ties (with an optional precompiled
+        frame) for sending; returns the Command without waiting for it
+        """
+        cmd = Command(ties, frame, on_done)
+        with self.queue_cond:
+            if self.closed:
+                cmd.complete(None)
+                return cmd
+            self.queued.append(cmd)
+            self.queue_cond.notify_all()
+        self.start()
+        return cmd
+
+    def start(self):
+        "start the sender thread, which also takes care of keepalives"
+        with self.queue_cond:
+            if not self.sender:
+                self.sender = threading.Thread(target=self.sender_thread, name="Sender")
+                self.sender.daemon = True
+                self.sender.start()
+
+    def take_pending(self):
+        "remove all commands that haven't been sent yet, e.g. to hand them over to another connection"
+        with self.queue_cond:
+            pending = [cmd for cmd in self.queued if not cmd.resync]  # tie queries only make sense on this connection
+            self.queued = [cmd for cmd in self.queued if cmd.resync]
+            self.queue_cond.notify_all()
+        return pending
+
+    def adopt(self, commands):
+        "queue commands taken from another connection, in front of the newer ones"
+        for cmd in commands:
+            if cmd.ties:
+                cmd.frame = None  # precompiled for the other connection's protocol
+        with self.queue_cond:
+            self.queued[:0] = commands
+            self.queue_cond.notify_all()
+        self.start()
+
+    def set_health(self, healthy, reason=None):
+        changed = (healthy != self.healthy) and (self.healthy is not None)
+        self.healthy = healthy
+        if changed:
+            self.log("health", healthy=healthy, reason=reason)
+            if self.on_health:
+                self.on_health(self, healthy, reason)
+
+    def log(self, event, **fields):
+        if self.on_event:
+            self.on_event(event, fields)
+
+    def keepalive_done(self, cmd):
+        if cmd.rtt is not None:
+            self.rtts.append(cmd.rtt)
+        if not cmd.result:
+            self.set_health(False, "no reaction to status query" if cmd.result is None else "error reply to status query")
+        elif cmd.rtt > KEEPALIVE_MAX_RTT:
+            self.set_health(False, "round-trip time {:.0f} ms".format(cmd.rtt * 1000.0))
+        else:
+            self.set_health(True)
+
+    def health(self):
+        "connection health summary, with round-trip times in milliseconds"
+        rtts = list(self.rtts)
+        return {
+            "connected": bool(self.conn),
+            "healthy": self.healthy,
+            "rtt": round(rtts[-1] * 1000.0, 1) if rtts else None,
+            "rtt_max": round(max(rtts) * 1000.0, 1) if rtts else None,
+            "reconnects": self.reconnects,
+        }
+
+    def expected_ties(self):
+        "the tie state after all queued and in-flight commands have been executed"
+        with self.queue_cond:
+            ties = dict(self.proto.ties)
+            for frame in self.inflight:
+                ties.update((pout, pin) for pin, pout in frame.ties)
+            for cmd in self.queued:
+                ties.update((pout, pin) for pin, pout in cmd.ties)
+        return ties
+
+    def wait_idle(self, timeout):
+        "wait until all queued commands have been sent and acknowledged; returns False on timeout"
+        t1 = monotonic() + timeout
+        with self.queue_cond:
+            while self.queued or self.inflight or self.busy:
+                remaining = t1 - monotonic()
+                if remaining <= 0:
+                    return False
+                self.queue_cond.wait(remaining)
+        return True
 
-    def send(self, data, allow_reconnect=True, wait=True):
-        if not(self.conn):
-            res = self.connect()
-            if self.conn and not res:
-                print("! reconnect didn't succeed, trying to send anyway")
+    def acknowledge(self, result, key=None):
+        """
+        called by the protocol for each command reply; matches it to the
+        oldest frame in flight expecting a reply with its key (see
+        ProtocolBase.replies), i.e. a success reply that doesn't name a tie
+        only to a frame expecting such a reply; error replies can't be told
+        apart, so they belong to the oldest frame. The device works in
+        order, so the replies expected before the matching one have been lost
+        """
+        with self.queue_cond:
+            if not self.inflight:
+                return  # unsolicited reply, or a late one for a frame that already failed
+            by_content = result or (key is not None)
+            index = 0
+            if by_content:
+                index = next((n for n, f in enumerate(self.inflight) if key in f.expect), None)
+                if index is None:
+                    return  # tie change caused by someone else, or a reply nobody waits for
+            lost = [self.inflight.popleft() for n in range(index)]
+            frame = self.inflight[0]
+            skipped = frame.expect.index(key) if by_content else 0
+            del frame.expect[:skipped + 1]
+            if not result:
+                frame.result = False
+            elif skipped and frame.result:
+                frame.result = None
+            done = not frame.expect
+            if done:
+                self.inflight.popleft()
+            self.busy += len(lost) + (1 if done else 0)
+            self.queue_cond.notify_all()
+        self.missed(lost)
+        if done and (frame.result is None) and frame.ties:
+            self.missed([frame])
+        elif done:
+            rtt = monotonic() - frame.sent
+            self.log("ack", seq=frame.seq, result=frame.result, rtt_ms=round(rtt * 1000.0, 2))
+            if frame.result:
+                self.proto.update_ties(frame.ties)
+                if frame.ties:
+                    self.frame_rtts.append(rtt)
+            elif (frame.result is False) and frame.ties:
+                print("! device reports error")
+            elif frame.ties:
+                print("! no reaction from device")
+            frame.complete(frame.result, rtt)
+        self.release(len(lost) + (1 if done else 0))
+
+    def release(self, n):
+        with self.queue_cond:
+            self.busy -= n
+            self.queue_cond.notify_all()
+
+    def missed(self, frames, attempts=RESYNC_ATTEMPTS):
+        """
+        replies to these frames have been lost, but the device has probably
+        executed them anyway: query the tie state of their outputs, ahead of
+        the queued commands, and complete them in verify(); frames without
+        ties fail right away
+        """
+        resync = []
+        for frame in frames:
+            if frame.ties and (frame.result is not False) and attempts:
+                cmd = Command([], None, lambda cmd, frame=frame: self.verify(frame, cmd, attempts - 1))
+                cmd.resync = frame
+                resync.append(cmd)
+                continue
+            result = False if (frame.result is False) else None  # an error reply to one of its messages counts
+            if frame.ties:
+                print("! no reaction from device" if result is None else "! device reports error")
+            self.log("no_reaction", seq=frame.seq)
+            frame.complete(result)
+        with self.queue_cond:
+            if not self.closed:
+                self.queued[:0] = resync
+                self.queue_cond.notify_all()
+                resync = []
+        for cmd in resync:
+            cmd.complete(None)
+
+    def verify(self, frame, query, attempts):
+        "complete a frame whose replies were lost, according to the tie state queried for its outputs"
+        if not query.result:
+            # replies to the tie queries are missing, so the others may have been attributed to the wrong outputs
+            for pin, pout in frame.ties:
+                self.proto.ties.pop(pout, None)
+            if attempts:
+                return self.missed([frame], attempts)
+        # outputs tied again by later frames don't show whether this frame was executed (see coalesce)
+        ties = [(pin, pout) for pin, pout in frame.ties if self.tied_by.get(pout) == frame.seq]
+        result = True if (query.result and all(self.proto.ties.get(pout) == pin for pin, pout in ties)) else None
+        rtt = monotonic() - frame.sent
+        self.log("ack", seq=frame.seq, result=result, rtt_ms=round(rtt * 1000.0, 2), resync=True)
+        if not result:
+            print("! no reaction from device")
+        frame.complete(result, rtt)
+
+    def requeue_inflight(self):
+        """
+        frames sent over a lost connection will never be acknowledged: queue
+        their commands again, in front of the newer ones (each command is
+        retried only once)
+        """
+        failed = []
+        with self.queue_cond:
+            retry = []
+            for frame in self.inflight:
+                for cmd in frame.commands:
+                    (retry if (cmd.ties and cmd.attempts < 2) else failed).append(cmd)
+            self.inflight.clear()
+            self.queued[:0] = retry
+            self.queue_cond.notify_all()
+        for cmd in failed:
+            cmd.complete(None)
+
+    def sender_thread(self):
+        while not self.closed:
+            with self.connect_lock:
+                lost = self.conn and not self.link_up
+                if lost:
+                    print("! connection lost, reconnecting")
+                    self.log("lost")
+                    self.disconnect()
+            if lost:
+                self.set_health(False, "connection lost")
+            commands = self.next_commands()
+            if commands:
+                self.transmit(commands)
+                self.release(1)
+
+    def next_commands(self):
+        """
+        wait until commands can be sent (returning them) or something else
+        needs attention (returning an empty list); fails expired frames
+        """
+        expired = []
+        with self.queue_cond:
+            now = monotonic()
+            while self.inflight and (now - self.inflight[0].sent >= self.reply_timeout(self.inflight[0])):
+                expired.append(self.inflight.popleft())
+            if expired:
+                self.busy += len(expired)
+                self.queue_cond.notify_all()
+            elif self.closed or (self.conn and not self.link_up):
+                pass
+            elif self.queued and (len(self.inflight) < self.pipeline_depth) and not self.unattributable():
+                # commands without ties (tie queries, saving a preset) are sent on their own
+                n = next((n for n, cmd in enumerate(self.queued) if not cmd.ties), len(self.queued)) or 1
+                commands, self.queued = self.queued[:n], self.queued[n:]
+                self.busy += 1
+                return commands
+            else:
+                query = self.proto.status_query() if self.keepalive_interval else None
+                if self.inflight:
+                    timeout = self.inflight[0].sent + self.reply_timeout(self.inflight[0]) - now
+                elif query:
+                    timeout = self.last_activity + self.keepalive_interval - now
+                    if timeout <= 0:
+                        self.last_activity = now
+                        self.busy += 1
+                        return [Command([], (query, [None]), self.keepalive_done)]
+                else:
+                    timeout = None
+                self.queue_cond.wait(timeout)
+        self.missed(expired)
+        if expired:
+            self.set_health(False, "no reaction")
+            self.release(len(expired))
+        return []
+
+    def reply_timeout(self, frame):
+        """
+        how long to wait for the replies to a frame: frames with ties are
+        verified by querying the tie state (see missed), and the queries are
+        repeated, so if a reply was just late, that doesn't do any harm; such
+        frames only wait a few round-trip times (per queried output)
+        """
+        resync = frame.commands[0].resync
+        if not((frame.ties or resync) and self.frame_rtts):
+            return MAX_COMMAND_TIMEOUT
+        messages = (len(resync.ties) + 1) if resync else 1
+        return min(MAX_COMMAND_TIMEOUT, max(MIN_REPLY_TIMEOUT, REPLY_TIMEOUT_FACTOR * max(self.frame_rtts) * messages))
+
+    def unattributable(self):
+        """
+        True if a frame in flight expects a reply that doesn't name its tie:
+        nothing is sent behind it, because a later frame's reply could be
+        taken for its own if its reply is lost (called with queue_cond held)
+        """
+        return any(not isinstance(key, tuple) for frame in self.inflight for key in frame.expect)
+
+    def coalesce(self, commands):
+        "merge commands into a single frame; later ties to an output supersede earlier ones"
+        for cmd in commands:
+            cmd.attempts += 1
+        if (len(commands) == 1) and commands[0].resync:
+            frame = commands[0].resync
+            query = self.proto.query_outputs(sorted(pout for pin, pout in frame.ties if self.tied_by.get(pout) == frame.seq))
+            return Frame(query[0], [], commands, query[1]) if query else None
+        if (len(commands) == 1) and commands[0].frame:
+            data, expect = commands[0].frame
+            return Frame(data, commands[0].ties, commands, expect)
+        assign = {}
+        for cmd in commands:
+            assign.update((pout, pin) for pin, pout in cmd.ties)
+        ties = [(assign[pout], pout) for pout in sorted(assign)]
+        data, expect = self.proto.encode(ties)
+        return Frame(data, ties, commands, expect)
+
+    def transmit(self, commands):
+        with self.connect_lock:
             if not self.conn:
+                res = self.connect()
+                if self.conn and not res:
+                    print("! reconnect didn't succeed, trying to send anyway")
+            conn = self.conn
+        frame = self.coalesce(commands)  # only now, because tie queries depend on the protocol state after connecting
+        if not frame:
+            for cmd in commands:
+                cmd.complete(None)  # the protocol can't query single outputs
+            return
+        if not conn:
+            if frame.ties:
                 print("! reconnect attempt failed, can't send command")
-                return
-        self.proto.clear_status()
+            self.log("send_failed", ties=frame.ties)
+            frame.complete(None)
+            self.set_health(False, "reconnect failed")
+            return
+        with self.queue_cond:
+            frame.sent = self.last_activity = monotonic()
+            self.frame_seq += 1
+            frame.seq = self.frame_seq
+            self.tied_by.update((pout, frame.seq) for pin, pout in frame.ties)
+            self.inflight.append(frame)
+        self.log("frame", seq=frame.seq, data=frame.data, ties=frame.ties, commands=len(frame.commands))
         try:
-            part = data
-            while part:
-                n = self.do_send(self.conn, part)
-                part = part[n:]
-            self.do_flush(self.conn)
+            self.write(conn, frame.data)
         except EnvironmentError:
-            if allow_reconnect:
-                print("! connection lost, reconnecting and retrying")
-                self.disconnect()
-                return self.send(data, allow_reconnect=False, wait=wait)
-        if wait:
-            t1 = time.time() + MAX_COMMAND_TIMEOUT
-            while (self.proto.result is None) and (time.time() < t1):
-                time.sleep(POLL_INTERVAL)
-            if self.proto.result is None:
-                print("! no reaction from device, reconnecting and retrying")
-                self.disconnect()
-                return self.send(data, allow_reconnect=False, wait=wait)
-            if not self.proto.result:
-                print("! device reports error")
+            print("! connection lost, reconnecting and retrying")
+            self.disconnect()  # puts the frame's commands back into the queue
+
+    def do_wait(self, conn, timeout):
+        "wait until data can be received; transports with blocking receive just return True"
+        return True
 
     def do_flush(self, conn):
         pass
@@ -176,6 +940,7 @@ class TCPConnection(ConnectionBase):
     def do_connect(self, timeout):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
         s.settimeout(timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         s.connect((self.ip, self.port))
         return s
     def do_disconnect(self, s):
@@ -184,71 +949,713 @@ class TCPConnection(ConnectionBase):
         except EnvironmentError as e:
             pass
         s.close()
+    def do_wait(self, s, timeout):
+        return bool(select.select([s], [], [], timeout)[0])
     def do_receive(self, s):
-        return s.recv(1024)
+        return s.recv(4096)
     def do_send(self, s, data):
         return s.send(data)
 
 class SerialConnection(ConnectionBase):
-    "port[,baud[,<bits><parity><stop>]] - serial connection"
+    "port[,baud[,<bits><parity><stop>[,timeout]]] - serial connection"
+    # port is a number (0 = COM1 or /dev/ttyUSB0, or /dev/ttyS0 if there's no
+    # USB adapter) or a device path; parity 0/1/2 = none/odd/even;
+    # timeout = inter-byte timeout in ms, after which a partial reply is discarded
     def __init__(self, proto, *params):
         ConnectionBase.__init__(self, proto)
-        if not(len(params) in (1, 2, 3, 5)) \
-        or ((len(params) >= 2) and (params[1] < 300)) \
-        or ((len(params) == 3) and not(700 < params[2] < 822)) \
-        or ((len(params) >  3) and not(7 <= params[2] <= 8)) \
-        or ((len(params) >  3) and not(0 <= params[3] <= 2)) \
-        or ((len(params) >  3) and not(0 <= params[4] <= 2)):
+        params = list(params)
+        if len(params) == 1:
+            params.append(self.proto.default_baud)
+        if len(params) in (2, 3, 4):
+            bits = params[2] if (len(params) > 2) else self.proto.default_bits
+            params[2:3] = [bits // 100, (bits // 10) % 10, bits % 10]
+        if not(len(params) in (5, 6)) \
+        or not(isinstance(params[0], str) or (params[0] >= 0)) \
+        or (params[1] < 300) \
+        or not(7 <= params[2] <= 8) \
+        or not(0 <= params[3] <= 2) \
+        or not(1 <= params[4] <= 2) \
+        or ((len(params) == 6) and not(0 < params[5] < 10000)):
             raise UnsuitableConnectionParameters()
         self.port = params[0]
-        self.baud = self.proto.default_baud if (len(params) < 2) else params[1]
-        if len(params) > 3:
-            self.bits, self.parity, self.stop = params[2:5]
-        else:
-            bits = self.proto.default_bits if (len(params) < 3) else params[2]
-            self.bits   = (bits / 100) % 10
-            self.parity = (bits /  10) % 10
-            self.stop   =  bits        % 10
+        self.baud, self.bits, self.parity, self.stop = params[1:5]
+        self.inter_byte_timeout = (params[5] / 1000.0) if (len(params) == 6) else SERIAL_INTER_BYTE_TIMEOUT
+        self.device = self.port_name(self.port)
+        self.missing_module_reported = False
+        print("* connecting to {} at {} baud, {}{}{}".format(self.device, self.baud, self.bits, "NOE"[self.parity], self.stop))
 
-Connections = [TCPConnection]
-try:
-    import serial
-    Connections.append(SerialConnection)
-except ImportError:
-    pass
+    @staticmethod
+    def port_name(port):
+        if isinstance(port, str):
+            return port
+        if os.name == 'nt':
+            return "COM{}".format(port + 1)
+        usb = "/dev/ttyUSB{}".format(port)
+        return usb if os.path.exists(usb) else "/dev/ttyS{}".format(port)
+
+    def do_connect(self, timeout):
+        try:
+            load_serial()
+        except ImportError:
+            if not self.missing_module_reported:
+                print("! serial connections require the PySerial package")
+                self.missing_module_reported = True
+            raise EnvironmentError("PySerial is not installed")
+        s = serial.Serial()
+        s.port = self.device
+        s.baudrate = self.baud
+        s.bytesize = self.bits
+        s.parity = (serial.PARITY_NONE, serial.PARITY_ODD, serial.PARITY_EVEN)[self.parity]
+        s.stopbits = (serial.STOPBITS_ONE, serial.STOPBITS_TWO)[self.stop - 1]
+        s.timeout = 0  # reads never block
+        s.write_timeout = timeout
+        s.open()
+        s.reset_input_buffer()
+        return s
+    def do_disconnect(self, s):
+        # unlike a socket, the port can't be closed while the receiver thread
+        # uses it (disconnect has already told it to stop)
+        if self.receiver and (self.receiver is not threading.current_thread()):
+            self.receiver.join(MAX_CONNECT_TIMEOUT)
+        s.close()
+    def do_wait(self, s, timeout):
+        try:
+            if os.name != 'nt':
+                return bool(select.select([s], [], [], timeout)[0])
+            t1 = monotonic() + timeout
+            while not s.in_waiting:
+                if monotonic() >= t1:
+                    return False
+                time.sleep(SERIAL_POLL_INTERVAL)
+            return True
+        except (TypeError, ValueError) as e:  # the port has been closed (SerialException is an EnvironmentError already)
+            raise EnvironmentError(str(e))
+    def do_receive(self, s):
+        try:
+            return s.read(max(1, s.in_waiting))
+        except (TypeError, ValueError) as e:
+            raise EnvironmentError(str(e))
+    def do_send(self, s, data):
+        return s.write(data)
+
+Connections = [TCPConnection, SerialConnection]
 
 ###############################################################################
 
+re_subcmd = re.compile(r'^(?:([0-9a-z])/)?([0-9a-z]+)$')
+re_connect = re.compile(r'^/([0-9a-z]?)/([0-9.]*)(?:/([0-9.]+))?$')
+re_cue = re.compile(r'^[0-9a-z./]+(-[0-9]+-[0-9a-z./]+)+$')
+re_preset = re.compile(r'^\*\*([0-9a-z])\*([0-9]*)$')
+
+def write_atomic(filename, data):
+    "replace the contents of a file, so that it never contains anything but the old or the new data"
+    tmpfile = filename + ".tmp"
+    with open(tmpfile, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if hasattr(os, 'replace'):
+        os.replace(tmpfile, filename)
+    else:  # Python 2
+        if (os.name == 'nt') and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmpfile, filename)
+
+def device_label(name):
+    return "device '{}'".format(name) if name else "default device"
+
+class MacroRecursionError(ValueError):
+    pass
+
+class CompiledMacro(object):
+    """
+    A macro with all nested macro references expanded: the resulting ties
+    per device, and the ready-to-send command frame for each device.
+    """
+    __slots__ = ('ties', 'frames')
+    def __init__(self, ties):
+        self.ties = ties    # device name -> [(input, output)]
+        self.frames = {}    # device name -> (data, expected replies)
+
+class CueRunner(threading.Thread):
+    """
+    Executes the steps of a cue list at their target times, relative to the
+    start of the cue, using a monotonic clock. The bulk of each delay is slept
+    away, the last few milliseconds are spent spinning for better precision.
+    Both sleeping and spinning end as soon as the cue is stopped.
+    The actual send time of each step is logged against its target time.
+    """
+    def __init__(self, ctl, name, steps):
+        threading.Thread.__init__(self, name="Cue")
+        self.daemon = True
+        self.ctl = ctl
+        self.cue_name = name
+        self.steps = steps  # [(offset in seconds, CompiledMacro)]
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        t0 = monotonic()
+        for n, (offset, step) in enumerate(self.steps, 1):
+            target = t0 + offset
+            remaining = target - monotonic()
+            if (remaining > CUE_SPIN_TIME) and self.stopped.wait(remaining - CUE_SPIN_TIME):
+                return
+            while (monotonic() < target) and not self.stopped.is_set():
+                pass
+            if self.stopped.is_set():
+                return
+            t = monotonic()
+            self.ctl.switch(step.ties, step.frames, verbose=False)
+            with self.ctl.print_lock:
+                print("cue '{}' step {}/{}: target +{:.1f} ms, sent +{:.1f} ms (drift {:+.1f} ms)".format(
+                      self.cue_name, n, len(self.steps), offset * 1000.0, (t - t0) * 1000.0, (t - target) * 1000.0))
+
+class EventLog(threading.Thread):
+    """
+    Writes events (commands, frames, acknowledgments, tie changes,
+    reconnects, ...) to a file, one JSON object per line. log() only puts
+    the event into a queue; a background thread formats and writes it, so
+    logging never delays switching. Every event has a wall clock "time" and
+    a monotonic "mono" timestamp, in seconds.
+    """
+    def __init__(self, filename):
+        threading.Thread.__init__(self, name="EventLog")
+        self.daemon = True
+        self.file = open(filename, "a")
+        self.queue = queue.Queue()
+        self.start()
+
+    def log(self, event, fields):
+        fields["event"] = event
+        fields["time"] = time.time()
+        fields["mono"] = monotonic()
+        self.queue.put(fields)
+
+    def close(self):
+        "write the remaining events and close the file"
+        self.queue.put(None)
+        self.join()
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, bytes):
+            return value.decode('latin-1')  # frame data
+        raise TypeError(repr(value))
+
+    def run(self):
+        import json
+        while True:
+            events = [self.queue.get()]
+            while not self.queue.empty():
+                events.append(self.queue.get())
+            for event in events:
+                if event is None:
+                    self.file.close()
+                    return
+                self.file.write(json.dumps(event, sort_keys=True, separators=(',', ':'), default=self.encode) + "\n")
+            self.file.flush()
+
 class DVIMatrixController(object):
-    def __init__(self, configfile=None):
+    def __init__(self, configfile=None, measure_latency=False, pipeline_depth=DEFAULT_PIPELINE_DEPTH,
+                 keepalive_interval=KEEPALIVE_INTERVAL):
         self.configfile = configfile or DEFAULT_CONFIGFILE
+        self.snapshot_file = self.configfile + SNAPSHOT_SUFFIX
+        self.journal_entries = 0     # number of lines in the configuration file
         self.macros = {}
-        self.connection_config = []
+        self.compiled = {}           # macro name -> CompiledMacro
+        self.cues = {}               # cue name -> [command, delay, command, ...]
+        self.compiled_cues = {}      # cue name -> [(offset, CompiledMacro)]
+        self.preset_links = {}       # macro name -> device preset number
+        self.preset_state = {}       # (device name, preset) -> (ties, tie state) when the preset was saved
+        self.cue_runner = None
+        self.preloaded_cue = None
+        self.command_queue = None
+        self.tie_listeners = []      # callback(device name, input, output)
+        self.connection_config = {}  # device name -> connection parameters
+        self.standby_config = {}     # device name -> standby connection parameters
         self.config_lock = False
-        self.conn = None
+        self.conns = {}              # device name -> connection
+        self.standby = {}            # device name -> standby connection
+        self.swap_lock = threading.Lock()
+        self.pipeline_depth = pipeline_depth
+        self.keepalive_interval = keepalive_interval
+        self.measure_latency = measure_latency
+        self.latencies = []
+        self.print_lock = threading.Lock()
+        self.startup_profile = None  # StartupProfile, if connection times shall be reported
+        self.event_log = None        # EventLog, if enabled
+
+    def log(self, event, **fields):
+        if self.event_log:
+            self.event_log.log(event, fields)
+
+    def command_done(self, name, cmd):
+        if self.measure_latency and (cmd.rtt is not None):
+            with self.print_lock:
+                self.latencies.append(cmd.rtt)
+                print("latency ({}): {:.1f} ms".format(device_label(name), cmd.rtt * 1000.0))
+
+    def resolve(self, subcmds, assign=None, stack=(), warn=True):
+        """
+        resolve a list of subcommands into a {(device, output): input} map,
+        expanding (possibly nested) macro references
+        """
+        if assign is None:
+            assign = {}
+        for subcmd in subcmds:
+            if subcmd in self.macros:
+                if subcmd in stack:
+                    raise MacroRecursionError(" -> ".join(stack + (subcmd,)))
+                self.resolve(self.macros[subcmd], assign, stack + (subcmd,), warn)
+                continue
+            name, subcmd = re_subcmd.match(subcmd).groups()
+            if len(subcmd) < 2:
+                if warn: print("warning: ignoring incomplete subcommand '{}'".format(subcmd))
+                continue
+            subcmd = [int(c, 36) for c in subcmd]
+            for out in subcmd[1:]:
+                assign[name or "", out] = subcmd[0]
+        return assign
+
+    @staticmethod
+    def group_ties(assign):
+        "split a {(device, output): input} map into {device: [(input, output)]}"
+        device_ties = {}
+        for (name, o), i in sorted(assign.items()):
+            device_ties.setdefault(name, []).append((i, o))
+        return device_ties
+
+    def compile(self, subcmds):
+        "compile a list of subcommands for the current set of connections"
+        macro = CompiledMacro(self.group_ties(self.resolve(subcmds, warn=False)))
+        for dev, ties in macro.ties.items():
+            conn = self.conns.get(dev)
+            if conn:
+                macro.frames[dev] = conn.proto.encode(ties)
+        return macro
+
+    def compile_macros(self):
+        "precompile all macros and cue lists for the current set of connections"
+        self.compiled = dict((name, self.compile([name])) for name in self.macros)
+        self.compiled_cues = {}
+        for name, value in self.cues.items():
+            offset = 0.0
+            steps = []
+            for i, item in enumerate(value):
+                if i & 1:
+                    offset += int(item) / 1000.0
+                else:
+                    steps.append((offset, self.compile(item.split('.'))))
+            self.compiled_cues[name] = steps
+
+    def switch(self, device_ties, frames=None, force=False, verbose=True):
+        """
+        queue a {device: [(input, output)]} map of ties (with optional
+        precompiled frames) for sending, skipping ties that are already active
+        or about to become active; returns the submitted commands
+        """
+        commands = []
+        for name in sorted(device_ties):
+            conn = self.conns.get(name)
+            if not conn:
+                if name:
+                    print("warning: no connection for {}".format(device_label(name)))
+                continue
+            ties = device_ties[name]
+            frame = frames.get(name) if frames else None
+            if not force:
+                expected = conn.expected_ties()
+                skip = [o for i,o in ties if expected.get(o) == i]
+                if skip:
+                    ties = [(i,o) for i,o in ties if not(o in skip)]
+                    frame = None
+                    if verbose:
+                        print("already tied{}:".format(" on " + device_label(name) if name else ""),
+                              ', '.join(map(str, skip)))
+            self.log("submit", device=name, ties=ties, skipped=skip if not force else [])
+            if ties:
+                commands.append(conn.submit(ties, frame or conn.proto.encode(ties),
+                                            lambda cmd, name=name: self.command_done(name, cmd)))
+        return commands
+
+    def recall_macro(self, name, macro, force=False, verbose=True):
+        """
+        Recall a compiled macro. If it's linked to a device preset, the
+        preset is recalled with a single short command on each device where
+        it's in sync with the macro. On the other devices, the macro's ties
+        are sent as usual, followed by a command that saves them as the
+        preset, so that the next recall can use it.
+        """
+        preset = self.preset_links.get(name)
+        if not preset:
+            return self.switch(macro.ties, macro.frames, force, verbose)
+        commands = []
+        for dev in sorted(macro.ties):
+            conn = self.conns.get(dev)
+            ties = macro.ties[dev]
+            if not(conn and (preset <= conn.proto.presets)):
+                commands += self.switch({dev: ties}, macro.frames, force, verbose)
+            elif not self.recall_preset(dev, conn, preset, ties, force, verbose):
+                sent = self.switch({dev: ties}, macro.frames, force, verbose)
+                self.sync_preset(dev, conn, preset, ties, sent)
+                commands += sent
+        return commands
+
+    def recall_preset(self, dev, conn, preset, ties, force, verbose):
+        """
+        recall a preset on a device instead of sending the ties, if it's known
+        to contain them and wouldn't change any other outputs; returns False
+        if the preset can't be used
+        """
+        saved = self.preset_state.get((dev, preset))
+        if not(saved and (saved[0] == tuple(ties))):
+            return False  # unknown or out of date
+        expected = conn.expected_ties()
+        outputs = set(o for i, o in ties)
+        if any(expected.get(o) != i for o, i in saved[1].items() if not(o in outputs)):
+            return False  # other outputs have been switched since the preset was saved
+        if not(force) and all(expected.get(o) == i for i, o in ties):
+            if verbose:
+                print("already tied{}:".format(" on " + device_label(dev) if dev else ""),
+                      ', '.join(str(o) for i, o in ties))
+            self.log("submit", device=dev, ties=[], skipped=sorted(outputs), preset=preset)
+            return True
+        self.log("submit", device=dev, ties=ties, skipped=[], preset=preset)
+        conn.submit(ties, (conn.proto.recall_preset(preset), [None]),
+                    lambda cmd, dev=dev: self.command_done(dev, cmd))
+        return True
+
+    def sync_preset(self, dev, conn, preset, ties, commands):
+        "queue a command saving the tie state as a preset, once the given commands have been executed"
+        if not conn.proto.ties:
+            return  # the tie state of the other outputs isn't known yet
+        state = conn.expected_ties()
+        def done(cmd):
+            if cmd.result and all(c.result for c in commands):
+                self.preset_state[dev, preset] = (tuple(ties), state)
+            else:
+                self.preset_state.pop((dev, preset), None)
+                print("! failed to save preset {} on {}".format(preset, device_label(dev)))
+        self.preset_state.pop((dev, preset), None)
+        self.log("preset_save", device=dev, preset=preset)
+        conn.submit([], (conn.proto.save_preset(preset), [None]), done)
+
+    def wait_idle(self, timeout=MAX_CONNECT_TIMEOUT + MAX_COMMAND_TIMEOUT):
+        "wait until the commands queued for all devices have been sent and acknowledged"
+        t1 = monotonic() + timeout
+        return all([conn.wait_idle(t1 - monotonic()) for conn in list(self.conns.values())])
+
+    def run_cue(self, name):
+        self.stop_cue()
+        self.cue_runner = CueRunner(self, name, self.compiled_cues[name])
+        self.cue_runner.start()
+
+    def stop_cue(self):
+        if self.cue_runner and self.cue_runner.is_alive():
+            self.cue_runner.stop()
+            self.cue_runner.join()
+            print("stopped cue '{}'".format(self.cue_runner.cue_name))
+        self.cue_runner = None
+
+    def preload_cue(self, name):
+        "make sure that all devices used by a cue are connected, so it can start without delay"
+        for offset, step in self.compiled_cues[name]:
+            for dev in step.ties:
+                conn = self.conns.get(dev)
+                if conn and not(conn.conn):
+                    conn.connect()
+        self.preloaded_cue = name
+
+    def tie_changed(self, name, pin, pout):
+        self.log("tie", device=name, input=pin, output=pout)
+        for listener in self.tie_listeners:
+            listener(name, pin, pout)
+
+    def open_connection(self, name, params):
+        "create a (not yet connected) connection for a device, or return None if the parameters don't fit"
+        conn = None
+        for c in Connections:
+            try:
+                conn = c(*params)
+            except UnsuitableConnectionParameters:
+                pass
+        if conn:
+            conn.pipeline_depth = self.pipeline_depth
+            conn.keepalive_interval = self.keepalive_interval
+            conn.proto.on_tie = lambda pin, pout: self.connection_tie_changed(name, conn, pin, pout)
+            conn.on_health = lambda conn, healthy, reason: self.connection_health(name, conn, healthy, reason)
+            conn.on_event = lambda event, fields: self.connection_event(name, conn, event, fields)
+            self.log("open", device=name, params=params)
+        return conn
+
+    def connection_event(self, name, conn, event, fields):
+        fields["device"] = name
+        if self.conns.get(name) is not conn:
+            fields["standby"] = True
+        self.log(event, **fields)
+
+    def connection_tie_changed(self, name, conn, pin, pout):
+        if self.conns.get(name) is conn:  # the standby connection's view doesn't count
+            self.tie_changed(name, pin, pout)
+
+    def connection_health(self, name, conn, healthy, reason):
+        "swap in the standby connection as soon as the active one degrades"
+        with self.swap_lock:
+            active = (self.conns.get(name) is conn)
+            role = "connection" if active else "standby connection"
+            if healthy:
+                print("! {} to {} is healthy again".format(role, device_label(name)))
+                return
+            standby = self.standby.get(name)
+            if not(active) or not(standby) or not(standby.healthy):
+                print("! {} to {} degraded ({})".format(role, device_label(name), reason))
+                return
+            standby.proto.ties.update(conn.proto.ties)
+            self.conns[name], self.standby[name] = standby, conn
+            standby.adopt(conn.take_pending())
+            self.compile_macros()
+            print("! connection to {} degraded ({}), switched to standby connection".format(device_label(name), reason))
+
+    def health(self):
+        "return the connection health of all devices as {device: {...}}"
+        state = {}
+        for name, conn in list(self.conns.items()):
+            state[name] = conn.health()
+            standby = self.standby.get(name)
+            if standby:
+                state[name]["standby"] = standby.health()
+        return state
+
+    def tie_state(self):
+        "return the known tie state of all devices as {device: {output: input}}"
+        return dict((name, dict(conn.proto.ties)) for name, conn in self.conns.items())
 
-    def save_config(self):
+    def start_command_queue(self):
+        """
+        from now on, execute all commands in a single worker thread, so that
+        commands from multiple clients (keypad, network) are serialized
+        """
+        self.command_queue = queue.Queue()
+        worker = threading.Thread(target=self.command_worker, name="Commands")
+        worker.daemon = True
+        worker.start()
+
+    def command_worker(self):
+        while True:
+            item = self.command_queue.get()
+            try:
+                item[2] = self.handle_cmd(item[0], verbose=item[3])
+            except Exception as e:
+                print("error: command {!r} failed: {}".format(item[0], e))
+                item[2] = False
+            item[1].set()
+
+    def execute(self, cmd, verbose=True):
+        """
+        run a command from any thread; returns False if the command was invalid
+        """
+        if not self.command_queue:
+            return self.handle_cmd(cmd, verbose=verbose)
+        item = [cmd, threading.Event(), None, verbose]
+        self.command_queue.put(item)
+        item[1].wait()
+        return item[2]
+
+    def latency_report(self):
+        if not self.latencies:
+            return
+        l = sorted(self.latencies)
+        print("latency over {} command(s): min {:.1f} ms, median {:.1f} ms, max {:.1f} ms".format(
+              len(l), l[0] * 1000.0, l[len(l) // 2] * 1000.0, l[-1] * 1000.0))
+
+    def connection_line(self, name):
+        "return the connect command for the current configuration of a device"
+        params = self.connection_config.get(name)
+        if not params:
+            return "/{}/".format(name)
+        standby = self.standby_config.get(name)
+        return "/{}/{}{}".format(name, '.'.join(map(str, params)),
+                                 "/" + '.'.join(map(str, standby)) if standby else "")
+
+    def config_lines(self):
+        "return the current configuration as a minimal list of commands"
+        lines = [self.connection_line(name) for name in sorted(self.connection_config)]
+        lines += ["*{}*{}".format(k, ','.join(self.macros[k])) for k in sorted(self.macros)]
+        lines += ["**{}*{}".format(k, self.preset_links[k]) for k in sorted(self.preset_links)]
+        lines += ["*{}*{}".format(k, '-'.join(self.cues[k]).replace('.', ',')) for k in sorted(self.cues)]
+        return lines
+
+    def save_config(self, line):
+        """
+        The configuration file is a journal: every configuration change is
+        appended to it, in the form of the command that made the change.
+        Once it contains many more lines than the current configuration,
+        it's compacted.
+        """
         if self.config_lock:
             return
         try:
-            with open(self.configfile, "w") as f:
-                print("//" + '.'.join(map(str, self.connection_config)), file=f)
-                for k in sorted(self.macros):
-                    print("*{}*{}".format(k, ','.join(self.macros[k])), file=f)
+            with open(self.configfile, "ab+") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        line = "\n" + line  # last line of a hand-edited file
+                f.write((line + "\n").encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+        except EnvironmentError as e:
+            print("error: failed to write configuration file '{}': {}".format(self.configfile, e))
+            return
+        self.journal_entries += 1
+        live = len(self.connection_config) + len(self.macros) + len(self.cues) + len(self.preset_links)
+        if self.journal_entries > max(JOURNAL_COMPACT_MIN, 2 * live):
+            self.compact_config()
+
+    def compact_config(self):
+        "rewrite the configuration file with the minimal set of commands, and take a new snapshot"
+        lines = self.config_lines()
+        data = ''.join(line + "\n" for line in lines).encode('utf-8')
+        try:
+            write_atomic(self.configfile, data)
+        except EnvironmentError as e:
+            print("error: failed to write configuration file '{}': {}".format(self.configfile, e))
+            return
+        self.journal_entries = len(lines)
+        self.save_snapshot(data)
+
+    def save_snapshot(self, data):
+        """
+        Save the current configuration, together with the length and hash of
+        the configuration file it corresponds to, so that the next startup only
+        has to apply the lines that have been appended since.
+        """
+        import json, zlib
+        snapshot = {
+            "journal_offset": len(data),
+            "journal_crc32": zlib.crc32(data) & 0xFFFFFFFF,
+            "connections": self.connection_config,
+            "standby": self.standby_config,
+            "macros": self.macros,
+            "cues": self.cues,
+            "presets": self.preset_links,
+        }
+        try:
+            write_atomic(self.snapshot_file, json.dumps(snapshot, sort_keys=True).encode('utf-8'))
         except EnvironmentError as e:
-            print("error: failed to write configuration file '{}':".format(self.configfile, e))
+            print("error: failed to write configuration snapshot '{}': {}".format(self.snapshot_file, e))
 
     def load_config(self):
+        """
+        Load the configuration without any side effects, i.e. without
+        connecting to anything (see connect_all). If the snapshot matches the
+        beginning of the configuration file, only the lines after that are
+        applied; otherwise, the whole file is.
+        """
+        import json, zlib
+        t0 = monotonic()
+        try:
+            with open(self.configfile, "rb") as f:
+                data = f.read()
+        except EnvironmentError:
+            return  # no error if config file doesn't exist
+        offset = 0
+        try:
+            with open(self.snapshot_file, "rb") as f:
+                snapshot = json.loads(f.read().decode('utf-8'))
+            end = snapshot["journal_offset"]
+            if (zlib.crc32(data[:end]) & 0xFFFFFFFF) == snapshot["journal_crc32"]:
+                self.connection_config = snapshot["connections"]
+                self.standby_config = snapshot["standby"]
+                self.macros = snapshot["macros"]
+                self.cues = snapshot["cues"]
+                self.preset_links = snapshot["presets"]
+                offset = end
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            pass  # no usable snapshot: apply the whole file
+        lines = data[offset:].decode('utf-8', 'replace').splitlines()
         self.config_lock = True
         try:
-            with open(self.configfile) as f:
-                print("----- loading and executing configuration file ('{}') -----".format(self.configfile))
-                for cmd in f:
-                    self.handle_cmd(cmd, echo="+ ", verbose=False)
-                print("----- configuration file loaded -----")
-        except EnvironmentError as e:
-            pass  # no error if config file doesn't exist
-        self.config_lock = False
+            for cmd in lines:
+                cmd = cmd.split('#', 1)[0].strip()
+                if cmd[:1] in ('*', '/'):
+                    self.handle_cmd(cmd, verbose=False)
+                elif cmd:
+                    print("warning: ignoring command '{}' in configuration file".format(cmd))
+        finally:
+            self.config_lock = False
+        self.journal_entries = data.count(b"\n")
+        self.compile_macros()
+        print("----- configuration file loaded ('{}'): {} device(s), {} macro(s), {} cue list(s) in {:.1f} ms -----".format(
+              self.configfile, len(self.connection_config), len(self.macros), len(self.cues), (monotonic() - t0) * 1000.0))
+        if lines:
+            self.save_snapshot(data)
+
+    def connect_all(self, background=False):
+        "open the connections to all configured devices"
+        for name in sorted(self.connection_config):
+            if not self.connect_device(name, background):
+                print("! invalid connection parameters for", device_label(name))
+
+    def connect_device(self, name, background=False):
+        """
+        (re)open the connection (and standby connection) to a device according
+        to its current configuration; returns False if the parameters are invalid.
+        With background set, this doesn't wait for the connections to be
+        established: commands for the device are queued until they are.
+        """
+        params = self.connection_config.get(name)
+        standby_params = self.standby_config.get(name)
+        with self.swap_lock:
+            old = [self.conns.pop(name, None), self.standby.pop(name, None)]
+        for key in [key for key in list(self.preset_state) if key[0] == name]:
+            del self.preset_state[key]  # it may be a different device now
+        for conn in old:
+            if conn:
+                conn.close()
+        if not params:
+            self.compile_macros()
+            print("! removed", device_label(name))
+            return True
+        conn = self.open_connection(name, params)
+        if conn:
+            self.conns[name] = conn
+        self.compile_macros()
+        if not conn:
+            return False
+        standby = self.open_connection(name, standby_params) if standby_params else None
+        if standby:
+            self.standby[name] = standby
+        elif standby_params:
+            print("! invalid standby connection parameters")
+        if background:
+            t = threading.Thread(target=self.establish, args=(name, conn, standby), name="Connect")
+            t.daemon = True
+            t.start()
+        else:
+            self.establish(name, conn, standby)
+        return True
+
+    def establish(self, name, conn, standby):
+        "connect the connections opened by connect_device, and start sending"
+        label = " to " + device_label(name) if name else ""
+        res = conn.connect()
+        if res:
+            print("! connection{} established".format(label))
+        else:
+            print("! connection{} failed".format(label))
+        if self.startup_profile:
+            print("----- startup profile: connection{} {} after {:.1f} ms -----".format(
+                  label, "established" if res else "failed", self.startup_profile.elapsed() * 1000.0))
+        conn.start()
+        if standby:
+            print("! standby connection{} {}".format(label, "established" if standby.connect() else "failed"))
+            standby.start()
+            if not conn.healthy:
+                self.connection_health(name, conn, False, "connection failed")
 
     def handle_cmd(self, cmd, echo=None, verbose=True):
         cmd = cmd.split('#', 1)[0].strip().replace(',', '.').lower()
@@ -256,80 +1663,146 @@ class DVIMatrixController(object):
             return
         if echo:
             print(echo + cmd)
+        if not self.config_lock:
+            self.log("command", cmd=cmd)
+        force = cmd.startswith('+') and all(re_subcmd.match(sc) for sc in cmd[1:].split('.'))
+        if force:
+            cmd = cmd[1:]
         if False:
             pass  # elif chain follows
 
-        # handle assignment command
-        elif cmd.replace('.', '').isalnum():
-            # step 1: resolve macros
-            subcmds = []
-            for subcmd in cmd.split('.'):
-                subcmd = subcmd
-                if subcmd in self.macros:
-                    subcmds.extend(self.macros[subcmd])
-                else:
-                    subcmds.append(subcmd)
-            # step 2: resolve output assignments
-            assign = {}
-            for subcmd in subcmds:
-                if len(subcmd) < 2:
-                    print("warning: ignoring incomplete subcommand '{}'".format(subcmd))
-                    continue
-                subcmd = [int(c, 36) for c in subcmd]
-                for out in subcmd[1:]:
-                    assign[out] = subcmd[0]
-            assign = [(i,o) for o,i in assign.items()]
-            # step 3: send command
-            if self.conn and assign:
-                if len(assign) > 1:
-                    self.conn.send(self.conn.proto.switch_multi(assign))
-                else:
-                    self.conn.send(self.conn.proto.switch_single(*assign[0]))
+        # handle cue list recall
+        elif cmd in self.cues:
+            self.run_cue(cmd)
+
+        # handle cue list control: -x = preload cue x, - = start preloaded cue, -- = stop running cue
+        elif cmd.startswith('-') and ((len(cmd) < 2) or (cmd[1:] in self.cues) or (cmd == '--')):
+            if cmd == '--':
+                self.stop_cue()
+            elif len(cmd) > 1:
+                self.preload_cue(cmd[1:])
+                print("cue '{}' is ready".format(cmd[1:]))
+            elif self.preloaded_cue in self.cues:
+                self.run_cue(self.preloaded_cue)
+                self.preloaded_cue = None
+            else:
+                print("no cue preloaded")
+
+        # handle assignment command (with '+' prefix: regardless of tie state)
+        elif all(re_subcmd.match(subcmd) for subcmd in cmd.split('.')):
+            # step 1: resolve macros and output assignments
+            macro = self.compiled.get(cmd)
+            if macro:
+                device_ties = macro.ties
+            else:
+                device_ties = self.group_ties(self.resolve(cmd.split('.')))
+            # step 2: send commands, skipping ties that are already active
+            if macro:
+                self.recall_macro(cmd, macro, force, verbose)
+            else:
+                self.switch(device_ties, None, force, verbose)
+
+        # handle "store cue list" command, e.g. *9*1-1500-2-4000-34,56
+        elif (len(cmd) > 3) \
+        and (cmd[0] == '*') \
+        and cmd[1].isalnum() \
+        and (cmd[2] == '*') \
+        and re_cue.match(cmd[3:]):
+            name = cmd[1]
+            value = cmd[3:].split('-')
+            if not all(re_subcmd.match(subcmd) for step in value[::2] for subcmd in step.split('.')):
+                print("invalid cue list", repr(cmd[3:]))
+                return
+            self.macros.pop(name, None)
+            self.preset_links.pop(name, None)
+            self.cues[name] = value
+            if verbose: print("stored cue '{}': {} step(s), {:.1f} s".format(
+                              name, len(value[::2]), sum(map(int, value[1::2])) / 1000.0))
+            if not self.config_lock:
+                self.compile_macros()
+            self.save_config("*{}*{}".format(name, '-'.join(value).replace('.', ',')))
 
         # handle "store macro" command, e.g. *1*34,56
         elif (len(cmd) > 2) \
         and (cmd[0] == '*') \
         and cmd[1].isalnum() \
         and (cmd[2] == '*') \
-        and ((len(cmd) <= 3) or cmd[3:].replace('.', '').isalnum()):
+        and ((len(cmd) <= 3) or all(re_subcmd.match(subcmd) for subcmd in cmd[3:].split('.'))):
             name = cmd[1]
             value = cmd[3:].split('.')
             if value and value[0]:
+                self.cues.pop(name, None)
+                old_value = self.macros.get(name)
                 self.macros[name] = value
+                try:
+                    self.resolve([name], warn=verbose)
+                except MacroRecursionError as e:
+                    print("error: macro '{}' would be recursive ({})".format(name, e))
+                    if old_value:
+                        self.macros[name] = old_value
+                    else:
+                        del self.macros[name]
+                    return
                 if verbose: print("stored macro '{}':".format(name), ','.join(value))
             elif name in self.macros:
                 del self.macros[name]
+                self.preset_links.pop(name, None)
                 if verbose: print("deleted macro '{}'".format(name))
+            elif name in self.cues:
+                del self.cues[name]
+                if verbose: print("deleted cue '{}'".format(name))
             else:
                 if verbose: print("macro '{}' is not defined".format(name))
-            self.save_config()
+            if not self.config_lock:
+                self.compile_macros()
+            self.save_config("*{}*{}".format(name, ','.join(value)))
+
+        # handle "link macro to preset" command, e.g. **7*12 (or **7* to unlink)
+        elif re_preset.match(cmd):
+            name, preset = re_preset.match(cmd).groups()
+            preset = int(preset or 0)
+            other = next((k for k, v in self.preset_links.items() if (v == preset) and (k != name)), None)
+            if preset and other:
+                print("error: preset {} is already linked to macro '{}'".format(preset, other))
+                return
+            if preset:
+                self.preset_links[name] = preset
+                if verbose: print("linked macro '{}' to preset {}".format(name, preset))
+                for dev in sorted(self.compiled[name].ties if name in self.compiled else ()):
+                    conn = self.conns.get(dev)
+                    if verbose and conn and (preset > conn.proto.presets):
+                        print("warning: {} doesn't support preset {}, the macro is sent as ties there".format(
+                              device_label(dev), preset))
+            elif self.preset_links.pop(name, None):
+                if verbose: print("unlinked macro '{}' from its preset".format(name))
+            else:
+                if verbose: print("macro '{}' isn't linked to a preset".format(name))
+            self.save_config("**{}*{}".format(name, preset or ''))
 
-        # handle "set connection" command, e.g. //192.168.1.2.10001 or //0.9600.801
-        elif cmd.startswith('//') \
-        and ((len(cmd) < 3) or cmd[2:].replace('.', '').isdigit()):
-            params = cmd[2:].split('.')
+        # handle "set connection" command, e.g. //192.168.1.2.10001 or //0.9600.801,
+        # or for an additional named device, e.g. /b/2.192.168.1.3,
+        # optionally followed by a standby connection, e.g. //2.192.168.1.2/2.0
+        elif re_connect.match(cmd):
+            name, params, standby_params = re_connect.match(cmd).groups()
+            params = params.split('.')
             if params and params[0]:
                 params = list(map(int, params))
             else:
                 params = []
-            if params:
-                self.connection_config = params
-                self.save_config()
-                if self.conn:
-                    self.conn.disconnect()
-                self.conn = None
-                for c in Connections:
-                    try:
-                        self.conn = c(*params)
-                    except UnsuitableConnectionParameters:
-                        pass
-                need_help = not(self.conn)
-                if self.conn:
-                    res = self.conn.connect()
-                    if res:
-                        print("! connection established")
-                    else:
-                        print("! connection failed")
+            standby_params = list(map(int, standby_params.split('.'))) if (params and standby_params) else []
+            if params or name:
+                if params:
+                    self.connection_config[name] = params
+                else:
+                    self.connection_config.pop(name, None)
+                if standby_params:
+                    self.standby_config[name] = standby_params
+                else:
+                    self.standby_config.pop(name, None)
+                self.save_config(self.connection_line(name))
+                if self.config_lock:
+                    return  # loading the configuration: connect later
+                need_help = not self.connect_device(name)
             else:
                 need_help = True
             if need_help:
@@ -338,11 +1811,18 @@ class DVIMatrixController(object):
                     print("  - //proto," + c.__doc__)
                 print("protocols:")
                 for k in sorted(Protocols):
-                    print("  -", k, "-", Protocols[k].__doc__)
+                    print("  -", k, "-", Protocols[k].__doc__, "({})".format(Protocols[k].capabilities()))
+                print("additional devices:")
+                print("  - /x/proto,... = connect to device 'x' (0-9, a-z)")
+                print("  - /x/          = remove device 'x'")
+                print("  - x/12         = tie input 1 to output 2 on device 'x'")
+                print("standby connection:")
+                print("  - //proto,.../proto,... = keep a second connection to the same device ready")
 
         # invalid command
         else:
             print("invalid command", repr(cmd))
+            return False
 
     def interactive(self):
         print("----- entering interactive command mode -----")
@@ -353,23 +1833,325 @@ Quick tutorial:
   - 12,345       = do both above commands at once
   - *7*12,345    = store these commands as macro '7'
   - 7            = recall macro '7'
+  - *8*7,36      = macros can contain other macros
+  - **7*5        = store macro '7' in preset 5 of the matrix when recalled
+  - *9*7-1500-12 = store cue list '9': recall macro '7', tie 1 -> 2 after 1.5 s
+  - 9            = run cue list '9'
+  - -9           = preload cue list '9' ('-' alone starts it, '--' stops it)
+  - +12          = tie input 1 to output 2, even if it's already tied
   - //           = show help about connect command
   - //2,10.0.1.2 = connect to Extron switch at IP 10.0.1.2 (default port)
+  - /b/2,10.0.1.3 = connect to a second switch, named 'b'
+  - 12,b/34      = tie 1 -> 2 on the first switch and 3 -> 4 on switch 'b'
 Hints:
   - dots ('.') and commas (',') can be used interchangeably, even in IP addrs.
   - config file is saved after every "store macro" and "connect" command
         """.strip())
         while True:
             try:
-                self.handle_cmd(input("> "))
+                self.execute(input("> "))
             except (IOError, EOFError, KeyboardInterrupt) as e:
                 print(type(e).__name__)
                 print("----- leaving interactive command mode -----")
+                self.wait_idle()
+                self.latency_report()
+                return e
+
+###############################################################################
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC11B65"
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Network control interface. A single TCP port serves two protocols:
+    - a plain line protocol: each line is a command in the same syntax as
+      on the keypad, answered by "OK" or "ERR <message>"; a line with a
+      single "?" dumps the tie state as "TIE <device> <output> <input>"
+      lines, "??" additionally subscribes to tie state changes
+    - HTTP with JSON: GET /state, GET /health, GET /macros, POST /cmd, and
+      a WebSocket at /ws that accepts {"cmd": "..."} messages and pushes
+      {"event": "tie", ...} messages on tie state changes; browsers may only
+      send commands from pages served by this server (Origin check)
+    All commands are serialized through the controller's command queue.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, ctl, address):
+        load_server_modules()
+        socketserver.TCPServer.__init__(self, address, ControlRequestHandler)
+        self.ctl = ctl
+        self.subscribers = set()
+        self.subscriber_lock = threading.Lock()
+        self.events = queue.Queue()
+        ctl.tie_listeners.append(self.tie_changed)
+        for target in (self.broadcaster, self.serve_forever):
+            t = threading.Thread(target=target, name="ControlServer")
+            t.daemon = True
+            t.start()
+
+    def tie_changed(self, name, pin, pout):
+        # called from the receiver threads, which must never block
+        self.events.put((name, pin, pout))
+
+    def broadcaster(self):
+        while True:
+            event = self.events.get()
+            with self.subscriber_lock:
+                subscribers = list(self.subscribers)
+            for handler in subscribers:
+                try:
+                    handler.push_tie(*event)
+                except EnvironmentError:
+                    self.unsubscribe(handler)
+
+    def subscribe(self, handler):
+        with self.subscriber_lock:
+            self.subscribers.add(handler)
+
+    def unsubscribe(self, handler):
+        with self.subscriber_lock:
+            self.subscribers.discard(handler)
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.ctl = self.server.ctl
+        self.write_lock = threading.Lock()
+        self.websocket = False
+
+    def write(self, data):
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def handle(self):
+        try:
+            line = self.rfile.readline(MAX_LINE_LENGTH)
+            if re.match(br'(GET|POST) /', line):
+                self.handle_http(line)
+            else:
+                while line:
+                    self.handle_line(line.decode('utf-8', 'replace').strip())
+                    line = self.rfile.readline(MAX_LINE_LENGTH)
+        except EnvironmentError:
+            pass
+        finally:
+            self.server.unsubscribe(self)
+
+    def push_tie(self, name, pin, pout):
+        if self.websocket:
+            self.send_ws_json({"event": "tie", "device": name, "output": pout, "input": pin})
+        else:
+            self.write("TIE {} {} {}\r\n".format(name or "-", pout, pin).encode())
+
+    ########## line protocol
+
+    def handle_line(self, line):
+        if line in ("?", "??"):
+            for name, ties in sorted(self.ctl.tie_state().items()):
+                for pout, pin in sorted(ties.items()):
+                    self.write("TIE {} {} {}\r\n".format(name or "-", pout, pin).encode())
+            if line == "??":
+                self.server.subscribe(self)
+            self.write(b"OK\r\n")
+        elif line:
+            ok = (self.ctl.execute(line) is not False)
+            self.write(b"OK\r\n" if ok else b"ERR invalid command\r\n")
+
+    ########## HTTP
+
+    def handle_http(self, request_line):
+        method, path = request_line.decode('latin-1').split()[:2]
+        headers = {}
+        while True:
+            line = self.rfile.readline(MAX_LINE_LENGTH).decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self.send_json(400, {"ok": False, "error": "invalid Content-Length"})
+        body = self.rfile.read(length) if length else b''
+        path = path.partition('?')[0]
+
+        if (path == "/ws") and (headers.get('upgrade', '').lower() == "websocket"):
+            if not self.same_origin(headers):
+                return self.send_json(403, {"ok": False, "error": "cross-origin request"})
+            return self.handle_websocket(headers)
+        if path == "/state":
+            return self.send_json(200, {"devices": self.json_state()})
+        if path == "/health":
+            return self.send_json(200, {"devices": dict((name or "-", h) for name, h in self.ctl.health().items())})
+        if path == "/macros":
+            return self.send_json(200, {
+                "macros": dict((k, ','.join(v)) for k, v in self.ctl.macros.items()),
+                "presets": self.ctl.preset_links,
+                "cues": dict((k, '-'.join(v).replace('.', ',')) for k, v in self.ctl.cues.items())})
+        if path == "/cmd":
+            # commands change the state, so they must not be triggered by
+            # links or by scripts on other web pages
+            if method != "POST":
+                return self.send_json(405, {"ok": False, "error": "commands must be sent with POST"})
+            if not self.same_origin(headers):
+                return self.send_json(403, {"ok": False, "error": "cross-origin request"})
+            try:
+                cmd = json.loads(body.decode('utf-8')).get("cmd")
+            except (ValueError, AttributeError):
+                cmd = body.decode('utf-8', 'replace')
+            if not cmd:
+                return self.send_json(400, {"ok": False, "error": "no command specified"})
+            ok = (self.ctl.execute(cmd) is not False)
+            return self.send_json(200 if ok else 400, {"ok": ok, "cmd": cmd})
+        self.send_json(404, {"ok": False, "error": "not found"})
+
+    def same_origin(self, headers):
+        # browsers send an Origin header with POST requests and WebSocket
+        # upgrades; other clients (curl, scripts) usually don't send any
+        origin = headers.get('origin')
+        return (origin is None) or (origin.lower() == "http://" + headers.get('host', '').lower())
+
+    def json_state(self):
+        return dict((name, dict((str(o), i) for o, i in ties.items()))
+                    for name, ties in self.ctl.tie_state().items())
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+                   status, {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed"}[status], len(body)).encode() + body)
+
+    ########## WebSocket
+
+    def handle_websocket(self, headers):
+        accept = base64.b64encode(hashlib.sha1((headers.get('sec-websocket-key', '') + WEBSOCKET_GUID).encode()).digest())
+        self.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        self.websocket = True
+        self.server.subscribe(self)
+        self.send_ws_json({"event": "state", "devices": self.json_state()})
+        while True:
+            opcode, payload = self.recv_ws_frame()
+            if opcode == 8:    # close
+                self.send_ws_frame(8, payload[:2])
                 return
+            if opcode == 9:    # ping
+                self.send_ws_frame(10, payload)
+            elif opcode == 1:  # text
+                try:
+                    cmd = json.loads(payload.decode('utf-8')).get("cmd")
+                except (ValueError, AttributeError):
+                    cmd = None
+                if not cmd:
+                    self.send_ws_json({"ok": False, "error": "no command specified"})
+                    continue
+                self.send_ws_json({"ok": (self.ctl.execute(cmd) is not False), "cmd": cmd})
+
+    def recv_exact(self, n):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise EOFError()
+        return bytearray(data)
+
+    def recv_ws_frame(self):
+        try:
+            head = self.recv_exact(2)
+            length = head[1] & 0x7F
+            if length == 126:
+                length = struct.unpack('>H', bytes(self.recv_exact(2)))[0]
+            elif length == 127:
+                length = struct.unpack('>Q', bytes(self.recv_exact(8)))[0]
+            mask = self.recv_exact(4) if (head[1] & 0x80) else bytearray(4)
+            payload = self.recv_exact(length)
+        except EOFError:
+            return (8, b'')
+        for i in range(length):
+            payload[i] ^= mask[i & 3]
+        return (head[0] & 0x0F, bytes(payload))
+
+    def send_ws_frame(self, opcode, payload):
+        n = len(payload)
+        if n < 126:
+            head = struct.pack('>BB', 0x80 | opcode, n)
+        elif n < 65536:
+            head = struct.pack('>BBH', 0x80 | opcode, 126, n)
+        else:
+            head = struct.pack('>BBQ', 0x80 | opcode, 127, n)
+        self.write(head + payload)
+
+    def send_ws_json(self, obj):
+        self.send_ws_frame(1, json.dumps(obj).encode('utf-8'))
 
 ###############################################################################
 
 if __name__ == "__main__":
-    ctl = DVIMatrixController()
+    import argparse
+    startup = StartupProfile()
+    startup.mark("imports and definitions")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-c", "--config", metavar="FILE", default=DEFAULT_CONFIGFILE,
+                        help="configuration file (default: %(default)s)")
+    parser.add_argument("-l", "--latency", action='store_true',
+                        help="report the round-trip time of every command sent to the matrix")
+    parser.add_argument("-p", "--pipeline", metavar="N", type=int, default=DEFAULT_PIPELINE_DEPTH,
+                        help="maximum number of unacknowledged commands per matrix (default: %(default)s)")
+    parser.add_argument("-k", "--keepalive", metavar="SECONDS", type=float, default=KEEPALIVE_INTERVAL,
+                        help="interval of connection health checks while idle, 0 = off (default: %(default)s)")
+    parser.add_argument("-s", "--server", metavar="[HOST:]PORT",
+                        help="enable the network control interface (line protocol, HTTP and WebSocket) on this port; "
+                             "it only listens on localhost unless a HOST is given (e.g. 0.0.0.0:PORT for all interfaces)")
+    parser.add_argument("--profile-startup", action='store_true',
+                        help="report how long each phase of the startup takes")
+    parser.add_argument("--log", metavar="FILE",
+                        help="append a log of all commands, frames, acknowledgments, tie changes and reconnects to FILE (JSON lines)")
+    parser.add_argument("--plugin", metavar="MODULE", action='append', default=[],
+                        help="load a protocol plugin (module or file name); can be used multiple times")
+    args = parser.parse_args()
+    startup.mark("command line parsing")
+    for plugin in args.plugin:
+        try:
+            load_plugin(plugin)
+        except Exception as e:
+            print("error: can not load plugin '{}': {}".format(plugin, e))
+            sys.exit(1)
+    if args.plugin:
+        startup.mark("loading plugins")
+    ctl = DVIMatrixController(args.config, measure_latency=args.latency, pipeline_depth=max(1, args.pipeline),
+                              keepalive_interval=max(0.0, args.keepalive))
+    if args.profile_startup:
+        ctl.startup_profile = startup
     ctl.load_config()
-    ctl.interactive()
+    startup.mark("loading the configuration")
+    if args.log:
+        try:
+            ctl.event_log = EventLog(args.log)
+        except EnvironmentError as e:
+            print("error: can not open log file:", e)
+            sys.exit(1)
+        ctl.log("start", config=ctl.config_lines())
+    ctl.connect_all(background=True)
+    startup.mark("starting the connections")
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        ctl.start_command_queue()
+        try:
+            ControlServer(ctl, (host or "localhost", int(port)))
+        except (ValueError, EnvironmentError) as e:
+            print("error: can not start control server:", e)
+            sys.exit(1)
+        print("----- control server listening on {}:{} -----".format(host or "localhost", port))
+        startup.mark("starting the control server")
+    if args.profile_startup:
+        startup.report()
+    if isinstance(ctl.interactive(), EOFError) and args.server:
+        # no console (e.g. running as a service): keep serving network clients
+        print("----- serving network clients only, press Ctrl+C to quit -----")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+    if ctl.event_log:
+        ctl.event_log.close()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Parse and validate EDID (Extended Display Identification Data) blocks, and
+keep track of which EDID is stored in which slot of which device.
+
+When run as a script, prints a summary of the given EDID files.
+"""
+from __future__ import print_function, unicode_literals
+import collections
+import threading
+import hashlib
+import json
+import sys
+import os
+import re
+
+BLOCK_SIZE = 128
+HEADER = b'\x00\xff\xff\xff\xff\xff\xff\x00'
+PADDING = (b'\x00' * BLOCK_SIZE, b'\xff' * BLOCK_SIZE)
+CEA_EXTENSION_TAG = 0x02
+DESCRIPTOR_SIZE = 18
+DESCRIPTOR_NAME = 0xFC
+
+# usual widths of TV modes, which are named by their height only (e.g. 1080p)
+TV_WIDTHS = {480: 720, 576: 720, 720: 1280, 1080: 1920}
+DEFAULT_REFRESH = 60
+
+class EDIDError(ValueError):
+    pass
+
+class Timing(collections.namedtuple('Timing', "width height refresh interlaced")):
+    "a video mode; refresh is the field rate in Hz"
+    __slots__ = ()
+
+    def __str__(self):
+        return mode_name(self)
+
+def mode_name(timing):
+    "format a Timing as a mode mnemonic, like '1080p50' or '1280x1024@60'"
+    refresh = int(round(timing.refresh))
+    if TV_WIDTHS.get(timing.height) == timing.width:
+        return "{}{}{}".format(timing.height, "i" if timing.interlaced else "p", refresh)
+    return "{}x{}{}@{}".format(timing.width, timing.height, "i" if timing.interlaced else "", refresh)
+
+def parse_mode(name):
+    """
+    Parse a mode mnemonic into a dictionary of the Timing attributes it
+    specifies. Understands 'WIDTHxHEIGHT[@HZ]' and 'HEIGHTp[HZ]'/'HEIGHTi[HZ]';
+    for interlaced modes, the frame rate may be given instead of the field
+    rate (1080i30 = 1080i60). Returns None for anything else.
+    """
+    name = name.strip().lower()
+    m = re.match(r'^(\d+)x(\d+)(i?)(?:@(\d+(?:\.\d+)?))?$', name)
+    if m:
+        spec = {"width": int(m.group(1)), "height": int(m.group(2)), "interlaced": bool(m.group(3))}
+        refresh = m.group(4)
+    else:
+        m = re.match(r'^(\d+)([pi])(\d+(?:\.\d+)?)?$', name)
+        if not m:
+            return None
+        spec = {"height": int(m.group(1)), "interlaced": (m.group(2) == 'i')}
+        if spec["height"] in TV_WIDTHS:
+            spec["width"] = TV_WIDTHS[spec["height"]]
+        refresh = m.group(3)
+    if refresh:
+        spec["refresh"] = float(refresh)
+        if spec["interlaced"] and (spec["refresh"] <= 30):
+            spec["refresh"] *= 2
+    return spec
+
+def find_mode(name, timings):
+    """
+    Find the key of the best match for a mode mnemonic in a dictionary of
+    Timings. If the refresh rate isn't specified, the timing closest to
+    DEFAULT_REFRESH wins. Returns None if nothing matches.
+    """
+    spec = parse_mode(name)
+    if not spec:
+        return None
+    matches = []
+    for key, timing in timings.items():
+        if any(getattr(timing, attr) != value for attr, value in spec.items() if attr != "refresh"):
+            continue
+        if ("refresh" in spec) and (abs(timing.refresh - spec["refresh"]) >= 1.0):
+            continue
+        matches.append((abs(timing.refresh - spec.get("refresh", DEFAULT_REFRESH)), key))
+    return min(matches)[1] if matches else None
+
+def parse_descriptor(d):
+    "parse a detailed timing descriptor into a Timing; returns None for display descriptors"
+    clock = (d[0] | (d[1] << 8)) * 10000
+    if not clock:
+        return None
+    width   = d[2] | ((d[4] & 0xF0) << 4)
+    hblank  = d[3] | ((d[4] & 0x0F) << 8)
+    height  = d[5] | ((d[7] & 0xF0) << 4)
+    vblank  = d[6] | ((d[7] & 0x0F) << 8)
+    interlaced = bool(d[17] & 0x80)
+    if not(width and height):
+        raise EDIDError("invalid detailed timing descriptor")
+    refresh = float(clock) / ((width + hblank) * (height + vblank))
+    if interlaced:
+        height *= 2  # the descriptor specifies the lines per field
+    return Timing(width, height, round(refresh, 2), interlaced)
+
+class EDID(object):
+    """
+    A parsed and validated EDID: the base block and any extension blocks.
+    Blocks after the ones the base block announces are accepted if they
+    are all 0x00 or all 0xFF, e.g. a 128-byte EDID padded to 256 bytes;
+    data keeps the padding. Raises EDIDError if the data isn't a valid EDID.
+    """
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.digest = hashlib.sha1(self.data).hexdigest()
+        raw = bytearray(self.data)
+        if not(raw) or (len(raw) % BLOCK_SIZE):
+            raise EDIDError("EDID size must be a multiple of {} bytes (not {})".format(BLOCK_SIZE, len(raw)))
+        if bytes(raw[:8]) != HEADER:
+            raise EDIDError("invalid EDID header")
+        blocks = [raw[i:i+BLOCK_SIZE] for i in range(0, len(raw), BLOCK_SIZE)]
+        while (len(blocks) > raw[126] + 1) and (bytes(blocks[-1]) in PADDING):
+            blocks.pop()
+        if raw[126] != len(blocks) - 1:
+            raise EDIDError("EDID announces {} extension block(s), but contains {}".format(raw[126], len(blocks) - 1))
+        for n, block in enumerate(blocks):
+            if sum(block) & 0xFF:
+                raise EDIDError("checksum error in block {}".format(n))
+
+        self.manufacturer = ''.join(chr(64 + ((raw[8] << 8 | raw[9]) >> shift & 0x1F)) for shift in (10, 5, 0))
+        self.product = raw[10] | (raw[11] << 8)
+        self.version = "{}.{}".format(raw[18], raw[19])
+        self.name = None
+        self.timings = []
+        for pos in range(54, 126, DESCRIPTOR_SIZE):
+            self.add_descriptor(raw[pos:pos+DESCRIPTOR_SIZE])
+        if not self.timings:
+            raise EDIDError("EDID doesn't contain a preferred timing")
+        self.preferred = self.timings[0]
+
+        self.extensions = [block[0] for block in blocks[1:]]
+        for block in blocks[1:]:
+            if block[0] != CEA_EXTENSION_TAG:
+                continue
+            offset = block[2]
+            if offset and not(4 <= offset <= BLOCK_SIZE - 1):
+                raise EDIDError("invalid CEA extension block")
+            while offset and (offset + DESCRIPTOR_SIZE < BLOCK_SIZE) and (block[offset] or block[offset+1]):
+                self.add_descriptor(block[offset:offset+DESCRIPTOR_SIZE])
+                offset += DESCRIPTOR_SIZE
+
+    def add_descriptor(self, d):
+        timing = parse_descriptor(d)
+        if timing:
+            self.timings.append(timing)
+        elif d[3] == DESCRIPTOR_NAME:
+            self.name = bytes(d[5:]).split(b'\n')[0].decode('ascii', 'replace').strip()
+
+    def __str__(self):
+        return "{} {:04X}{}, EDID {}, preferred mode {}, {} extension block(s)".format(
+            self.manufacturer, self.product, " ({})".format(self.name) if self.name else "",
+            self.version, self.preferred, len(self.extensions))
+
+def load(filename):
+    "load and validate an EDID file"
+    with open(filename, 'rb') as f:
+        data = f.read()
+    try:
+        return EDID(data)
+    except EDIDError as e:
+        raise EDIDError("{}: {}".format(filename, e))
+
+class SlotCache(object):
+    """
+    Remembers which EDID (by content hash and preferred mode) has been
+    uploaded into which slot of which device, in a JSON file, so that
+    uploads of an EDID the slot already holds can be skipped.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        try:
+            with open(filename) as f:
+                self.devices = json.load(f)
+        except (EnvironmentError, ValueError):
+            self.devices = {}
+
+    def get(self, device, slot):
+        "return {'sha1': ..., 'mode': ...} for the EDID in a device slot, or None if unknown"
+        with self.lock:
+            return self.devices.get(device, {}).get(str(slot))
+
+    def set(self, device, slot, edid=None):
+        "record that a slot holds an EDID now; None means the contents are unknown"
+        with self.lock:
+            slots = self.devices.setdefault(device, {})
+            if edid:
+                slots[str(slot)] = {"sha1": edid.digest, "mode": mode_name(edid.preferred)}
+            else:
+                slots.pop(str(slot), None)
+
+    def timings(self, device):
+        "return {slot: Timing} of the preferred modes of all known EDIDs of a device"
+        with self.lock:
+            slots = self.devices.get(device, {}).items()
+            return dict((int(slot), Timing(**parse_mode(entry["mode"]))) for slot, entry in slots)
+
+    def save(self):
+        with self.lock:
+            tmpfile = self.filename + ".tmp"
+            with open(tmpfile, 'w') as f:
+                json.dump(self.devices, f, indent=2, sort_keys=True)
+            getattr(os, 'replace', os.rename)(tmpfile, self.filename)  # Python 2 only has rename
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage:", sys.argv[0], "<EDID.bin> [...]", file=sys.stderr)
+        sys.exit(2)
+    ok = True
+    for filename in sys.argv[1:]:
+        try:
+            edid = load(filename)
+        except (EDIDError, EnvironmentError) as e:
+            print("ERROR:", e, file=sys.stderr)
+            ok = False
+            continue
+        print("{}: {}".format(filename, edid))
+        print("    timings:", ", ".join(map(str, edid.timings)))
+    sys.exit(0 if ok else 1)
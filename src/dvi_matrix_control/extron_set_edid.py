@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 """
 Assign EDID information for all inputs of an Extron DXP 88 DVI Pro
-or DXP 88 HDMI video matrix switcher.
+or DXP 88 HDMI video matrix switcher, or, using a manifest file, for
+individual inputs of multiple switches at once.
 """
 from __future__ import print_function, unicode_literals
 import argparse
+import threading
 import socket
 import time
 import sys
 import re
 
+import edid
+
 DEFAULT_IP = "192.168.254.254"
 DEFAULT_PORT = 23
 CONFIG_FILE = "dvi_matrix_control.conf"
@@ -17,68 +21,100 @@ CONFIG_FILE = "dvi_matrix_control.conf"
 MAX_SLOT_ID = 40
 USER_SLOT_BEGIN = 37
 USER_SLOT_END = MAX_SLOT_ID
-DEFAULT_USER_SLOT = USER_SLOT_BEGIN
-DEFAULT_MODES = {
-    "out1":1, "out2":2, "out3":3, "out4":4, "out5":5, "out6":6, "out7":7, "out8":8,
-      "o1":1,   "o2":2,   "o3":3,   "o4":4,   "o5":5,   "o6":6,   "o7":7,   "o8":8,
-     "640x480": 9,   "800x600":11,  "852x480":13, "1024x768":15,  "1024x852":17,
-    "1280x768":19, "1280x1024":21, "1365x768":23, "1366x768":25, "1400x1050":27, "1600x1200":28,
-     "480p":29,  "480p60":29,
-     "576p":30,                "576p50":30,
-     "720p":32,  "720p60":32,  "720p50":31,
-    "1080i":34, "1080i60":34, "1080i30":34,
-    "1080p":36, "1080p60":36, "1080p50":35,
-    "user1":37, "user2":38, "user3":39, "user4":40,
-       "u1":37,    "u2":38,    "u3":39,    "u4":40,
+OUTPUT_SLOTS = 8  # slots 1-8 hold the EDIDs of the displays at outputs 1-8
+# the built-in EDIDs; the VESA modes are the 60 Hz variants
+FACTORY_SLOTS = {
+     9: edid.Timing( 640,  480, 60, False),
+    11: edid.Timing( 800,  600, 60, False),
+    13: edid.Timing( 852,  480, 60, False),
+    15: edid.Timing(1024,  768, 60, False),
+    17: edid.Timing(1024,  852, 60, False),
+    19: edid.Timing(1280,  768, 60, False),
+    21: edid.Timing(1280, 1024, 60, False),
+    23: edid.Timing(1365,  768, 60, False),
+    25: edid.Timing(1366,  768, 60, False),
+    27: edid.Timing(1400, 1050, 60, False),
+    28: edid.Timing(1600, 1200, 60, False),
+    29: edid.Timing( 720,  480, 60, False),
+    30: edid.Timing( 720,  576, 50, False),
+    31: edid.Timing(1280,  720, 50, False),
+    32: edid.Timing(1280,  720, 60, False),
+    34: edid.Timing(1920, 1080, 60, True),
+    35: edid.Timing(1920, 1080, 50, False),
+    36: edid.Timing(1920, 1080, 60, False),
 }
+DEFAULT_CACHE_FILE = "extron_edid_cache.json"
 
 DEFAULT_TIMEOUT = 0.25
 
+try:
+    monotonic = time.monotonic
+except AttributeError:  # Python 2
+    monotonic = time.time
+
+class DeviceError(Exception):
+    pass
+
 class Connection:
-    def __init__(self, ip, port, timeout=DEFAULT_TIMEOUT, verbose=False):
+    def __init__(self, ip, port, timeout=DEFAULT_TIMEOUT, verbose=False, prefix=""):
         self.timeout = timeout
         self.verbose = verbose
-        if self.verbose:
-            print("connecting to {}:{} ...".format(ip, port))
+        self.prefix = prefix  # for log messages, if multiple devices are handled at once
+        self.log("connecting to {}:{} ...".format(ip, port))
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
             self.sock.settimeout(self.timeout)
             self.sock.connect((ip, port))
         except EnvironmentError as e:
-            print("CONNECTION ERROR:", e, file=sys.stderr)
-            sys.exit(1)
+            raise DeviceError("CONNECTION ERROR: {}".format(e))
+        self.log("connection established.")
+
+    def log(self, *items):
         if self.verbose:
-            print("connection established.")
+            print(self.prefix + ' '.join(map(str, items)))
 
     def read_response(self, expect=None):
-        end = time.time() + self.timeout
+        """
+        Read until a line matching the expect regex has been received, or
+        (without expect) until all received lines are complete. The timeout
+        is only an upper bound for slow or silent devices.
+        """
+        end = monotonic() + self.timeout
         data = b''
-        while time.time() < end:
+        matched = False
+        while not matched:
+            remaining = end - monotonic()
+            if remaining <= 0:
+                break
+            self.sock.settimeout(remaining)
             try:
-                data += self.sock.recv(4096)
+                chunk = self.sock.recv(4096)
             except socket.timeout:
-                pass
+                break
             except EnvironmentError:
                 break
-        if self.verbose:
-            print("received:", repr(data))
+            if not chunk:
+                break
+            data += chunk
+            if expect:
+                lines = data.replace(b'\r', b'\n').split(b'\n')[:-1]
+                matched = any(re.match(expect, line.strip().decode(errors='replace')) for line in lines)
+            else:
+                matched = data.endswith((b'\r', b'\n'))
+        self.log("received:", repr(data))
 
-        if expect:
+        if expect and not matched:
             edata = data.strip().decode(errors='replace')
-            if not re.match(expect, edata):
-                print("UNEXPECTED RESPONSE - expected /{}/, got {!r}".format(expect, edata), file=sys.stderr)
-                sys.exit(1)
+            raise DeviceError("UNEXPECTED RESPONSE - expected /{}/, got {!r}".format(expect, edata))
 
     def send(self, data):
         if not isinstance(data, bytes):
             data = data.encode()
-        if self.verbose:
-            print("SENDING: ", repr(data))
+        self.log("SENDING: ", repr(data))
         try:
             self.sock.sendall(data)
         except EnvironmentError as e:
-            print("CONNECTION ERROR:", e, file=sys.stderr)
-            sys.exit(1)
+            raise DeviceError("CONNECTION ERROR: {}".format(e))
 
     def close(self):
         try:
@@ -86,6 +122,214 @@ class Connection:
         except EnvironmentError:
             pass
 
+def parse_slot(slot, user_timings={}):
+    """
+    convert a slot number or mode mnemonic into a slot number; returns None
+    if it's neither. Modes are looked up in the factory EDIDs first, then in
+    the preferred modes of the user slots in user_timings ({slot: Timing}).
+    """
+    try:
+        slot = int(slot)
+    except ValueError:
+        m = re.match(r'^(?:o|out)([0-9]+)$|^(?:u|user)([0-9]+)$', slot.lower())
+        if m and m.group(1) and (1 <= int(m.group(1)) <= OUTPUT_SLOTS):
+            return int(m.group(1))
+        if m and m.group(2) and (1 <= int(m.group(2)) <= USER_SLOT_END - USER_SLOT_BEGIN + 1):
+            return USER_SLOT_BEGIN + int(m.group(2)) - 1
+        return edid.find_mode(slot, FACTORY_SLOTS) or edid.find_mode(slot, user_timings)
+    return slot if (1 <= slot <= MAX_SLOT_ID) else None
+
+def load_edid(filename):
+    data = edid.load(filename)
+    if len(data.data) != 256:
+        raise edid.EDIDError("EDID file '{}' must be exactly 256 bytes long (not {})".format(filename, len(data.data)))
+    return data
+
+def parse_inputs(spec):
+    "parse an input list like '1-4,7' into a list of input numbers; 'all' is input 0"
+    if spec.lower() == "all":
+        return [0]
+    inputs = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        inputs.extend(range(int(first), int(last or first) + 1))
+    if not inputs or min(inputs) < 1:
+        raise ValueError("invalid input list '{}'".format(spec))
+    return inputs
+
+def device_name(ip, port):
+    return "{}:{}".format(ip, port)
+
+# connect command of dvi_matrix_control.py: /[DEVICE]/PARAMS[/STANDBY_PARAMS]
+re_connect = re.compile(r'^/([0-9a-z]?)/([0-9.]*)(?:/([0-9.]+))?$')
+
+def detect_address(filename):
+    """
+    Find the Extron network connection (type 2) of the default device in
+    a dvi_matrix_control.py configuration file. Returns (IP, port); the
+    port, or both, are None if not configured. A standby connection is
+    ignored, the last connect command wins.
+    """
+    ip = port = None
+    with open(filename) as f:
+        for line in f:
+            m = re_connect.match(line.strip().replace(',', '.'))
+            if not(m) or m.group(1):
+                continue
+            try:
+                params = list(map(int, m.group(2).split('.')))
+            except ValueError:
+                continue
+            if (len(params) < 5) or (params[0] != 2):
+                continue
+            ip = '.'.join(map(str, params[1:5]))
+            port = params[5] if (len(params) > 5) else None
+    return ip, port
+
+def read_manifest(filename, cache=None):
+    """
+    Read a batch manifest. Each line contains a switch address (IP[:PORT]),
+    a list of inputs ('all', or numbers and ranges like '1-4,7') and either
+    a slot number, a mode mnemonic or the name of an EDID file. Returns
+    {(ip, port): [(inputs, slot, EDID)]}, where exactly one of slot
+    and EDID is None.
+    """
+    devices = {}
+    with open(filename) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                address, inputs, spec = line.split()
+                ip, _, port = address.partition(':')
+                port = int(port or DEFAULT_PORT)
+                inputs = parse_inputs(inputs)
+                slot = parse_slot(spec, cache.timings(device_name(ip, port)) if cache else {})
+                data = None if slot else load_edid(spec)
+            except (ValueError, EnvironmentError) as e:
+                raise ValueError("{}, line {}: {}".format(filename, lineno, e))
+            devices.setdefault((ip, port), []).append((inputs, slot, data))
+    return devices
+
+def deploy(ip, port, assignments, timeout=DEFAULT_TIMEOUT, verbose=False, prefix="", cache=None, force=False):
+    """
+    Upload and assign EDIDs on one switch. assignments is a list of
+    (inputs, slot, EDID) tuples, as returned by read_manifest();
+    if an EDID is given, it is uploaded into the slot, or, without a slot,
+    into a free user slot. Each distinct EDID is uploaded only once, and
+    not at all if the cache says that the slot already holds it (unless
+    force is set).
+    Returns a dict of timings (in seconds) and counts.
+    """
+    device = device_name(ip, port)
+    wanted = set(data.digest for _, _, data in assignments if data)
+    t0 = monotonic()
+    c = Connection(ip, port, timeout=timeout, verbose=verbose, prefix=prefix)
+    try:
+        c.read_response()
+        t_connect = monotonic()
+
+        def cached(slot):
+            return (cache.get(device, slot) or {}).get("sha1") if (cache and not force) else None
+
+        uploaded = {}  # EDID digest -> slot
+        skipped = 0
+        slots = []
+        for inputs, slot, data in assignments:
+            if (data is None) or (data.digest in uploaded):
+                slots.append(slot or uploaded.get(data.digest))
+                continue
+            if not slot:
+                # prefer a slot that already holds the EDID, then one that holds none we need
+                used = set(uploaded.values())
+                free = [s for s in range(USER_SLOT_BEGIN, USER_SLOT_END + 1) if not(s in used)]
+                free.sort(key=lambda s: (cached(s) != data.digest, cached(s) in wanted))
+                if not free:
+                    raise DeviceError("more distinct EDID files than user slots ({}-{})".format(USER_SLOT_BEGIN, USER_SLOT_END))
+                slot = free[0]
+            if cached(slot) == data.digest:
+                c.log("slot #{} already holds EDID {}".format(slot, data))
+                skipped += 1
+            else:
+                c.log("loading EDID {} into slot #{}".format(data, slot))
+                if cache:
+                    cache.set(device, slot, None)
+                c.send("\x1bI{}EDID\r\n".format(slot).encode() + data.data)
+                c.read_response(r'EdidI0*' + str(slot))
+                if cache:
+                    cache.set(device, slot, data)
+            uploaded[data.digest] = slot
+            slots.append(slot)
+        t_upload = monotonic()
+
+        count = 0
+        for (inputs, _, _), slot in zip(assignments, slots):
+            for pin in inputs:
+                if pin:
+                    c.log("setting EDID of input {} to slot {}".format(pin, slot))
+                    c.send("\x1bA{}*{}EDID\r\n".format(pin, slot))
+                    c.read_response(r'EdidA0*{}\*0*{}'.format(pin, slot))
+                else:
+                    c.log("setting EDID to slot {}".format(slot))
+                    c.send("\x1bA{}*EDID\r\n".format(slot))
+                    c.read_response(r'EdidA0+\*' + str(slot))
+                count += 1
+        t_assign = monotonic()
+        c.log("done, closing connection.")
+    finally:
+        c.close()
+    return {
+        "uploads": len(uploaded) - skipped,
+        "skipped": skipped,
+        "assignments": count,
+        "connect": t_connect - t0,
+        "upload": t_upload - t_connect,
+        "assign": t_assign - t_upload,
+        "total": t_assign - t0,
+    }
+
+def deploy_batch(devices, timeout=DEFAULT_TIMEOUT, verbose=False, cache=None, force=False):
+    """
+    Run deploy() for all devices of a manifest in parallel, then print a
+    summary of the timings. Returns False if any device failed.
+    """
+    results = {}
+    def worker(ip, port):
+        try:
+            results[ip, port] = deploy(ip, port, devices[ip, port], timeout, verbose,
+                                       "[{}] ".format(device_name(ip, port)), cache, force)
+        except DeviceError as e:
+            results[ip, port] = e
+    threads = [threading.Thread(target=worker, args=device) for device in sorted(devices)]
+    t0 = monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = monotonic() - t0
+
+    print("{:<22} {:>7} {:>7} {:>7} {:>8} {:>8} {:>8} {:>8}".format(
+          "switch", "uploads", "skipped", "assigns", "connect", "upload", "assign", "total"))
+    ok = True
+    for ip, port in sorted(devices):
+        res = results.get((ip, port)) or DeviceError("no result")
+        name = device_name(ip, port)
+        if isinstance(res, DeviceError):
+            print("{:<22} {}".format(name, res))
+            ok = False
+        else:
+            print("{:<22} {:>7} {:>7} {:>7} {:>7.3f}s {:>7.3f}s {:>7.3f}s {:>7.3f}s".format(
+                  name, res["uploads"], res["skipped"], res["assignments"], res["connect"], res["upload"], res["assign"], res["total"]))
+    print("{} switch(es) done in {:.3f}s".format(len(devices), elapsed))
+    return ok
+
+def save_cache(cache):
+    try:
+        cache.save()
+    except EnvironmentError as e:
+        print("WARNING: could not save EDID cache:", e, file=sys.stderr)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("-v", "--verbose", action='store_true',
@@ -95,46 +339,55 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--port", metavar="N", type=int,
                         help="set SIS control port (default: read from {} if present, else fall back to {})".format(CONFIG_FILE, DEFAULT_PORT))
     parser.add_argument("-t", "--timeout", metavar="SECONDS", type=float, default=DEFAULT_TIMEOUT,
-                        help="set amount of time to wait for responses (default: %(default)s)")
+                        help="set maximum amount of time to wait for each response (default: %(default)s)")
     parser.add_argument("-f", "--edidfile", metavar="EDID.bin",
                         help="load EDID file (256-byte binary dump) into a user-defined EDID slot (37-40) and activate that")
     parser.add_argument("slot", metavar="MODE|SLOT", nargs='?',
                         help="""
                             set internal EDID "slot" number to assign to all outputs
                             (optional if -f is used, mandatory otherwise;
-                            can be either a number 1-40 or one of the following
-                            mnemonics: """ + ", ".join(sorted(DEFAULT_MODES)) + ")")
+                            can be either a number 1-40, outN/oN for the EDID of the display
+                            at output N, userN/uN for user slot N, or a video mode like
+                            1080p50 or 1280x1024@60; built-in modes are """
+                            + ", ".join(edid.mode_name(FACTORY_SLOTS[s]) for s in sorted(FACTORY_SLOTS))
+                            + "; other modes are looked up in the EDIDs uploaded to the user slots)")
+    parser.add_argument("-m", "--manifest", metavar="FILE",
+                        help="""
+                            configure multiple switches in parallel, as described
+                            in a manifest file with lines of the form
+                            'IP[:PORT] INPUTS MODE|SLOT|EDIDFILE'
+                            (INPUTS is either 'all' or a list like '1-4,7')""")
+    parser.add_argument("-c", "--cache", metavar="FILE", default=DEFAULT_CACHE_FILE,
+                        help="remember which EDID has been uploaded into which user slot in FILE (default: %(default)s)")
+    parser.add_argument("-F", "--force", action='store_true',
+                        help="upload EDID files even if the slot is known to hold them already")
     args = parser.parse_args()
     slot = args.slot
     ip = args.ip
     port = args.port
+    cache = edid.SlotCache(args.cache)
 
-    if slot:
+    if args.manifest:
+        if slot or args.edidfile or ip or port:
+            parser.error("-m can't be combined with -a, -p, -f or a mode/slot")
         try:
-            slot = int(slot)
-        except ValueError:
-            try:
-                slot = DEFAULT_MODES[slot]
-            except KeyError:
-                parser.error("unrecognized mode/slot '{}'".format(slot))
+            devices = read_manifest(args.manifest, cache)
+        except (ValueError, EnvironmentError) as e:
+            print("ERROR:", e, file=sys.stderr)
+            sys.exit(1)
+        ok = deploy_batch(devices, timeout=args.timeout, verbose=args.verbose, cache=cache, force=args.force)
+        save_cache(cache)
+        sys.exit(0 if ok else 1)
 
     if not(args.edidfile) and not(slot):
         parser.error("neither EDID file nor desired video mode specified")
 
     if not ip:
         try:
-            with open(CONFIG_FILE) as f:
-                if args.verbose:
-                    print("trying to auto-detect IP address from", CONFIG_FILE, "...")
-                for line in f:
-                    line = line.strip().replace(',', '.')
-                    if line.startswith("//2."):
-                        try:
-                            line = list(map(int, line[4:].split('.')))
-                        except ValueError:
-                            line = []
-                        if len(line) >= 4: ip   = '.'.join(map(str, line[:4]))
-                        if len(line) >  4: port = line[4]
+            if args.verbose:
+                print("trying to auto-detect IP address from", CONFIG_FILE, "...")
+            ip, detected_port = detect_address(CONFIG_FILE)
+            port = port or detected_port
             if args.verbose:
                 if ip:
                     print("detected IP address", ip)
@@ -145,31 +398,25 @@ if __name__ == "__main__":
     ip = ip or DEFAULT_IP
     port = port or DEFAULT_PORT
 
+    if slot:
+        slot_id = parse_slot(slot, cache.timings(device_name(ip, port)))
+        if not slot_id:
+            parser.error("unrecognized mode/slot '{}'".format(slot))
+        slot = slot_id
+
     if args.edidfile:
-        slot = slot or DEFAULT_USER_SLOT
-        if args.verbose:
-            print("loading EDID file '{}' into slot #{}".format(args.edidfile, slot))
-        with open(args.edidfile, 'rb') as f:
-            edid = f.read()
-        if len(edid) != 256:
-            print("ERROR: EDID file must be exactly 256 bytes long (not {})".format(len(edid)), file=sys.stderr)
+        try:
+            data = load_edid(args.edidfile)
+        except (ValueError, EnvironmentError) as e:
+            print("ERROR:", e, file=sys.stderr)
             sys.exit(1)
     else:
-        edid = None
-
-    assert slot
-    c = Connection(ip, port, timeout=args.timeout, verbose=args.verbose)
-    c.read_response()
-
-    if edid:
-        c.send("\x1bI{}EDID\r\n".format(slot).encode() + edid)
-        c.read_response(r'EdidI0*' + str(slot))
-
-    if args.verbose:
-        print("setting EDID to slot {}".format(slot))
-    c.send("\x1bA{}*EDID\r\n".format(slot))
-    c.read_response(r'EdidA0+\*' + str(slot))
+        data = None
 
-    if args.verbose:
-        print("done, closing connection.")
-    c.close()
+    try:
+        deploy(ip, port, [([0], slot, data)], timeout=args.timeout, verbose=args.verbose, cache=cache, force=args.force)
+    except DeviceError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        save_cache(cache)
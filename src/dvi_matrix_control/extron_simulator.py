@@ -1,105 +1,336 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 """
-Minimal simulation of the SIS protocol as implemented by Extron DXP switches.
-Really only supports enough of the protocol to talk to dvi_matrix_control.py.
+Simulation of Extron DXP (SIS protocol) and Lightware (LW1 protocol)
+crossbar switches, for development and benchmarking of dvi_matrix_control.py
+without hardware. Any number of clients can be connected at the same time;
+all of them operate on the same tie state. Replies can be delayed, jittered
+and dropped to simulate slow or unreliable devices.
 
 NOTE: This script is just used for development.
       It is *not* required to use dvi_matrix_control with a real switch!
 """
-from __future__ import print_function
-import SocketServer
+import abc
+import argparse
+import asyncio
+import os
+import random
+import re
+import sys
 
-class ConnectionHandler(SocketServer.BaseRequestHandler):
-    def handle(self):
-        self.request.sendall("(c) Copyright 20nn, Extron Electronics DXP DVI-HDMI, Vn.nn, 60-nnnn-01\r\nDdd, DD Mmm YYYY HH:MM:SS\r\n")
+SIS_GREETING = b"(c) Copyright 20nn, Extron Electronics DXP DVI-HDMI, Vn.nn, 60-nnnn-01\r\nDdd, DD Mmm YYYY HH:MM:SS\r\n"
+SIS_FIRMWARE = b"1.23"
+SIS_PART_NUMBER = b"60-nnnn-01"
+SIS_TIE_TYPES = {b'!': b"All", b'&': b"RGB", b'%': b"Vid", b'$': b"Aud"}
+LW1_PRODUCT = b"I:MX8x8DVI-SIMULATOR"
+EDID_SIZE = 256
+PRESETS = 32
+
+re_sis_tie = re.compile(br'(\d+)\*(\d+)([!&%$])')
+re_sis_query = re.compile(br'(\d+)[!%$&]')
+re_sis_preset = re.compile(br'(\d+)([,.])')
+re_sis_multi = re.compile(br'\x1b\+Q(.*?)\r?\n', re.S)
+re_sis_edid_upload = re.compile(br'\x1bI(\d+)EDID\r?\n')
+re_sis_edid_assign = re.compile(br'\x1bA(\d+)\*(\d*)EDID\r?\n')
+re_lw1_cmd = re.compile(br'\{([^}]*)\}')
+re_lw1_tie = re.compile(br'(\d+)@(\d+)$')
+re_lw1_preset = re.compile(br'([$%])(\d+)$')
+
+class Matrix:
+    "the state of the simulated switch, shared by all clients"
+    def __init__(self, inputs, outputs):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.ties = dict((o, 1) for o in range(1, outputs + 1))  # output -> input (0 = untied)
+        self.edids = {}        # EDID slot -> data
+        self.edid_inputs = {}  # input -> EDID slot
+        self.presets = {}      # preset number -> ties
+
+    def preset(self, n, save):
+        "save or recall a preset; returns False if that's not possible"
+        if not(1 <= n <= PRESETS) or not(save or (n in self.presets)):
+            return False
+        if save:
+            self.presets[n] = dict(self.ties)
+        else:
+            self.ties.update(self.presets[n])
+        return True
+
+    def valid_input(self, pin):
+        return 0 <= pin <= self.inputs
+
+    def valid_output(self, pout):
+        return 1 <= pout <= self.outputs
+
+class Session(abc.ABC):
+    """
+    Protocol state of a single client. feed() takes any fragment of the
+    received byte stream and returns the list of (description, reply) pairs
+    for all commands that are complete by now. Each protocol implements
+    parse().
+    """
+    greeting = b""
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.buf = b""
+
+    def feed(self, data):
+        self.buf += data
+        replies = []
+        while self.buf:
+            res = self.parse()
+            if not res:
+                break
+            consumed, desc, reply = res
+            self.buf = self.buf[consumed:]
+            if desc:
+                replies.append((desc, reply))
+        return replies
+
+    @abc.abstractmethod
+    def parse(self):
+        "return (number of bytes consumed, description, reply) or None if more data is needed"
+
+class SISSession(Session):
+    greeting = SIS_GREETING
+
+    def parse(self):
+        buf = self.buf
+        m = self.matrix
+        if buf.startswith(b"\x1b"):
+            if len(buf) < 2:
+                return None
+            if buf[1:2] == b"+":
+                r = re_sis_multi.match(buf)
+                if not r:
+                    return None
+                ties = [(int(i), int(o)) for i, o, _ in re_sis_tie.findall(r.group(1))]
+                if not all(m.valid_input(i) and m.valid_output(o) for i, o in ties):
+                    return r.end(), "multi tie (invalid)", b"E01"
+                m.ties.update((o, i) for i, o in ties)
+                return r.end(), "multi tie " + ' '.join("{}*{}".format(i, o) for i, o in ties), b"Qik"
+            if buf[1:2] == b"I":
+                r = re_sis_edid_upload.match(buf)
+                if not r:
+                    return None
+                if len(buf) < r.end() + EDID_SIZE:
+                    return None
+                slot = int(r.group(1))
+                m.edids[slot] = buf[r.end():r.end() + EDID_SIZE]
+                return r.end() + EDID_SIZE, "EDID upload to slot {}".format(slot), b"EdidI%02d" % slot
+            if buf[1:2] == b"A":
+                r = re_sis_edid_assign.match(buf)
+                if not r:
+                    return None
+                if r.group(2):  # input*slot
+                    pin, slot = int(r.group(1)), int(r.group(2))
+                else:           # slot for all inputs
+                    pin, slot = 0, int(r.group(1))
+                if not m.valid_input(pin):
+                    return r.end(), "EDID assign (invalid)", b"E01"
+                for i in (range(1, m.inputs + 1) if pin == 0 else [pin]):
+                    m.edid_inputs[i] = slot
+                return r.end(), "EDID assign slot {} to input {}".format(slot, pin or "all"), b"EdidA%02d*%02d" % (pin, slot)
+            end = buf.find(b"\n")
+            if end < 0:
+                return None
+            return end + 1, "unrecognized escape command {!r}".format(buf[:end + 1]), b"E10"
+        if buf[:1] in b"\r\n ":
+            return 1, None, None
+        if buf[:1].isdigit():
+            r = re_sis_tie.match(buf)
+            if r:
+                pin, pout = int(r.group(1)), int(r.group(2))
+                if not m.valid_input(pin):
+                    return r.end(), "single tie (invalid input)", b"E01"
+                if not m.valid_output(pout):
+                    return r.end(), "single tie (invalid output)", b"E12"
+                m.ties[pout] = pin
+                return r.end(), "single tie {}*{}".format(pin, pout), \
+                       b"Out%02d In%02d %s" % (pout, pin, SIS_TIE_TYPES[r.group(3)])
+            r = re_sis_query.match(buf)
+            if r:
+                pout = int(r.group(1))
+                if not m.valid_output(pout):
+                    return r.end(), "tie query (invalid output)", b"E12"
+                return r.end(), "tie query {}".format(pout), b"%02d" % m.ties[pout]
+            r = re_sis_preset.match(buf)
+            if r:
+                n, save = int(r.group(1)), (r.group(2) == b",")
+                desc = "{} preset {}".format("save" if save else "recall", n)
+                if not m.preset(n, save):
+                    return r.end(), desc + " (invalid)", b"E11"
+                return r.end(), desc, b"%s%02d" % (b"Spr" if save else b"Rpr", n)
+            r = re.match(br'\d+(?:\*\d*)?', buf)
+            if r.end() == len(buf):
+                return None  # incomplete command
+            return r.end() + 1, "unrecognized command {!r}".format(buf[:r.end() + 1]), b"E10"
+        c = buf[:1].upper()
+        if c == b"I":
+            return 1, "information", b"V%dX%d A%dX%d" % (m.inputs, m.outputs, m.inputs, m.outputs)
+        if c == b"Q":
+            return 1, "firmware version", SIS_FIRMWARE
+        if c == b"N":
+            return 1, "part number", SIS_PART_NUMBER
+        return 1, "unrecognized command {!r}".format(buf[:1]), b"E10"
+
+class LW1Session(Session):
+    def parse(self):
+        start = self.buf.find(b"{")
+        if start < 0:
+            return len(self.buf), None, None  # garbage outside of braces
+        r = re_lw1_cmd.match(self.buf, start)
+        if not r:
+            return (start, None, None) if start else None
+        cmd = r.group(1).strip()
+        m = self.matrix
+        t = re_lw1_tie.match(cmd)
+        if t:
+            pin, pout = int(t.group(1)), int(t.group(2))
+            if not(m.valid_input(pin) and m.valid_output(pout)):
+                return r.end(), "tie (invalid)", b"(ERR01)"
+            m.ties[pout] = pin
+            return r.end(), "tie {}@{}".format(pin, pout), b"(O%02d I%02d)" % (pout, pin)
+        p = re_lw1_preset.match(cmd)
+        if p:
+            n, save = int(p.group(2)), (p.group(1) == b"$")
+            desc = "{} preset {}".format("save" if save else "recall", n)
+            if not m.preset(n, save):
+                return r.end(), desc + " (invalid)", b"(ERR01)"
+            return r.end(), desc, b"(%s%02d)" % (b"SPR" if save else b"LPR", n)
+        if cmd.upper() == b"VC":
+            return r.end(), "tie query", b"(ALL " + b" ".join(b"%02d" % m.ties[o] for o in sorted(m.ties)) + b")"
+        if cmd.lower() == b"i":
+            return r.end(), "product type", b"(" + LW1_PRODUCT + b")"
+        return r.end(), "unrecognized command {!r}".format(cmd), b"(ERR04)"
+
+Protocols = {
+    "sis": SISSession,
+    "lw1": LW1Session,
+}
+
+class Responder:
+    """
+    Sends the replies to one client in order, each one after the configured
+    latency (plus or minus jitter), or drops it with the configured probability.
+    """
+    def __init__(self, write, name, args):
+        self.write = write
+        self.name = name
+        self.args = args
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.run())
+
+    def put(self, desc, reply):
+        self.queue.put_nowait((desc, reply))
+
+    async def run(self):
+        args = self.args
+        while True:
+            desc, reply = await self.queue.get()
+            delay = max(0.0, args.latency + random.uniform(-args.jitter, args.jitter)) / 1000.0
+            if delay:
+                await asyncio.sleep(delay)
+            if random.random() < args.drop:
+                log(args, self.name, desc, "-> (dropped)")
+                continue
+            log(args, self.name, desc, "->", reply.decode('latin-1'))
+            self.write(reply + b"\r\n")
+
+    def close(self):
+        self.task.cancel()
+
+def log(args, *items):
+    if not args.quiet:
+        print(*items)
+
+async def serve_client(reader, writer, matrix, proto, args):
+    name = "{}:{}".format(proto, writer.get_extra_info('peername')[1])
+    log(args, name, "connected")
+    session = Protocols[proto](matrix)
+    writer.write(session.greeting)
+    responder = Responder(writer.write, name, args)
+    try:
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            for desc, reply in session.feed(data):
+                responder.put(desc, reply)
+    except EnvironmentError:
+        pass
+    finally:
+        responder.close()
+        writer.close()
+        log(args, name, "disconnected")
+
+def serve_pty(matrix, proto, args):
+    "serve a pseudo-terminal, whose other end can be used like a serial port"
+    import tty  # Unix only, like pseudo-terminals themselves
+    master, slave = os.openpty()
+    tty.setraw(slave)  # the slave end stays open, so the master survives client disconnects
+    name = "{}:pty".format(proto)
+    session = Protocols[proto](matrix)
+    responder = Responder(lambda data: os.write(master, data), name, args)
+    def readable():
         try:
-            print("connected")
-            buf = ""
-            cmd = None
-            wait = False
-            while True:
-                if cmd:
-                    if pos > 0:
-                        print("dummy data:", repr(buf[:pos]))
-                    print(cmd + " command:", repr(buf[pos:]))
-                    if response:
-                        self.request.sendall(response)
-                    buf = ""
-                    wait = False
-                cmd = pos = response = None
-            
-                c = self.request.recv(1)
-                if not c:
-                    print("disconnected")
-                    return
-                buf += c
-                # print("\x1b[37m" + repr(buf) + "\x1b[0m")
-
-                # detect multi-tie command
-                if buf.endswith("\x1b+Q"):
-                    wait = True
-                    continue
-
-                # detect single-tie command
-                if not(wait) and (buf[-1] in "!&%$"):
-                    pos = buf.rfind("*")
-                    if pos < 1:
-                        print("bogus command:", repr(buf))
-                        buf = ""
-                        continue
-                    while pos and buf[pos-1].isdigit(): pos -= 1
-                    cmd = "single tie"
-                    response = "OutX InY All\r\n"
-                    continue
-
-                # detect status command
-                if not(wait) and (buf in "XINQS"):
-                    cmd = "info"
-                    response = "whatever\r\n"
-                    continue
-
-                # check for end-of-line
-                if buf[-1] != "\n":
-                    continue
-                
-                # handle multi-tie command
-                pos = buf.find("\x1b+Q")
-                if pos >= 0:
-                    cmd = "multi tie"
-                    response = "Qik\r\n"
-                    continue
-
-                # handle EDID upload command
-                edid = buf.find("EDID")
-                pos = buf.find("\x1bI")
-                if (pos >= 0) and (edid > pos):
-                    cmd = "EDID upload"
-                    response = "EdidI" + buf[pos+2 : edid] + "\r\n"
-                    bytes_left = 256
-                    while bytes_left > 0:
-                        bytes_left -= len(self.request.recv(bytes_left))
-                    continue
-
-                # handle EDID assign command
-                edid = buf.find("*EDID")
-                pos = buf.find("\x1bA")
-                if (pos >= 0) and (edid > pos):
-                    cmd = "EDID assign"
-                    response = "EdidA0*" + buf[pos+2 : edid] + "\r\n"
-                    continue
-
-                # handle ordinary end-of-line
-                if buf.strip():
-                    print("unrecognized command:", repr(buf))
-                else:
-                    print("whitespace:", repr(buf))
-                buf = ""
-
-        except EnvironmentError as e:
-            print("connect error:", e)
-
-class TCPServer(SocketServer.TCPServer):
-    allow_reuse_address = True
+            data = os.read(master, 4096)
+        except EnvironmentError:
+            return
+        for desc, reply in session.feed(data):
+            responder.put(desc, reply)
+    asyncio.get_running_loop().add_reader(master, readable)
+    print("serving {} on serial port {}".format(proto.upper(), os.ttyname(slave)))
+
+async def main(args):
+    matrix = Matrix(*args.size)
+    servers = []
+    for proto, port in (("sis", args.port), ("lw1", args.lw1_port)):
+        if port:
+            handler = lambda r, w, proto=proto: serve_client(r, w, matrix, proto, args)
+            servers.append(await asyncio.start_server(handler, args.host, port))
+            print("serving {} on {}:{}".format(proto.upper(), args.host, port))
+    for proto in args.pty:
+        serve_pty(matrix, proto, args)
+    if servers:
+        await asyncio.gather(*(s.serve_forever() for s in servers))
+    else:
+        await asyncio.Event().wait()  # pseudo-terminals only
+
+def matrix_size(s):
+    m = re.match(r'(\d+)x(\d+)$', s.lower())
+    if not m:
+        raise argparse.ArgumentTypeError("size must be given as <inputs>x<outputs>")
+    return int(m.group(1)), int(m.group(2))
 
 if __name__ == "__main__":
-    TCPServer(("localhost", 2323), ConnectionHandler).serve_forever()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-a", "--host", default="localhost",
+                        help="address to listen on (default: %(default)s)")
+    parser.add_argument("-p", "--port", metavar="N", type=int, default=2323,
+                        help="TCP port for the Extron SIS protocol, 0 = off (default: %(default)s)")
+    parser.add_argument("-w", "--lw1-port", metavar="N", type=int, default=0,
+                        help="TCP port for the Lightware LW1 protocol, 0 = off (default: %(default)s)")
+    parser.add_argument("-t", "--pty", metavar="PROTO", action='append', default=[], choices=sorted(Protocols),
+                        help="also serve this protocol (sis or lw1) on a pseudo-terminal; can be used multiple times")
+    parser.add_argument("-s", "--size", metavar="IxO", type=matrix_size, default=(8, 8),
+                        help="number of inputs and outputs (default: 8x8)")
+    parser.add_argument("-l", "--latency", metavar="MS", type=float, default=0.0,
+                        help="delay of every reply in milliseconds (default: %(default)s)")
+    parser.add_argument("-j", "--jitter", metavar="MS", type=float, default=0.0,
+                        help="random variation of the delay in milliseconds (default: %(default)s)")
+    parser.add_argument("-d", "--drop", metavar="FRACTION", type=float, default=0.0,
+                        help="probability of a reply being dropped, 0..1 (default: %(default)s)")
+    parser.add_argument("-r", "--seed", metavar="N", type=int,
+                        help="seed for the random number generator, for reproducible runs")
+    parser.add_argument("-q", "--quiet", action='store_true',
+                        help="don't log every command")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
+    except EnvironmentError as e:
+        print("error:", e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Latency and throughput benchmark for dvi_matrix_control.py. Starts a local
+extron_simulator.py with the given reply latency, jitter and drop rate,
+drives DVIMatrixController.handle_cmd with single ties, multi-ties and
+macro recalls, and reports time-to-acknowledgment percentiles, commands
+per second and reconnect counts. Each run is written to a JSON report, so
+that runs can be compared later (see --compare).
+
+NOTE: This script is just used for development.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import dvi_matrix_control as dmc
+
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "extron_simulator.py")
+WORKLOADS = ("single", "multi", "macro")
+PROTOCOL_IDS = {"sis": 2, "lw1": 1}
+SIMULATOR_STARTUP_TIMEOUT = 5.0
+MACRO_NAMES = "xy"
+PORT_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+class BenchmarkController(dmc.DVIMatrixController):
+    "a controller that collects all finished commands"
+    def __init__(self, *args, **kwargs):
+        dmc.DVIMatrixController.__init__(self, *args, **kwargs)
+        self.finished = []
+        self.finished_lock = threading.Lock()
+
+    def command_done(self, name, cmd):
+        dmc.DVIMatrixController.command_done(self, name, cmd)
+        with self.finished_lock:
+            self.finished.append(cmd)
+
+def tie(pin, pouts):
+    "format a keypad tie command; ports above 9 are written as letters"
+    return ''.join(PORT_DIGITS[p] for p in [pin] + list(pouts))
+
+def make_commands(kind, count, size, state, rng):
+    """
+    generate a list of keypad commands; every tie changes the (simulated)
+    tie state, so that no command is skipped as "already tied"
+    """
+    inputs, outputs = size
+    def other_input(pout):
+        return rng.choice([i for i in range(1, inputs + 1) if i != state.get(pout)])
+    commands = []
+    for n in range(count):
+        if kind == "single":
+            pout = rng.randint(1, outputs)
+            pin = other_input(pout)
+            state[pout] = pin
+            commands.append(tie(pin, [pout]))
+        elif kind == "multi":
+            ties = []
+            for pout in rng.sample(range(1, outputs + 1), rng.randint(2, min(4, outputs))):
+                pin = other_input(pout)
+                state[pout] = pin
+                ties.append(tie(pin, [pout]))
+            commands.append(','.join(ties))
+        else:
+            name = MACRO_NAMES[n % len(MACRO_NAMES)]
+            pin = 1 + MACRO_NAMES.index(name)
+            state.update((o, pin) for o in range(1, outputs + 1))
+            commands.append(name)
+    return commands
+
+def percentile(values, p):
+    "nearest-rank percentile of a sorted list"
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+def run_workload(ctl, kind, args, rng):
+    conn = ctl.conns[""]
+    size = args.size
+    if kind == "macro":
+        for pin, name in enumerate(MACRO_NAMES, 1):
+            ctl.handle_cmd("*{}*{}".format(name, tie(pin, range(1, size[1] + 1))), verbose=False)
+    commands = make_commands(kind, args.count, size, conn.expected_ties(), rng)
+    reconnects = conn.reconnects
+    with ctl.finished_lock:
+        ctl.finished = []
+    t0 = time.monotonic()
+    for n, cmd in enumerate(commands):
+        if args.interval:
+            delay = t0 + n * args.interval / 1000.0 - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        ctl.handle_cmd(cmd, verbose=False)
+        if args.closed_loop:
+            ctl.wait_idle()
+    ctl.wait_idle(dmc.MAX_CONNECT_TIMEOUT + args.count * dmc.MAX_COMMAND_TIMEOUT)
+    elapsed = time.monotonic() - t0
+    with ctl.finished_lock:
+        finished = list(ctl.finished)
+    acked = sorted((cmd.finished - cmd.submitted) * 1000.0 for cmd in finished if cmd.result)
+    return {
+        "commands": len(commands),
+        "acknowledged": len(acked),
+        "errors": sum(1 for cmd in finished if cmd.result is False),
+        "failed": len(commands) - len(finished) + sum(1 for cmd in finished if cmd.result is None),
+        "reconnects": conn.reconnects - reconnects,
+        "elapsed_s": round(elapsed, 4),
+        "commands_per_s": round(len(commands) / elapsed, 1) if elapsed else None,
+        "ack_ms": dict((key, round(percentile(acked, p), 2) if acked else None)
+                       for key, p in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))),
+    }
+
+def free_port():
+    s = socket.socket()
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_simulator(args, port):
+    cmdline = [sys.executable, SIMULATOR, "-q", "-s", "{}x{}".format(*args.size),
+               "-l", str(args.latency), "-j", str(args.jitter), "-d", str(args.drop)]
+    if args.seed is not None:
+        cmdline += ["-r", str(args.seed)]
+    cmdline += ["-p", str(port)] if (args.protocol == "sis") else ["-p", "0", "-w", str(port)]
+    sim = subprocess.Popen(cmdline, stdout=subprocess.DEVNULL)
+    t1 = time.monotonic() + SIMULATOR_STARTUP_TIMEOUT
+    while time.monotonic() < t1:
+        try:
+            socket.create_connection(("localhost", port), timeout=dmc.MAX_CONNECT_TIMEOUT).close()
+            return sim
+        except EnvironmentError:
+            time.sleep(0.05)
+    sim.kill()
+    raise EnvironmentError("simulator didn't start")
+
+def print_results(results, reference=None):
+    print("{:<8} {:>6} {:>6} {:>6} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+          "workload", "cmds", "acked", "failed", "reconn", "cmd/s", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for kind in WORKLOADS:
+        r = results.get(kind)
+        if not r:
+            continue
+        row = [r["commands_per_s"]] + [r["ack_ms"][k] for k in ("p50", "p90", "p99", "max")]
+        print("{:<8} {:>6} {:>6} {:>6} {:>6} ".format(kind, r["commands"], r["acknowledged"], r["failed"], r["reconnects"])
+              + ' '.join("{:>8}".format("-" if v is None else v) for v in row))
+        ref = (reference or {}).get(kind)
+        if ref:
+            ref_row = [ref["commands_per_s"]] + [ref["ack_ms"][k] for k in ("p50", "p90", "p99", "max")]
+            print("{:<36}".format("  vs. reference") + ' '.join(
+                  "{:>8}".format("-" if (v is None or rv is None) else "{:+.1f}".format(v - rv))
+                  for v, rv in zip(row, ref_row)))
+
+def size_arg(s):
+    try:
+        inputs, outputs = map(int, s.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("size must be given as <inputs>x<outputs>")
+    if not(2 <= inputs <= 35) or not(1 <= outputs <= 35):
+        raise argparse.ArgumentTypeError("size must be between 2x1 and 35x35")
+    return inputs, outputs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-w", "--workload", action='append', choices=WORKLOADS,
+                        help="workload to run; can be used multiple times (default: all)")
+    parser.add_argument("-n", "--count", metavar="N", type=int, default=200,
+                        help="number of commands per workload (default: %(default)s)")
+    parser.add_argument("-i", "--interval", metavar="MS", type=float, default=0.0,
+                        help="time between commands in milliseconds, 0 = as fast as possible (default: %(default)s)")
+    parser.add_argument("-c", "--closed-loop", action='store_true',
+                        help="wait for each command to be acknowledged before sending the next one")
+    parser.add_argument("-P", "--protocol", choices=sorted(PROTOCOL_IDS), default="sis",
+                        help="protocol to benchmark (default: %(default)s)")
+    parser.add_argument("-s", "--size", metavar="IxO", type=size_arg, default=(8, 8),
+                        help="matrix size (default: 8x8)")
+    parser.add_argument("-l", "--latency", metavar="MS", type=float, default=5.0,
+                        help="simulated reply latency in milliseconds (default: %(default)s)")
+    parser.add_argument("-j", "--jitter", metavar="MS", type=float, default=1.0,
+                        help="simulated reply jitter in milliseconds (default: %(default)s)")
+    parser.add_argument("-d", "--drop", metavar="FRACTION", type=float, default=0.0,
+                        help="simulated reply drop rate, 0..1 (default: %(default)s)")
+    parser.add_argument("-p", "--pipeline", metavar="N", type=int, default=dmc.DEFAULT_PIPELINE_DEPTH,
+                        help="controller pipeline depth (default: %(default)s)")
+    parser.add_argument("-r", "--seed", metavar="N", type=int, default=1,
+                        help="random seed for workloads and simulator (default: %(default)s)")
+    parser.add_argument("-o", "--output", metavar="DIR", default=".",
+                        help="directory for the JSON report (default: current directory)")
+    parser.add_argument("--compare", metavar="REPORT",
+                        help="print the differences to a previous JSON report")
+    args = parser.parse_args()
+    reference = None
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)["results"]
+
+    rng = random.Random(args.seed)
+    port = free_port()
+    sim = start_simulator(args, port)
+    tmpdir = tempfile.mkdtemp()
+    ctl = None
+    try:
+        ctl = BenchmarkController(os.path.join(tmpdir, "benchmark.conf"),
+                                 pipeline_depth=max(1, args.pipeline), keepalive_interval=0)
+        ctl.handle_cmd("//{}.127.0.0.1.{}".format(PROTOCOL_IDS[args.protocol], port))
+        conn = ctl.conns[""]
+        if not conn.conn:
+            sys.exit(1)
+        t1 = time.monotonic() + dmc.MAX_CONNECT_TIMEOUT
+        while (len(conn.proto.ties) < args.size[1]) and (time.monotonic() < t1):
+            time.sleep(0.01)  # the tie state is queried asynchronously after connecting
+        results = {}
+        for kind in args.workload or WORKLOADS:
+            results[kind] = run_workload(ctl, kind, args, rng)
+    finally:
+        for conn in (list(ctl.conns.values()) if ctl else []):
+            conn.close()
+        sim.kill()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    now = datetime.datetime.now()
+    report = {
+        "timestamp": now.isoformat(timespec='seconds'),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "settings": {
+            "protocol": args.protocol, "size": "{}x{}".format(*args.size),
+            "latency_ms": args.latency, "jitter_ms": args.jitter, "drop": args.drop,
+            "pipeline": args.pipeline, "interval_ms": args.interval, "closed_loop": args.closed_loop,
+            "count": args.count, "seed": args.seed,
+        },
+        "results": results,
+    }
+    print()
+    print_results(results, reference)
+    os.makedirs(args.output, exist_ok=True)
+    filename = os.path.join(args.output, now.strftime("benchmark-%Y%m%d-%H%M%S.json"))
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("\nreport written to", filename)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Replay a session recorded with dvi_matrix_control.py --log against local
+extron_simulator.py instances (one per device), at the original speed or
+faster. Reports the acknowledgment times of the replay next to the recorded
+ones, how far the replay fell behind the recorded timing, and whether the
+outputs switched in the session end up in the same state as recorded.
+The exit status is 1 if they don't.
+
+NOTE: This script is just used for development.
+"""
+import argparse
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import dvi_matrix_control as dmc
+import matrix_benchmark as mb
+
+PROTOCOL_NAMES = dict((v, k) for k, v in mb.PROTOCOL_IDS.items())
+
+def read_sessions(filename):
+    "split an event log into sessions, each starting with a 'start' event"
+    sessions = []
+    with open(filename) as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                print("warning: ignoring malformed line {} of {}".format(lineno, filename), file=sys.stderr)
+                continue
+            if (event.get("event") == "start") or not sessions:
+                sessions.append([])
+            sessions[-1].append(event)
+    return sessions
+
+def recorded_devices(session):
+    "return {device: protocol name} for the (main) connections opened in a session"
+    devices = {}
+    for event in session:
+        if (event["event"] == "open") and not(event["device"] in devices):
+            proto = PROTOCOL_NAMES.get(event["params"][0])
+            if proto:
+                devices[event["device"]] = proto
+    return devices
+
+def recorded_results(session):
+    """
+    return the round-trip times (in ms) of the acknowledged tie frames, the
+    final tie state {device: {output: input}} and the outputs switched in
+    the session {device: set(outputs)}
+    """
+    tie_frames = set()
+    rtts = []
+    state = {}
+    switched = {}
+    for event in session:
+        kind = event["event"]
+        if kind == "frame" and event["ties"]:
+            tie_frames.add((event["device"], event.get("standby", False), event["seq"]))
+        elif kind == "ack" and event["result"] and \
+             ((event["device"], event.get("standby", False), event["seq"]) in tie_frames):
+            rtts.append(event["rtt_ms"])
+        elif kind == "tie":
+            state.setdefault(event["device"], {})[event["output"]] = event["input"]
+        elif kind == "submit":
+            outputs = switched.setdefault(event["device"], set())
+            outputs.update(o for i, o in event["ties"])
+            outputs.update(event["skipped"])
+    return sorted(rtts), state, switched
+
+def percentiles(values):
+    return [mb.percentile(values, p) for p in (50, 90, 99, 100)]
+
+def print_row(label, count, values):
+    print("{:<10} {:>6} ".format(label, count) + ' '.join(
+          "{:>8}".format("-" if v is None else "{:.2f}".format(v)) for v in values))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", metavar="LOGFILE",
+                        help="event log written by dvi_matrix_control.py --log")
+    parser.add_argument("-S", "--session", metavar="N", type=int, default=-1,
+                        help="session to replay, counting from 1; negative numbers count from the end (default: last)")
+    parser.add_argument("-x", "--speed", metavar="FACTOR", type=float, default=1.0,
+                        help="replay speed, e.g. 10 = ten times faster, 0 = as fast as possible (default: %(default)s)")
+    parser.add_argument("-s", "--size", metavar="IxO", type=mb.size_arg, default=(8, 8),
+                        help="matrix size of the simulators (default: 8x8)")
+    parser.add_argument("-l", "--latency", metavar="MS", type=float, default=5.0,
+                        help="simulated reply latency in milliseconds (default: %(default)s)")
+    parser.add_argument("-j", "--jitter", metavar="MS", type=float, default=1.0,
+                        help="simulated reply jitter in milliseconds (default: %(default)s)")
+    parser.add_argument("-d", "--drop", metavar="FRACTION", type=float, default=0.0,
+                        help="simulated reply drop rate, 0..1 (default: %(default)s)")
+    parser.add_argument("-r", "--seed", metavar="N", type=int, default=1,
+                        help="random seed for the simulators (default: %(default)s)")
+    parser.add_argument("-p", "--pipeline", metavar="N", type=int, default=dmc.DEFAULT_PIPELINE_DEPTH,
+                        help="controller pipeline depth (default: %(default)s)")
+    args = parser.parse_args()
+
+    sessions = read_sessions(args.log)
+    try:
+        session = sessions[args.session - 1 if args.session > 0 else args.session]
+    except IndexError:
+        parser.error("the log contains {} session(s)".format(len(sessions)))
+    devices = recorded_devices(session)
+    commands = [e for e in session if e["event"] == "command"]
+    if not devices or not commands:
+        print("nothing to replay: the session has no connections or no commands", file=sys.stderr)
+        sys.exit(1)
+    config = next((e["config"] for e in session if e["event"] == "start"), [])
+
+    sims = []
+    tmpdir = tempfile.mkdtemp()
+    ctl = None
+    try:
+        ctl = mb.BenchmarkController(os.path.join(tmpdir, "replay.conf"),
+                                    pipeline_depth=max(1, args.pipeline), keepalive_interval=0)
+        for name, proto in sorted(devices.items()):
+            sim_args = copy.copy(args)
+            sim_args.protocol = proto
+            port = mb.free_port()
+            sims.append(mb.start_simulator(sim_args, port))
+            ctl.handle_cmd("/{}/{}.127.0.0.1.{}".format(name, mb.PROTOCOL_IDS[proto], port))
+            conn = ctl.conns.get(name)
+            if not(conn and conn.conn):
+                sys.exit(1)
+            t1 = time.monotonic() + dmc.MAX_CONNECT_TIMEOUT
+            while (len(conn.proto.ties) < args.size[1]) and (time.monotonic() < t1):
+                time.sleep(0.01)  # the tie state is queried asynchronously after connecting
+        for line in config:
+            if line.startswith('*'):
+                ctl.handle_cmd(line, verbose=False)
+
+        print("replaying {} command(s) on {} device(s) at {}".format(
+              len(commands), len(devices), "{:g}x speed".format(args.speed) if args.speed else "full speed"))
+        skipped = 0
+        behind = []
+        m0 = commands[0]["mono"]
+        t0 = time.monotonic()
+        for event in commands:
+            cmd = event["cmd"]
+            if cmd.startswith('/'):
+                skipped += 1  # connect commands would go to the real devices
+                continue
+            if args.speed:
+                target = t0 + (event["mono"] - m0) / args.speed
+                delay = target - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                behind.append(max(0.0, time.monotonic() - target) * 1000.0)
+            ctl.handle_cmd(cmd, verbose=False)
+        ctl.wait_idle(dmc.MAX_CONNECT_TIMEOUT + len(commands) * dmc.MAX_COMMAND_TIMEOUT)
+        elapsed = time.monotonic() - t0
+        replay_state = ctl.tie_state()
+        with ctl.finished_lock:
+            finished = list(ctl.finished)  # closing the connections fails the unfinished commands
+    finally:
+        for conn in (list(ctl.conns.values()) if ctl else []):
+            conn.close()
+        for sim in sims:
+            sim.kill()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    recorded_rtts, recorded_state, switched = recorded_results(session)
+    replay_rtts = sorted(cmd.rtt * 1000.0 for cmd in finished if cmd.result)
+    failed = sum(1 for cmd in finished if not cmd.result)
+    print()
+    print("{:<10} {:>6} {:>8} {:>8} {:>8} {:>8}".format("round trip", "acked", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    print_row("recorded", len(recorded_rtts), percentiles(recorded_rtts))
+    print_row("replay", len(replay_rtts), percentiles(replay_rtts))
+    print()
+    print("replay took {:.3f} s ({} command(s) failed, {} connect command(s) skipped)".format(elapsed, failed, skipped))
+    if behind:
+        behind.sort()
+        print("behind recorded timing: p50 {:.2f} ms, max {:.2f} ms".format(mb.percentile(behind, 50), behind[-1]))
+
+    mismatches = []
+    for name in sorted(switched):
+        for pout in sorted(switched[name]):
+            expected = recorded_state.get(name, {}).get(pout)
+            actual = replay_state.get(name, {}).get(pout)
+            if expected != actual:
+                mismatches.append("{} output {}: recorded input {}, replay input {}".format(
+                                  dmc.device_label(name), pout, expected, actual))
+    if mismatches:
+        print("tie state differs from the recording:")
+        for line in mismatches:
+            print("  " + line)
+        sys.exit(1)
+    print("tie state of {} switched output(s) matches the recording".format(sum(map(len, switched.values()))))
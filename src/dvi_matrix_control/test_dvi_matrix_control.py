@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+"""
+Tests for dvi_matrix_control.py, against a local extron_simulator.py;
+run with: python3 -m unittest
+"""
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import dvi_matrix_control as dmc
+import edid
+import extron_set_edid
+import extron_simulator
+import test_edid
+try:
+    import serial
+except ImportError:
+    serial = None
+
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "extron_simulator.py")
+TIMEOUT = 5.0
+OUTPUTS = 8
+
+def free_port():
+    s = socket.socket()
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_until(condition, timeout=TIMEOUT):
+    "poll a condition until it's true; returns False if it didn't become true in time"
+    t1 = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > t1:
+            return False
+        time.sleep(0.01)
+    return True
+
+class Proxy(object):
+    """
+    Forwards connections from a local port to another one, so that tests
+    can make a connection fail: cut() closes all connections and stops
+    listening, stall() stops forwarding replies but keeps the connections.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.listener = socket.socket()
+        self.listener.bind(("localhost", 0))
+        self.listener.listen(5)
+        self.address = self.listener.getsockname()
+        self.sockets = []
+        self.stalled = False
+        self.start(self.accept)
+
+    @staticmethod
+    def start(target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except EnvironmentError:
+                return
+            server = socket.create_connection(("localhost", self.port))
+            self.sockets += [client, server]
+            self.start(self.forward, client, server, False)
+            self.start(self.forward, server, client, True)
+
+    def forward(self, src, dst, replies):
+        while True:
+            try:
+                data = src.recv(4096)
+                if not data:
+                    break
+                if not(replies and self.stalled):
+                    dst.sendall(data)
+            except EnvironmentError:
+                break
+        self.close(dst)
+
+    @staticmethod
+    def close(s):
+        try:
+            s.shutdown(socket.SHUT_RDWR)
+        except EnvironmentError:
+            pass
+        s.close()
+
+    def stall(self):
+        self.stalled = True
+
+    def cut(self):
+        for s in [self.listener] + self.sockets:
+            self.close(s)
+
+class SimulatorTestCase(unittest.TestCase):
+    """
+    Runs a simulator with Extron SIS on self.port and Lightware LW1 on
+    self.lw1_port (both operating on the same matrix), plus the
+    pseudo-terminals in self.ptys if requested with "-t", and a controller
+    whose configuration file is in a temporary directory.
+    """
+    simulator_args = []
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.port, self.lw1_port = free_port(), free_port()
+        self.sim = subprocess.Popen([sys.executable, "-u", SIMULATOR, "-q", "-p", str(self.port), "-w", str(self.lw1_port)]
+                                    + self.simulator_args, stdout=subprocess.PIPE, universal_newlines=True)
+        # the simulator announces each port once it's ready
+        self.ptys = []
+        for n in range(2 + self.simulator_args.count("-t")):
+            line = self.sim.stdout.readline()
+            if not line:
+                self.sim.wait()
+                raise EnvironmentError("simulator didn't start")
+            m = re.search(r'serial port (\S+)', line)
+            if m:
+                self.ptys.append(m.group(1))
+        self.controllers = []
+        self.ctl = self.controller()
+
+    def tearDown(self):
+        for ctl in self.controllers:
+            for conn in list(ctl.conns.values()) + list(ctl.standby.values()):
+                conn.close()
+        self.sim.kill()
+        self.sim.wait()
+        self.sim.stdout.close()
+        shutil.rmtree(self.tmpdir)
+
+    def controller(self, **kwargs):
+        kwargs.setdefault("keepalive_interval", 0)
+        ctl = dmc.DVIMatrixController(os.path.join(self.tmpdir, "test.conf"), **kwargs)
+        self.controllers.append(ctl)
+        return ctl
+
+    def connect(self, ctl=None, name="", proto=2):
+        "connect a controller to the simulator, and wait for the initial tie state"
+        ctl = ctl or self.ctl
+        ctl.handle_cmd("/{}/{}.127.0.0.1.{}".format(name, proto, self.port if (proto == 2) else self.lw1_port),
+                       verbose=False)
+        conn = ctl.conns[name]
+        self.assertTrue(wait_until(lambda: len(conn.proto.ties) == OUTPUTS), "no initial tie state")
+        return conn
+
+    def simulator_ties(self):
+        "query the actual tie state of the simulator over a separate LW1 connection; returns {output: input}"
+        s = socket.create_connection(("localhost", self.lw1_port), timeout=0.5)
+        try:
+            data = b""
+            while not data.endswith(b"\n"):
+                s.sendall(b"{VC}\r\n")
+                try:
+                    while not data.endswith(b"\n"):
+                        chunk = s.recv(4096)
+                        if not chunk:
+                            raise EnvironmentError("simulator closed the connection")
+                        data += chunk
+                except socket.timeout:
+                    pass  # the reply was dropped
+        finally:
+            s.close()
+        return dict(enumerate(map(int, data.strip()[5:-1].split()), 1))
+
+    def switch(self, cmd, ctl=None):
+        "run a command and wait until it has been acknowledged"
+        ctl = ctl or self.ctl
+        ctl.handle_cmd(cmd, verbose=False)
+        self.assertTrue(ctl.wait_idle(TIMEOUT), "command {!r} not finished".format(cmd))
+
+class MacroTest(SimulatorTestCase):
+    def test_nested_macros(self):
+        self.connect()
+        self.switch("*1*23,45")
+        self.switch("*2*1,36,74")
+        self.switch("2")
+        ties = self.simulator_ties()
+        self.assertEqual([ties[o] for o in (3, 5, 6, 4)], [2, 4, 3, 7])
+        self.assertEqual(self.ctl.conns[""].proto.ties, ties)
+
+    def test_recursive_macros_are_rejected(self):
+        self.connect()
+        self.switch("*1*23")
+        self.switch("*2*1,45")
+        self.switch("*3*2")
+        for cmd in ("*1*1", "*1*3,67", "*2*3"):
+            self.ctl.handle_cmd(cmd, verbose=False)
+        # the macros keep their previous values, and the rejected ones aren't saved
+        self.assertEqual(self.ctl.macros, {"1": ["23"], "2": ["1", "45"], "3": ["2"]})
+        self.assertEqual(sorted(self.ctl.compiled["3"].ties[""]), [(2, 3), (4, 5)])
+        with open(self.ctl.configfile) as f:
+            self.assertEqual(f.read().split()[1:], ["*1*23", "*2*1,45", "*3*2"])
+        # a recursion through a macro that doesn't exist yet is caught when it's stored
+        self.switch("*4*5")
+        self.ctl.handle_cmd("*5*4", verbose=False)
+        self.assertFalse("5" in self.ctl.macros)
+
+class CueTest(SimulatorTestCase):
+    def test_steps_and_stop(self):
+        self.connect()
+        self.switch("12")
+        self.switch("*9*34-100-56-3000-72")
+        t0 = time.monotonic()
+        self.ctl.handle_cmd("9", verbose=False)
+        self.assertTrue(wait_until(lambda: self.simulator_ties()[6] == 5))
+        self.assertGreaterEqual(time.monotonic() - t0, 0.1)
+        self.assertEqual(self.simulator_ties()[4], 3)
+        # stopping doesn't wait for the next step
+        t0 = time.monotonic()
+        self.ctl.handle_cmd("--", verbose=False)
+        self.assertLess(time.monotonic() - t0, 0.1)
+        self.assertFalse(self.ctl.cue_runner)
+        self.assertEqual(self.simulator_ties()[2], 1)
+
+class ControlServerTest(SimulatorTestCase):
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.connect()
+        self.ctl.start_command_queue()
+        self.server = dmc.ControlServer(self.ctl, ("localhost", 0))
+        self.host = "localhost:{}".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        SimulatorTestCase.tearDown(self)
+
+    def request(self, data):
+        "send raw data to the server; returns everything it sends back until it closes the connection"
+        s = socket.create_connection(self.server.server_address, timeout=TIMEOUT)
+        try:
+            s.sendall(data)
+            s.shutdown(socket.SHUT_WR)
+            reply = b""
+            while True:
+                chunk = s.recv(4096)
+                if not chunk:
+                    return reply
+                reply += chunk
+        finally:
+            s.close()
+
+    def http(self, method, path, body=b"", headers=()):
+        "returns (status, JSON body)"
+        head = ["{} {} HTTP/1.1".format(method, path), "Host: " + self.host]
+        head += list(headers)
+        if not any(h.lower().startswith("content-length:") for h in headers):
+            head.append("Content-Length: {}".format(len(body)))
+        reply = self.request(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+        status, _, body = reply.partition(b"\r\n\r\n")
+        return int(status.split()[1]), json.loads(body.decode())
+
+    def test_state_and_commands(self):
+        self.assertEqual(self.http("GET", "/state"), (200, {"devices": {"": dict((str(o), 1) for o in range(1, OUTPUTS + 1))}}))
+        self.assertEqual(self.http("POST", "/cmd", b'{"cmd": "23"}'), (200, {"ok": True, "cmd": "23"}))
+        self.assertEqual(self.http("POST", "/cmd", b'{"cmd": "456"}', ["Origin: http://" + self.host]),
+                         (200, {"ok": True, "cmd": "456"}))
+        self.assertTrue(self.ctl.wait_idle(TIMEOUT))
+        self.assertEqual([self.simulator_ties()[o] for o in (3, 5, 6)], [2, 4, 4])
+        self.assertEqual(self.request(b"71\r\n!\r\n"), b"OK\r\nERR invalid command\r\n")
+
+    def test_invalid_requests(self):
+        # only POST requests may change anything
+        self.assertEqual(self.http("GET", "/cmd?cmd=23")[0], 405)
+        # browsers may only send commands from pages served by the server itself
+        self.assertEqual(self.http("POST", "/cmd", b'{"cmd": "23"}', ["Origin: http://example.com"])[0], 403)
+        self.assertEqual(self.http("GET", "/ws", headers=["Origin: http://example.com", "Upgrade: websocket",
+                                                          "Connection: Upgrade", "Sec-WebSocket-Key: dGVzdA=="])[0], 403)
+        # malformed requests
+        self.assertEqual(self.http("POST", "/cmd", b'{"cmd": "23"}', ["Content-Length: abc"])[0], 400)
+        self.assertEqual(self.http("POST", "/cmd", b'{"cmd": "23"}', ["Content-Length: -5"])[0], 400)
+        self.assertEqual(self.http("POST", "/cmd", b'{}')[0], 400)
+        self.assertEqual(self.http("POST", "/cmd", b'{"cmd": "*x"}')[0], 400)
+        self.assertEqual(self.http("GET", "/nothing")[0], 404)
+        self.assertTrue(self.ctl.wait_idle(TIMEOUT))
+        self.assertEqual(self.simulator_ties()[3], 1)
+
+class PipelineTest(SimulatorTestCase):
+    simulator_args = ["-l", "20"]
+
+    def test_commands_are_coalesced(self):
+        for proto in (2, 1):
+            conn = self.connect(proto=proto)
+            rng = random.Random(proto)
+            ties = [(rng.randint(1, 8), rng.randint(1, OUTPUTS)) for n in range(30)]
+            t0 = time.monotonic()
+            commands = [cmd for tie in ties for cmd in self.ctl.switch({"": [tie]}, force=True, verbose=False)]
+            self.assertTrue(self.ctl.wait_idle(TIMEOUT))
+            # sent one by one, they would take 30 round trips of 20 ms
+            self.assertLess(time.monotonic() - t0, 0.3)
+            self.assertLess(conn.frame_seq, len(ties) // 2)
+            self.assertEqual([cmd.result for cmd in commands], [True] * len(ties))
+            # later ties to an output supersede earlier ones
+            last = dict((o, i) for i, o in ties)
+            actual = self.simulator_ties()
+            self.assertEqual(dict((o, actual[o]) for o in last), last)
+            self.assertEqual(conn.proto.ties, actual)
+
+class LostReplyTest(SimulatorTestCase):
+    simulator_args = ["-l", "2", "-d", "0.2", "-r", "1"]
+
+    def test_lost_replies(self):
+        for proto in (2, 1):
+            self.ctl.handle_cmd("//{}.127.0.0.1.{}".format(proto, self.port if (proto == 2) else self.lw1_port), verbose=False)
+            conn = self.ctl.conns[""]
+            rng = random.Random(proto)
+            commands = []
+            for n in range(50):
+                ties = [(rng.randint(1, 8), o) for o in rng.sample(range(1, OUTPUTS + 1), rng.randint(1, 3))]
+                commands += self.ctl.switch({"": ties}, force=True, verbose=False)
+                time.sleep(0.005)
+            self.assertTrue(self.ctl.wait_idle(TIMEOUT))
+            # commands whose replies were lost are verified by querying the tie
+            # state (with matching in FIFO order, most of them would fail)
+            self.assertGreaterEqual([cmd.result for cmd in commands].count(True), len(commands) * 0.9)
+            # the tracked tie state may have gaps, but it's never wrong
+            actual = self.simulator_ties()
+            self.assertEqual(dict((o, actual[o]) for o in conn.proto.ties), conn.proto.ties)
+            self.assertGreaterEqual(len(conn.proto.ties), OUTPUTS // 2)
+
+class StandbyTest(SimulatorTestCase):
+    def failover(self, fail, **kwargs):
+        "connect to SIS through a proxy, with a standby connection to LW1, and make the SIS connection fail"
+        ctl = self.controller(**kwargs)
+        proxy = Proxy(self.port)
+        ctl.handle_cmd("//2.127.0.0.1.{}/1.127.0.0.1.{}".format(proxy.address[1], self.lw1_port), verbose=False)
+        main, standby = ctl.conns[""], ctl.standby[""]
+        self.assertTrue(wait_until(lambda: len(main.proto.ties) == OUTPUTS))
+        self.switch("12", ctl)
+        self.assertEqual(self.simulator_ties()[2], 1)
+        fail(proxy)
+        ctl.handle_cmd("34", verbose=False)
+        self.assertTrue(wait_until(lambda: ctl.conns[""] is standby), "no failover")
+        self.assertTrue(ctl.wait_idle(TIMEOUT))
+        # the pending command was handed over to the standby connection
+        self.assertEqual(self.simulator_ties()[4], 3)
+        self.switch("56", ctl)
+        self.assertEqual(self.simulator_ties()[6], 5)
+        self.assertIs(ctl.standby[""], main)
+        self.assertFalse(main.healthy)
+        proxy.cut()
+
+    def test_connection_lost(self):
+        self.failover(Proxy.cut)
+
+    def test_no_reaction(self):
+        self.failover(Proxy.stall, keepalive_interval=0.05)
+
+@unittest.skipUnless(serial and (os.name == 'posix'), "needs PySerial and pseudo-terminals")
+class SerialTest(SimulatorTestCase):
+    simulator_args = ["-t", "sis"]
+
+    def test_disconnect(self):
+        errors = []
+        excepthook, threading.excepthook = threading.excepthook, lambda args: errors.append(args.exc_value)
+        try:
+            conn = dmc.SerialConnection(2, self.ptys[0])
+            for pin in (3, 5):
+                self.assertTrue(conn.connect())
+                conn.start()
+                cmd = conn.submit([(pin, 4)], conn.proto.encode([(pin, 4)]))
+                self.assertTrue(cmd.done.wait(TIMEOUT))
+                self.assertTrue(cmd.result)
+                self.assertEqual(self.simulator_ties()[4], pin)
+                receiver = conn.receiver
+                conn.disconnect()
+                # the receiver thread has ended without an exception, and the link is down
+                self.assertFalse(receiver.is_alive())
+                self.assertFalse(conn.link_up)
+                self.assertEqual(errors, [])
+            conn.close()
+        finally:
+            threading.excepthook = excepthook
+
+class EDIDDeployTest(SimulatorTestCase):
+    def test_padded_edid(self):
+        # a 128-byte EDID padded to the 256 bytes that the switch expects
+        filename = os.path.join(self.tmpdir, "padded.bin")
+        with open(filename, "wb") as f:
+            f.write(test_edid.make_edid() + b"\xff" * edid.BLOCK_SIZE)
+        data = extron_set_edid.load_edid(filename)
+        cache = edid.SlotCache(os.path.join(self.tmpdir, "cache.json"))
+        assignments = [([1, 2], None, data), ([0], None, data)]
+        result = extron_set_edid.deploy("localhost", self.port, assignments, timeout=TIMEOUT, cache=cache)
+        self.assertEqual((result["uploads"], result["skipped"], result["assignments"]), (1, 0, 3))
+        slot = extron_set_edid.USER_SLOT_BEGIN
+        self.assertEqual(cache.timings("localhost:{}".format(self.port)), {slot: edid.Timing(1920, 1080, 60, False)})
+        # the cache knows that the slot already holds the EDID
+        result = extron_set_edid.deploy("localhost", self.port, assignments, timeout=TIMEOUT, cache=cache)
+        self.assertEqual((result["uploads"], result["skipped"], result["assignments"]), (0, 1, 3))
+        with self.assertRaises(edid.EDIDError):
+            with open(filename, "wb") as f:
+                f.write(test_edid.make_edid(1)[:edid.BLOCK_SIZE] + b"\xff" * edid.BLOCK_SIZE)
+            extron_set_edid.load_edid(filename)
+
+class JournalTest(SimulatorTestCase):
+    def config(self, ctl):
+        return (ctl.connection_config, ctl.macros, ctl.cues, ctl.preset_links)
+
+    def reload(self):
+        ctl = self.controller()
+        ctl.load_config()
+        return ctl
+
+    def test_reload(self):
+        self.connect()
+        for cmd in ("*1*23", "*2*1,45", "*9*34-100-56", "**2*5", "*1*27"):
+            self.switch(cmd)
+        ctl = self.reload()
+        self.assertEqual(self.config(ctl), self.config(self.ctl))
+        self.assertEqual(ctl.macros["1"], ["27"])
+        self.assertTrue(os.path.exists(ctl.snapshot_file))
+        # loading doesn't connect, connect_all does
+        self.assertEqual(ctl.conns, {})
+        ctl.connect_all()
+        self.assertTrue(wait_until(lambda: len(ctl.conns[""].proto.ties) == OUTPUTS))
+        self.switch("2", ctl)
+        ties = self.simulator_ties()
+        self.assertEqual((ties[7], ties[5]), (2, 4))
+
+    def test_compaction_and_snapshot(self):
+        self.connect()
+        for n in range(dmc.JOURNAL_COMPACT_MIN):
+            self.switch("*1*{}{}".format(n % 8 + 1, n % 7 + 1))
+        # compacted into the connection and the macro, with a snapshot of the result
+        with open(self.ctl.configfile) as f:
+            self.assertEqual(len(f.read().splitlines()), 2)
+        with open(self.ctl.snapshot_file) as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot["macros"], self.ctl.macros)
+        # lines appended after the snapshot are applied to it
+        self.switch("*2*81")
+        with open(self.ctl.snapshot_file, "w") as f:
+            snapshot["macros"]["3"] = ["12"]  # only in the snapshot
+            json.dump(snapshot, f)
+        ctl = self.reload()
+        self.assertEqual(ctl.macros, dict(self.ctl.macros, **{"3": ["12"]}))
+        # if the beginning of the file doesn't match the snapshot, the whole file is applied
+        with open(self.ctl.configfile) as f:
+            lines = f.read().splitlines()
+        with open(self.ctl.configfile, "w") as f:
+            f.write("\n".join(lines[:1] + ["*1*88"] + lines[2:]) + "\n")
+        ctl = self.reload()
+        self.assertEqual(ctl.macros, {"1": ["88"], "2": ["81"]})
+        self.assertEqual(ctl.connection_config, self.ctl.connection_config)
+
+class PresetTest(SimulatorTestCase):
+    class EventRecorder(object):
+        "stands in for an EventLog"
+        def __init__(self):
+            self.events = []
+
+        def log(self, event, fields):
+            if event in ("submit", "preset_save"):
+                self.events.append((event, fields.get("preset")))
+
+    def recall(self, name):
+        "recall a macro; returns the submit and preset_save events, with the preset used"
+        self.ctl.event_log = recorder = self.EventRecorder()
+        self.switch(name)
+        self.ctl.event_log = None
+        return recorder.events
+
+    def test_stale_preset(self):
+        self.connect()
+        self.switch("*1*34,56")
+        self.switch("**1*5")
+        # the first recall sends the ties, and saves them as the preset
+        self.assertEqual(self.recall("1"), [("submit", None), ("preset_save", 5)])
+        self.assertTrue(("", 5) in self.ctl.preset_state)
+        # as long as no other output has been switched, the preset is used
+        self.switch("74")
+        self.assertEqual(self.recall("1"), [("submit", 5)])
+        ties = self.simulator_ties()
+        self.assertEqual((ties[4], ties[6]), (3, 5))
+        # recalling the preset would switch output 8 back, so the ties are sent instead
+        self.switch("74")
+        self.switch("28")
+        self.assertEqual(self.recall("1"), [("submit", None), ("preset_save", 5)])
+        ties = self.simulator_ties()
+        self.assertEqual((ties[4], ties[6], ties[8]), (3, 5, 2))
+        self.switch("74")
+        self.assertEqual(self.recall("1"), [("submit", 5)])
+        self.assertEqual(self.simulator_ties()[8], 2)
+        # a preset saved for the previous value of the macro isn't used either
+        self.switch("*1*34,57")
+        self.assertEqual(self.recall("1"), [("submit", None), ("preset_save", 5)])
+        ties = self.simulator_ties()
+        self.assertEqual((ties[4], ties[6], ties[7], ties[8]), (3, 5, 5, 2))
+        self.assertEqual(self.ctl.conns[""].proto.ties, ties)
+
+class SimulatorSessionTest(unittest.TestCase):
+    def test_protocols(self):
+        matrix = extron_simulator.Matrix(8, 8)
+        with self.assertRaises(TypeError):
+            extron_simulator.Session(matrix)  # abstract
+        sis = extron_simulator.SISSession(matrix)
+        self.assertEqual(sis.feed(b"3*4!"), [("single tie 3*4", b"Out04 In03 All")])
+        self.assertEqual([reply for desc, reply in sis.feed(b"4!9*1!1*9!x\x1bZ\r\n1*")], [b"03", b"E01", b"E12", b"E10", b"E10"])
+        self.assertEqual(sis.feed(b"2!"), [("single tie 1*2", b"Out02 In01 All")])
+        lw1 = extron_simulator.LW1Session(matrix)
+        self.assertEqual([reply for desc, reply in lw1.feed(b"{2@5}{9@1}{xyz}{VC")], [b"(O05 I02)", b"(ERR01)", b"(ERR04)"])
+        self.assertEqual(lw1.feed(b"}"), [("tie query", b"(ALL 01 01 01 03 02 01 01 01)")])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Tests for edid.py; run with: python -m unittest
+"""
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+import edid
+
+# detailed timing descriptors: 1920x1080 at 148.5 MHz (60 Hz), 1280x720 at 74.25 MHz (60 Hz)
+TIMING_1080P60 = bytearray([0x02, 0x3A, 0x80, 0x18, 0x71, 0x38, 0x2D, 0x40, 0x58, 0x2C, 0x45, 0x00, 0x40, 0x84, 0x63, 0x00, 0x00, 0x1E])
+TIMING_720P60 = bytearray([0x01, 0x1D, 0x00, 0x72, 0x51, 0xD0, 0x1E, 0x20, 0x6E, 0x28, 0x55, 0x00, 0x40, 0x84, 0x63, 0x00, 0x00, 0x1E])
+
+def checksum(block):
+    block[-1] = (-sum(block[:-1])) & 0xFF
+    return block
+
+def make_edid(extensions=0, name=b"TEST"):
+    "a minimal EDID with a 1080p60 preferred mode and a name, followed by CEA extension blocks with a 720p60 mode"
+    base = bytearray(edid.BLOCK_SIZE)
+    base[0:8] = edid.HEADER
+    base[8:10] = bytearray([0x10, 0xAC])  # "DEL"
+    base[10:12] = bytearray([0x34, 0x12])
+    base[18:20] = bytearray([1, 3])
+    base[54:72] = TIMING_1080P60
+    base[72:90] = bytearray([0, 0, 0, edid.DESCRIPTOR_NAME, 0]) + (name + b"\n").ljust(13, b" ")
+    base[126] = extensions
+    data = checksum(base)
+    for n in range(extensions):
+        ext = bytearray(edid.BLOCK_SIZE)
+        ext[0:4] = bytearray([edid.CEA_EXTENSION_TAG, 3, 4, 0])
+        ext[4:22] = TIMING_720P60
+        data += checksum(ext)
+    return bytes(data)
+
+class EDIDTest(unittest.TestCase):
+    def test_parse(self):
+        e = edid.EDID(make_edid(1))
+        self.assertEqual((e.manufacturer, e.product, e.version, e.name), ("DEL", 0x1234, "1.3", "TEST"))
+        self.assertEqual(e.timings, [edid.Timing(1920, 1080, 60.0, False), edid.Timing(1280, 720, 60.0, False)])
+        self.assertEqual(str(e.preferred), "1080p60")
+        self.assertEqual(e.extensions, [edid.CEA_EXTENSION_TAG])
+
+    def test_padded(self):
+        # a 128-byte EDID, padded to the 256 bytes that devices expect
+        for padding in (b"\x00", b"\xff"):
+            data = make_edid() + padding * edid.BLOCK_SIZE
+            e = edid.EDID(data)
+            self.assertEqual(e.extensions, [])
+            self.assertEqual(e.data, data)
+            self.assertEqual(str(e.preferred), "1080p60")
+
+    def test_invalid(self):
+        data = make_edid(1)
+        for invalid in (
+            data[:edid.BLOCK_SIZE],                            # truncated extension block
+            data[:200],                                        # not a multiple of the block size
+            make_edid() + b"\x00" * 127 + b"\x01",             # not padding
+            data[:edid.BLOCK_SIZE] + b"\xff" * edid.BLOCK_SIZE, # padding instead of the announced block
+            data[:20] + b"\x02" + data[21:],                   # checksum error in the base block
+            data[:-1] + b"\x00",                               # checksum error in the extension block
+            b"\x01" + data[1:],                                # header
+        ):
+            self.assertRaises(edid.EDIDError, edid.EDID, invalid)
+
+    def test_modes(self):
+        self.assertEqual(edid.parse_mode("1080i30"), {"width": 1920, "height": 1080, "interlaced": True, "refresh": 60.0})
+        self.assertEqual(edid.parse_mode("1280x1024@75"), {"width": 1280, "height": 1024, "interlaced": False, "refresh": 75.0})
+        self.assertEqual(edid.parse_mode("full hd"), None)
+        timings = {1: edid.Timing(1920, 1080, 50, False), 2: edid.Timing(1920, 1080, 59.94, False)}
+        self.assertEqual(edid.find_mode("1080p", timings), 2)
+        self.assertEqual(edid.find_mode("1080p50", timings), 1)
+        self.assertEqual(edid.find_mode("720p", timings), None)
+
+class SlotCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "cache.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_save_and_load(self):
+        e = edid.EDID(make_edid())
+        cache = edid.SlotCache(self.filename)
+        cache.set("10.0.0.1:23", 37, e)
+        cache.save()
+        cache.set("10.0.0.1:23", 38, e)
+        cache.save()  # replaces the existing file
+        cache = edid.SlotCache(self.filename)
+        self.assertEqual(cache.get("10.0.0.1:23", 37), {"sha1": e.digest, "mode": "1080p60"})
+        self.assertEqual(cache.timings("10.0.0.1:23"), {37: edid.Timing(1920, 1080, 60, False), 38: edid.Timing(1920, 1080, 60, False)})
+        cache.set("10.0.0.1:23", 37, None)
+        self.assertEqual(cache.get("10.0.0.1:23", 37), None)
+        self.assertEqual(os.listdir(self.tmpdir), ["cache.json"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+Tests for extron_set_edid.py; run with: python -m unittest
+"""
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+import extron_set_edid as ese
+
+class DetectAddressTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def detect(self, *lines):
+        filename = os.path.join(self.tmpdir, "dvi_matrix_control.conf")
+        with open(filename, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return ese.detect_address(filename)
+
+    def test_plain_connection(self):
+        self.assertEqual(self.detect("//2.192.168.1.2.23", "*7*12,34"), ("192.168.1.2", 23))
+        self.assertEqual(self.detect("//2,10,0,0,5"), ("10.0.0.5", None))
+
+    def test_standby_connection(self):
+        self.assertEqual(self.detect("//2.192.168.1.2.10001/2.192.168.1.3.23"), ("192.168.1.2", 10001))
+        self.assertEqual(self.detect("//2.192.168.1.2/0.9600"), ("192.168.1.2", None))
+
+    def test_other_connections_are_ignored(self):
+        self.assertEqual(self.detect("//0.9600.801", "/b/2.192.168.1.3.23", "//71.192.168.1.4"), (None, None))
+        self.assertEqual(self.detect("//2.10.0.0.1.23", "/b/2.10.0.0.2.23"), ("10.0.0.1", 23))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,10 +6,17 @@ for C3VOC streaming.
 Assumes that the event will take place in this computer's time zone.
 """
 import argparse
+import concurrent.futures
+import functools
+import html as mod_html
+import json
 import time
 import uuid
 import sys
+import os
 import re
+from xml.sax.saxutils import escape, quoteattr
+import xml.etree.ElementTree as ET
 
 RootNamespaceUUID = uuid.UUID("22d1e322-e72b-4f28-80d1-9c1b7e2aebb1")
 
@@ -35,54 +42,444 @@ DefaultMap = [
     "Seminar=talk",
 ]
 
+# the same few hundred timestamps are formatted over and over again
+# (event start, day start/end, verbose dumps), so cache the conversions
+localtime = functools.lru_cache(maxsize=None)(time.localtime)
+
+@functools.lru_cache(maxsize=None)
 def xmltimestamp(t):
-    t = time.localtime(t)
+    t = localtime(t)
     tz = time.strftime("%z", t)
     return time.strftime("%Y-%m-%dT%H:%M:%S", t) + tz[:-2] + ":" + tz[-2:]
 
+@functools.lru_cache(maxsize=None)
+def shorttimestamp(t):
+    return time.strftime("%Y-%m-%d %H:%M", localtime(t))
+
 
 class Event:
     day_split_hour = 6
 
-    def __init__(self, title, start, pm_type, xml_type, room, eid=None):
+    def __init__(self, title, start, pm_type, xml_type, room, eid=None, source=0):
         self.title = title
         self.start = start
         self.end = None
         self.type = xml_type
         self.room = room
-        t = time.localtime(start)
+        t = localtime(start)
         if t.tm_hour < self.day_split_hour:
             # if the event is before the "day split" point, count it to the previous day
-            t = time.localtime(start - 86400)
+            t = localtime(start - 86400)
         self.day = tuple(t[:3])
         self.eid = eid
+        self.source = source
         if room == pm_type:
             self.slug = room + "-"
         else:
             self.slug = f"{room}-{pm_type}-"
         # note: slug is incomplete at this point; a unique ID is added later
         self.uuid = None
+        self.guid_name = canonicalize(title)  # the GUID is derived from this
 
     def __str__(self):
         return str(self.eid).rjust(4) + ": <{:04d}-{:02d}-{:02d}> ".format(*self.day) \
-            + time.strftime("%Y-%m-%d %H:%M", time.localtime(self.start)) + " - " \
-            + (time.strftime("%Y-%m-%d %H:%M", time.localtime(self.end)) if self.end else "????-??-?? ??:??") \
+            + shorttimestamp(self.start) + " - " \
+            + (shorttimestamp(self.end) if self.end else "????-??-?? ??:??") \
             + f" [{self.slug}] {self.title} {{{self.uuid}}}"
 
 
+def index_events(events):
+    """
+    Group a list of events (sorted by start time) into a
+    day -> room -> [events] index; the per-room lists stay sorted.
+    """
+    index = {}
+    for e in events:
+        index.setdefault(e.day, {}).setdefault(e.room, []).append(e)
+    return index
+
+def assign_end_times(events, end_of_party, max_duration):
+    """
+    Fill in the end times of all events (sorted by start time) in a single
+    backwards sweep over all rooms: each event ends when the next event in
+    the same room starts, but lasts max_duration at most. The last event of
+    a room ends at the end of the party, given as a source -> time map.
+    Returns a list of (kind, event, other_event) tuples for events that
+    start at the same time as another one in the same room ("conflict"),
+    or that are cut short by an event from another source ("overlap").
+    """
+    next_event = {}         # room -> next event in that room
+    next_own_start = {}     # (room, source) -> start of next event from the same source
+    issues = []
+    for e in reversed(events):
+        nxt = next_event.get(e.room)
+        e.end = min(nxt.start if nxt else end_of_party[e.source], e.start + max_duration)
+        if nxt and (nxt.start == e.start):
+            issues.append(("conflict", e, nxt))
+        elif nxt and (nxt.source != e.source) \
+        and (nxt.start < min(next_own_start.get((e.room, e.source), end_of_party[e.source]), e.start + max_duration)):
+            issues.append(("overlap", e, nxt))
+        next_event[e.room] = e
+        next_own_start[e.room, e.source] = e.start
+    issues.reverse()
+    return issues
+
+def day_bounds(day_rooms):
+    "determine (start, end) time of a day from its room -> events map"
+    return (min(room_events[0].start for room_events in day_rooms.values()),
+            max(e.end for room_events in day_rooms.values() for e in room_events))
+
+def event_record(e):
+    "the per-event data fields, in Fahrplan order, shared by all writers"
+    start = localtime(e.start)
+    minutes = int((e.end - e.start) / 60 + 0.5)
+    return {
+        "date":     xmltimestamp(e.start),
+        "start":    f"{start.tm_hour:02d}:{start.tm_min:02d}",
+        "duration": f"{minutes//60}:{minutes%60:02d}",
+        "room":     e.room,
+        "slug":     e.slug,
+        "title":    e.title,
+        "type":     e.type,
+        "language": "en",
+    }
+
+EmptyEventFields = ["subtitle", "track", "abstract", "description", "logo", "links", "attachments"]
+
+
+class XMLWriter:
+    "minimal incremental XML emitter with escaping and indentation"
+
+    def __init__(self, f, indent="  "):
+        self.f = f
+        self.indent = indent
+        self.stack = []
+        self.f.write("<?xml version='1.0' encoding='utf-8' ?>\n")
+
+    def _line(self, s):
+        self.f.write(self.indent * len(self.stack) + s + "\n")
+
+    @staticmethod
+    def _tag(tag, attrs):
+        return tag + "".join(f" {k}={quoteattr(str(v))}" for k, v in attrs.items())
+
+    def start(self, tag, **attrs):
+        self._line(f"<{self._tag(tag, attrs)}>")
+        self.stack.append(tag)
+
+    def end(self):
+        tag = self.stack.pop()
+        self._line(f"</{tag}>")
+
+    def element(self, tag, text=None, **attrs):
+        if text is None:
+            self._line(f"<{self._tag(tag, attrs)} />")
+        else:
+            self._line(f"<{self._tag(tag, attrs)}>{escape(str(text))}</{tag}>")
+
+
+class ScheduleWriterBase:
+    "interface for the output formats driven by write_schedule()"
+    def begin(self, conf): pass
+    def begin_day(self, nday, day, dstart, dend): pass
+    def begin_room(self, room): pass
+    def event(self, e, record): pass
+    def end_room(self): pass
+    def end_day(self): pass
+    def end(self): pass
+
+class XMLScheduleWriter(ScheduleWriterBase):
+    "Fahrplan XML"
+    def __init__(self, f):
+        self.xml = XMLWriter(f)
+
+    def begin(self, conf):
+        self.xml.start("schedule")
+        self.xml.element("generator", name="pm_events_to_ccc_xml")
+        self.xml.element("version", conf["version"])
+        self.xml.start("conference")
+        for key in ConferenceFields:
+            self.xml.element(key, conf[key])
+        self.xml.end()
+
+    def begin_day(self, nday, day, dstart, dend):
+        self.xml.start("day", index=nday, date=day, start=xmltimestamp(dstart), end=xmltimestamp(dend))
+
+    def begin_room(self, room):
+        self.xml.start("room", name=room)
+
+    def event(self, e, record):
+        self.xml.start("event", id=e.eid, guid=e.uuid)
+        for key, value in record.items():
+            self.xml.element(key, value)
+        for key in EmptyEventFields:
+            self.xml.element(key)
+        self.xml.end()
+
+    def end_room(self): self.xml.end()
+    def end_day(self):  self.xml.end()
+    def end(self):      self.xml.end()
+
+class JSONScheduleWriter(ScheduleWriterBase):
+    "C3VOC schedule JSON"
+    def __init__(self, f):
+        self.f = f
+
+    def begin(self, conf):
+        self.rooms = []
+        self.days = []
+        self.doc = {
+            "$schema": "https://c3voc.de/schedule/schema.json",
+            "generator": {"name": "pm_events_to_ccc_xml"},
+            "schedule": {
+                "version": conf["version"],
+                "conference": {
+                    "acronym":           conf["acronym"],
+                    "title":             conf["title"],
+                    "start":             conf["start"],
+                    "end":               conf["end"],
+                    "daysCount":         conf["days"],
+                    "timeslot_duration": conf["timeslot_duration"],
+                    "rooms":             self.rooms,
+                    "days":              self.days,
+                },
+            },
+        }
+
+    def begin_day(self, nday, day, dstart, dend):
+        self.day_rooms = {}
+        self.days.append({"index": nday, "date": day,
+                          "day_start": xmltimestamp(dstart), "day_end": xmltimestamp(dend),
+                          "rooms": self.day_rooms})
+
+    def begin_room(self, room):
+        if not any((r["name"] == room) for r in self.rooms):
+            self.rooms.append({"name": room})
+        self.room_events = self.day_rooms[room] = []
+
+    def event(self, e, record):
+        item = {"id": e.eid, "guid": e.uuid}
+        item.update(record)
+        item.update({key: ([] if key in ("links", "attachments") else "") for key in EmptyEventFields})
+        item["persons"] = []
+        self.room_events.append(item)
+
+    def end(self):
+        json.dump(self.doc, self.f, indent=2)
+        self.f.write("\n")
+
+
+def write_schedule(index, conf, writers):
+    "run all writers in a single pass over the day -> room -> events index"
+    for w in writers:
+        w.begin(conf)
+    for nday, day in enumerate(sorted(index), 1):
+        day_rooms = index[day]
+        dstart, dend = day_bounds(day_rooms)
+        day = '-'.join(f"{x:02d}" for x in day)
+        for w in writers:
+            w.begin_day(nday, day, dstart, dend)
+        for room in sorted(day_rooms):
+            for w in writers:
+                w.begin_room(room)
+            for e in day_rooms[room]:
+                record = event_record(e)
+                for w in writers:
+                    w.event(e, record)
+            for w in writers:
+                w.end_room()
+        for w in writers:
+            w.end_day()
+    for w in writers:
+        w.end()
+
+
+def detect_default_room(html):
+    """
+    auto-detect the default room name: analyze the title tag, split it into
+    words, and remove the words that are always there; if only one word
+    remains, use that (in lowercase) as the default room name
+    """
+    m = re.search(r'<title>(.*?)</title>', html, flags=re.I+re.S)
+    if m:
+        words = set(m.group(1).lower().split()) \
+              - {"partymeister", "backend", "home", "-", "event", "events", "schedule", "timetable"}
+        if len(words) == 1:
+            return words.pop()
+    return None
+
+def parse_events(html, type_map, default_room, exclude=[], source=0):
+    "our super-simplistic, very special-cased parser"
+    events = []
+    html = html.split("<tbody", 1)[-1]
+    for attrs, tr in re.findall(r'<tr([^>]*)>(.*?)</tr>', html, flags=re.I+re.S):
+        raw = [re.sub(r'<[^>]+>', '', td).strip()
+               for attrs, td
+               in re.findall(r'<td([^>]*)>(.*?)</td>', tr, flags=re.I+re.S)]
+        row = [mod_html.unescape(cell) for cell in raw]
+
+        # parse time
+        t = re_time.match(row[2])
+        if not t:
+            print(f"WARNING: invalid event {row[:3]}", file=sys.stderr)
+            continue
+        t = time.mktime((int(t.group('dy')), int(t.group('dm')), int(t.group('dd')),
+                         int(t.group('th')), int(t.group('tm')), 0,
+                         -1, -1, -1))
+
+        # check for exclusion
+        title_l = canonicalize(row[0])
+        if any((excl in title_l) for excl in exclude):
+            continue
+
+        # resolve type
+        pm_type = canonicalize(row[1])
+        xml_type, room = type_map.get(pm_type, (None, None))
+        if not xml_type:
+            continue  # ignored event
+
+        # extract ID (if present)
+        m = re.search(r'data-record-id="(\d+)"', tr)
+        eid = int(m.group(1)) if m else None
+
+        # enter event; its GUID is derived from the title as it appears in
+        # the HTML (with entities), so it matches earlier schedules
+        e = Event(row[0], t, pm_type, xml_type, room or default_room, eid, source)
+        e.guid_name = canonicalize(raw[0])
+        events.append(e)
+    return events
+
+def load_source(source, filename, type_map, default_room=None, exclude=[]):
+    """
+    read and parse a single input file;
+    returns (default room name, list of events)
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        html = f.read()
+    if not default_room:
+        default_room = detect_default_room(html)
+        if not default_room:
+            raise ValueError("no default room name specified and auto-detection failed")
+    return (default_room, parse_events(html, type_map, default_room, exclude, source))
+
+def merge_sources(event_lists):
+    """
+    merge the event lists of multiple sources into a single list sorted
+    by start time; identical events (same room, start time and title)
+    that are listed in more than one source are only kept once
+    returns (events, number of removed duplicates)
+    """
+    events = sorted((e for events in event_lists for e in events), key=lambda e: e.start)
+    seen = set()
+    merged = []
+    for e in events:
+        key = (e.room, e.start, canonicalize(e.title))
+        if not(key in seen):
+            seen.add(key)
+            merged.append(e)
+    return (merged, len(events) - len(merged))
+
+def assign_ids(events):
+    """
+    make sure that every event has a unique ID: record IDs of different
+    sources (i.e. PartyMeister instances) may collide, so the first source
+    keeps its IDs, and colliding or missing IDs are replaced by new ones
+    above all existing IDs; returns the number of replaced IDs
+    """
+    next_id = max((e.eid or 0) for e in events) + 100
+    used = set()
+    replaced = 0
+    for e in sorted(events, key=lambda e: e.source):  # stable sort: per source, by start time
+        if not(e.eid) or (e.eid in used):
+            replaced += 1 if e.eid else 0
+            e.eid = next_id
+            next_id += 1
+        used.add(e.eid)
+    return replaced
+
+
+ConferenceFields = ["title", "acronym", "days", "start", "end", "timeslot_duration"]
+
+def schedule_snapshot(index):
+    """
+    Build a comparable {key: {field: text}} map of all events in an index.
+    The key is the (deterministic) GUID; repeated GUIDs (i.e. events with
+    identical titles) are disambiguated by their order of appearance.
+    """
+    snapshot = {}
+    for day in sorted(index):
+        for room in sorted(index[day]):
+            for e in index[day][room]:
+                record = {"id": str(e.eid)}
+                record.update((k, str(v)) for k, v in event_record(e).items())
+                add_snapshot_item(snapshot, e.uuid, record)
+    return snapshot
+
+def add_snapshot_item(snapshot, guid, record):
+    key, n = guid, 1
+    while key in snapshot:
+        n += 1
+        key = f"{guid}#{n}"
+    snapshot[key] = record
+
+def read_schedule_xml(filename):
+    """
+    Read back a previously written schedule XML file.
+    Returns (version, {conference field: text}, snapshot), or None if the
+    file doesn't exist or can't be parsed.
+    """
+    try:
+        root = ET.parse(filename).getroot()
+    except FileNotFoundError:
+        return None
+    except (IOError, ET.ParseError) as e:
+        print(f"WARNING: can not read previous schedule '{filename}':", e, file=sys.stderr)
+        return None
+    conf = {child.tag: (child.text or "") for child in root.iterfind("conference/*")}
+    snapshot = {}
+    for ev in root.iterfind("day/room/event"):
+        record = {"id": ev.get("id", "")}
+        record.update((child.tag, child.text or "") for child in ev if child.tag not in EmptyEventFields)
+        add_snapshot_item(snapshot, ev.get("guid", ""), record)
+    return (root.findtext("version", ""), conf, snapshot)
+
+def diff_schedules(old, new):
+    "compare two snapshots; returns (added keys, removed keys, {changed key: [fields]})"
+    added = [k for k in new if not(k in old)]
+    removed = [k for k in old if not(k in new)]
+    changed = {}
+    for k in new:
+        if k in old:
+            fields = [f for f in new[k] if new[k][f] != old[k].get(f)]
+            if fields:
+                changed[k] = fields
+    return (added, removed, changed)
+
+def bump_version(version):
+    "increment the last number in a version string, e.g. 1.9 -> 1.10"
+    m = re.match(r'(.*?)(\d+)(\D*)$', version)
+    if not m:
+        return version + ".1"
+    return m.group(1) + str(int(m.group(2)) + 1) + m.group(3)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("-i", "--infile", metavar="HTML", default="events.html",
+    parser.add_argument("-i", "--infile", metavar="HTML", action='append',
                         help="""
                             input HTML file, saved as a single HTML file
                             (no MTHML!) from the event list in PartyMeister's
                             backend with pagination disabled (i.e. "events per
-                            page" set to maximum)
-                        [default: %(default)s]""")
+                            page" set to maximum);
+                            can be used multiple times to merge the schedules
+                            of several PartyMeister instances into one
+                        [default: events.html]""")
     parser.add_argument("-o", "--outfile", metavar="XML", default="schedule.xml",
                         help="output XML file [default: %(default)s]")
+    parser.add_argument("-j", "--jsonfile", metavar="JSON",
+                        help="additionally write the schedule in C3VOC JSON format into this file")
     parser.add_argument("-r", "--room", metavar="NAME",
-                        help="default room name [default: infer from page title]")
+                        help="default room name [default: infer from page title, separately for each input file]")
     parser.add_argument("-t", "--title", metavar="NAME",
                         help="party title [default: infer from room name and year]")
     parser.add_argument("-a", "--acronym", metavar="NAME",
@@ -115,10 +512,17 @@ if __name__ == "__main__":
                             can be used multiple times
                             [default: no exclusions]
                         """)
-    parser.add_argument("-n", "--version", metavar="STR", default="1.0",
+    parser.add_argument("-n", "--version", metavar="STR",
                         help="""
                             value of the <version> tag
-                        [default: %(default)s]""")
+                        [default: 1.0 for a new output file; otherwise, the
+                        previous version with the last number incremented,
+                        if anything changed]""")
+    parser.add_argument("-f", "--force", action='store_true',
+                        help="""
+                            rewrite the output file(s) even if the schedule
+                            didn't change since the last run
+                        """)
     parser.add_argument("--include-last", action='store_true',
                         help="""
                             include the very last event in the schedule
@@ -136,89 +540,59 @@ if __name__ == "__main__":
     max_duration = (60 * h + m) * 60
     Event.day_split_hour = args.day_split
 
-    # open input file
-    print("reading input from", args.infile)
-    try:
-        with open(args.infile, 'r', encoding='utf-8') as f:
-            html = f.read()
-    except (IOError, UnicodeError) as e:
-        print("FATAL: can not read input file:", e, file=sys.stderr)
-        sys.exit(1)
-
-    # auto-detect default room name, title and acronym
-    default_room = args.room
-    title = args.title
-    acronym = args.acronym
-    if not default_room:
-        # auto-detect strategy: analyze the title tag, split it into words,
-        # and remove the words that are always there; if only one word remains,
-        # use that (in lowercase) as the default room name
-        m = re.search(r'<title>(.*?)</title>', html, flags=re.I+re.S)
-        if m:
-            words = set(m.group(1).lower().split()) \
-                  - {"partymeister", "backend", "home", "-", "event", "events", "schedule", "timetable"}
-            if len(words) == 1:
-                default_room = words.pop()
-        if not default_room:
-            print("FATAL: no default room name specified and auto-detection failed", file=sys.stderr)
-            sys.exit(1)
-        print(f"default room name auto-detected as '{default_room}'")
+    infiles = args.infile or ["events.html"]
 
     # resolve type map
     type_map = {}
     for pm_type, xml_type, room in list(map(map_item, DefaultMap)) + args.map:
         type_map[pm_type] = (xml_type, room)
 
-    # prepare data structures
-    used_pm_types = set()
-    events = []
-
-    # our super-simplistic, very special-cased parser
-    html = html.split("<tbody", 1)[-1]
-    for attrs, tr in re.findall(r'<tr([^>]*)>(.*?)</tr>', html, flags=re.I+re.S):
-        row = [re.sub(r'<[^>]+>', '', td).strip()
-               for attrs, td
-               in re.findall(r'<td([^>]*)>(.*?)</td>', tr, flags=re.I+re.S)]
-
-        # parse time
-        t = re_time.match(row[2])
-        if not t:
-            print(f"WARNING: invalid event {row[:3]}", file=sys.stderr)
-            continue
-        t = time.mktime((int(t.group('dy')), int(t.group('dm')), int(t.group('dd')),
-                         int(t.group('th')), int(t.group('tm')), 0,
-                         -1, -1, -1))
-
-        # check for exclusion
-        title_l = canonicalize(row[0])
-        if any((excl in title_l) for excl in args.exclude):
-            continue
-
-        # resolve type
-        pm_type = canonicalize(row[1])
-        used_pm_types.add(pm_type)
-        xml_type, room = type_map.get(pm_type, (None, None))
-        if not xml_type:
-            continue  # ignored event
+    # read and parse all input files concurrently
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        futures = [pool.submit(load_source, source, filename, type_map, args.room, args.exclude)
+                   for source, filename in enumerate(infiles)]
+    sources = []
+    for filename, future in zip(infiles, futures):
+        print("reading input from", filename)
+        try:
+            default_room, source_events = future.result()
+        except (IOError, UnicodeError) as e:
+            print("FATAL: can not read input file:", e, file=sys.stderr)
+            sys.exit(1)
+        except ValueError as e:
+            print(f"FATAL: {filename}:", e, file=sys.stderr)
+            sys.exit(1)
+        if not args.room:
+            print(f"default room name auto-detected as '{default_room}'")
+        if not source_events:
+            print(f"FATAL: no valid events found in input file '{filename}'", file=sys.stderr)
+            sys.exit(1)
+        source_events.sort(key=lambda e: e.start)
+        sources.append((default_room, source_events))
+    default_room = sources[0][0]
+    title = args.title
+    acronym = args.acronym
 
-        # extract ID (if present)
-        m = re.search(r'data-record-id="(\d+)"', tr)
-        eid = int(m.group(1)) if m else None
+    # determine the end of the party (separately for each source)
+    end_of_party = {}
+    for source, (room, source_events) in enumerate(sources):
+        if args.include_last:
+            end_of_party[source] = source_events[-1].start + max_duration
+        else:
+            end_of_party[source] = source_events.pop().start
 
-        # enter event
-        events.append(Event(row[0], t, pm_type, xml_type, room or default_room, eid))
+    # merge the sources
+    events, duplicates = merge_sources(e for room, e in sources)
+    if duplicates:
+        print(f"merged {duplicates} event(s) that are listed in more than one input file")
 
     # summarize data
     if not events:
-        print("FATAL: no valid events found in input file", file=sys.stderr)
+        print("FATAL: no valid events found in input file(s)", file=sys.stderr)
         sys.exit(1)
-    events.sort(key=lambda e: e.start)
-    if args.include_last:
-        end_of_party = events[-1].start + max_duration
-    else:
-        end_of_party = events.pop().start
-    rooms = set(e.room for e in events)
-    days = set(e.day for e in events)
+    index = index_events(events)
+    rooms = set(room for day_rooms in index.values() for room in day_rooms)
+    days = set(index)
     print(f"found {len(events)} event(s) across {len(days)} day(s) and {len(rooms)} room(s)")
 
     # now that we have events, auto-detect the title and acronym
@@ -231,76 +605,89 @@ if __name__ == "__main__":
     party_uuid = uuid.uuid5(RootNamespaceUUID, acronym)
 
     # fill in end times for all events
-    for room in rooms:
-        t = end_of_party
-        for e in reversed(events):
-            if e.room != room: continue
-            e.end = min(t, e.start + max_duration)
-            t = e.start
+    for kind, e, other in assign_end_times(events, end_of_party, max_duration):
+        print(f"WARNING: room {kind} in '{e.room}' at {shorttimestamp(e.start)}:",
+              f"'{e.title}' ({infiles[e.source]}) and",
+              f"'{other.title}' ({infiles[other.source]}) at {shorttimestamp(other.start)}",
+              file=sys.stderr)
 
     # assign IDs, slugs and UUIDs
-    next_id = max((e.eid or 0) for e in events) + 100
+    renumbered = assign_ids(events)
+    if renumbered:
+        print(f"renumbered {renumbered} event(s) whose ID is already used by another input file")
     slugs = {}
     for e in events:
-        if not e.eid:
-            e.eid = next_id
-            next_id += 1
         slug_base = e.slug
         slug_id = slugs.get(slug_base, 0) + 1
         e.slug += str(slug_id)
         slugs[slug_base] = slug_id
-        e.uuid = str(uuid.uuid5(party_uuid, canonicalize(e.title)))
+        e.uuid = str(uuid.uuid5(party_uuid, e.guid_name))
 
     # dump (in verbose mode)
     if args.verbose:
         print("event list:")
         for e in events:
             print("  -", e)
+        for nday, day in enumerate(sorted(index), 1):
+            dstart, dend = day_bounds(index[day])
+            print(f"day {nday}:", shorttimestamp(dstart), "-", shorttimestamp(dend))
+
+    # compare against the previously written schedule
+    conf = {
+        "title": title,
+        "acronym": acronym,
+        "days": len(days),
+        "start": '-'.join(f"{x:02d}" for x in min(days)),
+        "end": '-'.join(f"{x:02d}" for x in max(days)),
+        "timeslot_duration": "00:10",
+    }
+    snapshot = schedule_snapshot(index)
+    prev = read_schedule_xml(args.outfile)
+    if prev:
+        prev_version, prev_conf, prev_snapshot = prev
+        added, removed, changed = diff_schedules(prev_snapshot, snapshot)
+        conf_changed = [k for k in ConferenceFields if str(conf[k]) != prev_conf.get(k)]
+        for k in added:
+            print("  + added:  ", snapshot[k]["slug"], snapshot[k]["title"])
+        for k in removed:
+            print("  - removed:", prev_snapshot[k]["slug"], prev_snapshot[k]["title"])
+        for k, fields in changed.items():
+            print("  * changed:", snapshot[k]["slug"], snapshot[k]["title"], "(" + ", ".join(fields) + ")")
+        if conf_changed:
+            print("  * changed: conference", "(" + ", ".join(conf_changed) + ")")
+        modified = bool(added or removed or changed or conf_changed)
+        print(f"compared to version {prev_version}: {len(added)} added, {len(removed)} removed, {len(changed)} changed event(s)")
+        if args.version:
+            conf["version"] = args.version
+        elif modified:
+            conf["version"] = bump_version(prev_version or "1.0")
+        else:
+            conf["version"] = prev_version
+    else:
+        modified = True
+        conf["version"] = args.version or "1.0"
+    outfiles = [(args.outfile, XMLScheduleWriter)]
+    if args.jsonfile:
+        outfiles.append((args.jsonfile, JSONScheduleWriter))
+    if prev and not(modified) and not(args.force) \
+    and (conf["version"] == prev_version) \
+    and all(os.path.exists(filename) for filename, writer_class in outfiles):
+        print(f"schedule unchanged, keeping version {prev_version}")
+        sys.exit(0)
+    print("schedule version:", conf["version"])
 
     # produce output
-    print("writing output to", args.outfile)
+    files = []
     try:
-        with open(args.outfile, 'w', encoding='utf-8') as f:
-            f.write( "<?xml version='1.0' encoding='utf-8' ?>\n")
-            f.write( '<schedule>\n')
-            f.write( '  <generator name="pm_events_to_ccc_xml" />\n')
-            f.write(f'  <version>{args.version}</version>\n')
-            f.write( '  <conference>\n')
-            f.write(f'    <title>{title}</title>\n')
-            f.write(f'    <acronym>{acronym}</acronym>\n')
-            f.write(f'    <days>{len(days)}</days>\n')
-            f.write( '    <start>{}</start>\n'.format('-'.join(f"{x:02d}" for x in min(days))))
-            f.write( '    <end>{}</end>\n'.format('-'.join(f"{x:02d}" for x in max(days))))
-            f.write( '    <timeslot_duration>00:10</timeslot_duration>\n')
-            f.write( '  </conference>\n')
-            for nday, day in enumerate(sorted(days)):
-                dstart = min(e.start for e in events if e.day == day)
-                dend = max(e.end for e in events if e.day == day)
-                if args.verbose:
-                    print(f"day {nday+1}:",
-                          time.strftime("%Y-%m-%d %H:%M", time.localtime(dstart)), "-",
-                          time.strftime("%Y-%m-%d %H:%M", time.localtime(dend)))
-                f.write(f'  <day index="{nday+1}" date="{day[0]:04d}-{day[1]:02d}-{day[2]:02d}" start="{xmltimestamp(dstart)}" end="{xmltimestamp(dend)}">\n')
-                for room in sorted({e.room for e in events if e.day == day}):
-                    f.write(f'    <room name="{room}">\n')
-                    for e in events:
-                        if (e.day != day) or (e.room != room): continue
-                        start = time.localtime(e.start)
-                        minutes = int((e.end - e.start) / 60 + 0.5)
-                        f.write(f'      <event id="{e.eid}" guid="{e.uuid}">\n')
-                        f.write(f'        <date>{xmltimestamp(e.start)}</date>\n')
-                        f.write(f'        <start>{start.tm_hour:02d}:{start.tm_min:02d}</start>\n')
-                        f.write(f'        <duration>{minutes//60}:{minutes%60:02d}</duration>\n')
-                        f.write(f'        <room>{e.room}</room>\n')
-                        f.write(f'        <slug>{e.slug}</slug>\n')
-                        f.write(f'        <title>{e.title}</title>\n')
-                        f.write(f'        <type>{e.type}</type>\n')
-                        f.write( '        <language>en</language>\n')
-                        f.write( '        <subtitle/><track/><abstract/><description/><logo/><links/><attachments/>\n')
-                        f.write( '      </event>\n')
-                    f.write( '    </room>\n')
-                f.write( '  </day>\n')
-            f.write( '</schedule>\n')
+        writers = []
+        for filename, writer_class in outfiles:
+            print("writing output to", filename)
+            files.append(open(filename, 'w', encoding='utf-8'))
+            writers.append(writer_class(files[-1]))
+        write_schedule(index, conf, writers)
     except IOError as e:
         print("FATAL: can not write output file:", e, file=sys.stderr)
         sys.exit(1)
+    finally:
+        for f in files:
+            f.close()
@@ -4,6 +4,7 @@ Generate a template for a results.txt file, a Demozoo-compliant .tsv file, or an
 HTML document based on a PartyMeister 3 vote list or Wuhu JSON results export.
 """
 import argparse
+import array
 import textwrap
 import html as mod_html
 import json
@@ -24,20 +25,81 @@ def H(x):
 ###############################################################################
 
 class CompoEntry:
-    def __init__(self, title: str, author: str, score=0, rank=0, flags=[]):
-        self.title  = title
-        self.author = author
-        self.score  = score
-        self.rank   = rank
-        self.flags  = set(flags or [])
+    "lightweight view of a single row of a Compo's result columns"
+    __slots__ = ('compo', 'index')
+
+    def __init__(self, compo, index: int):
+        self.compo = compo
+        self.index = index
+
+    @property
+    def title(self):  return self.compo.titles[self.index]
+    @property
+    def author(self): return self.compo.authors[self.index]
+    @property
+    def score(self):  return self.compo.scores[self.index]
+    @property
+    def rank(self):   return self.compo.ranks[self.index]
+    @property
+    def flags(self):  return self.compo.flags[self.index]
 
 class Compo:
+    """
+    Column-oriented storage of a compo's results: one list or array per
+    attribute instead of one object per entry, so that large (e.g. per-voter)
+    data sets stay compact and ranking is a single pass over the columns.
+    """
+    __slots__ = ('name', 'titles', 'authors', 'scores', 'ranks', 'flags')
+
     def __init__(self, name: str):
-        self.name = name
-        self.entries = []
+        self.name    = name
+        self.titles  = []
+        self.authors = []
+        self.scores  = array.array('q')
+        self.ranks   = array.array('l')
+        self.flags   = []
 
     def __len__(self):
-        return len(self.entries)
+        return len(self.titles)
+
+    def __iter__(self):
+        return (CompoEntry(self, i) for i in range(len(self.titles)))
+
+    def add(self, title: str, author: str, score=0, rank=0, flags=()):
+        "append an entry and return its index"
+        self.titles.append(title)
+        self.authors.append(author)
+        self.scores.append(int(score))
+        self.ranks.append(int(rank))
+        self.flags.append(tuple(dict.fromkeys(flags or ())))
+        return len(self.titles) - 1
+
+    def add_votes(self, votes):
+        "accumulate an iterable of raw (entry index, points) votes into the scores"
+        scores = self.scores
+        for index, points in votes:
+            scores[index] += points
+
+    def sort_by_score(self):
+        "reorder all columns by descending score (stable)"
+        order = sorted(range(len(self.scores)), key=self.scores.__getitem__, reverse=True)
+        self.titles  = [self.titles[i]  for i in order]
+        self.authors = [self.authors[i] for i in order]
+        self.flags   = [self.flags[i]   for i in order]
+        self.scores  = array.array('q', (self.scores[i] for i in order))
+        self.ranks   = array.array('l', (self.ranks[i]  for i in order))
+
+    def assign_ranks(self):
+        "auto-generate ranks for all entries without an explicit rank, based on score"
+        ranks, scores = self.ranks, self.scores
+        prev_rank = 0
+        prev_score = 0
+        for i in range(len(ranks)):
+            if not ranks[i]:
+                if scores[i] != prev_score:
+                    prev_rank = i + 1
+                    prev_score = scores[i]
+                ranks[i] = prev_rank
 
 ###############################################################################
 
@@ -72,7 +134,7 @@ def ParsePartymeisterHTML(doc: str):
                 print(f"WARNING: unrecognized entry format {row}", file=sys.stderr)
                 continue
 
-            compo.entries.append(CompoEntry(title, author, score, rank, flags))
+            compo.add(title, author, score, rank, flags)
         yield compo
 
 def ParseWuhuJSON(doc: str):
@@ -80,11 +142,42 @@ def ParseWuhuJSON(doc: str):
     for compo_struct in json.loads(doc)['compos']:
         compo = Compo(compo_struct['name'])
         for entry in compo_struct['results']:
-            compo.entries.append(CompoEntry(
-                title  = entry['title'],
-                author = entry['author'],
-                score  = entry['points'],
-                rank   = entry['ranking']))
+            compo.add(title  = entry['title'],
+                      author = entry['author'],
+                      score  = entry['points'],
+                      rank   = entry['ranking'])
+        yield compo
+
+def ParseRawVotesTSV(doc: str):
+    "raw per-vote TSV"
+    # one vote per line: compo <TAB> title <TAB> author <TAB> points
+    compos = {}
+    votes = {}
+    for lineno, line in enumerate(doc.splitlines(), 1):
+        if not line.strip():
+            continue
+        row = line.split('\t')
+        if len(row) != 4:
+            raise ValueError(f"line {lineno}: expected 4 tab-separated columns, got {len(row)}")
+        compo_name, title, author, points = (col.strip() for col in row)
+        try:
+            points = int(points)
+        except ValueError:
+            raise ValueError(f"line {lineno}: invalid number of points {points!r}")
+        compo = compos.get(compo_name)
+        if not compo:
+            compo = compos[compo_name] = Compo(compo_name)
+            votes[compo_name] = ({}, [])
+        index_map, compo_votes = votes[compo_name]
+        index = index_map.get((title, author))
+        if index is None:
+            index = index_map[title, author] = compo.add(title, author)
+        compo_votes.append((index, points))
+    if not compos:
+        raise ValueError("no votes found")
+    for compo in compos.values():
+        compo.add_votes(votes[compo.name][1])
+        compo.sort_by_score()
         yield compo
 
 ###############################################################################
@@ -95,7 +188,9 @@ if __name__ == "__main__":
                         help="""
                             input HTML file, saved as a single HTML file
                             (no MTHML!) from the vote list in PartyMeister's
-                            backend, or from Wuhu's results -> export as JSON option
+                            backend, or from Wuhu's results -> export as JSON option,
+                            or a TSV file with one raw vote per line
+                            (compo, title, author, points)
                         [default: %(default)s]""")
     parser.add_argument("-o", "--outfile", metavar="FILE", default="raw_results.txt",
                         help="""
@@ -141,7 +236,7 @@ if __name__ == "__main__":
     # parse the input file
     errors = []
     compos = None
-    for parser in (ParsePartymeisterHTML, ParseWuhuJSON):
+    for parser in (ParsePartymeisterHTML, ParseWuhuJSON, ParseRawVotesTSV):
         try:
             compos = list(parser(doc))
             print("input format:", parser.__doc__)
@@ -183,16 +278,8 @@ tr, td { break-before: avoid; break-inside: avoid; }
         else:
             print("---", compo.name, file=out)
 
-        count = 0
-        prev_rank = 0
-        prev_score = 0
-        for entry in compo.entries:
-            count += 1
-            if not entry.rank:  # auto-generate rank based on score
-                if entry.score != prev_score:
-                    prev_rank = count
-                    prev_score = entry.score
-                entry.rank = prev_rank
+        compo.assign_ranks()
+        for entry in compo:
             if args.max_rank and (entry.rank > args.max_rank):
                 break
             flags_str = "" if args.no_flags else ", ".join(str(f).upper() for f in entry.flags)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Tests for pm_events_to_ccc_xml.py; run with: python3 -m unittest
+"""
+import time
+import unittest
+
+import pm_events_to_ccc_xml as pm
+
+TYPE_MAP = {"competition": ("generic", None), "seminar": ("talk", None)}
+
+def events_html(*rows):
+    "a minimal PartyMeister events list with (record ID, title, type, start) rows"
+    return "<table><tbody>" + "".join(
+        f'<tr><td>{title}</td><td>{pm_type}</td><td>{start}</td>'
+        f'<td><a href="#" data-record-id="{eid}">Edit</a></td></tr>'
+        for eid, title, pm_type, start in rows) + "</tbody></table>"
+
+class ParseEventsTest(unittest.TestCase):
+    def test_entities_in_titles(self):
+        events = pm.parse_events(events_html(
+            (1, "Rock &amp; Roll &#39;Til Dawn", "Concert", "2024-05-10 22:00"),
+            (2, "Demo Compo", "Competition", "2024-05-10 20:00"),
+        ), {"concert": ("liveset", None), **TYPE_MAP}, "main")
+        self.assertEqual([e.title for e in events], ["Rock & Roll 'Til Dawn", "Demo Compo"])
+        # GUIDs are still derived from the title as written in the HTML
+        self.assertEqual([e.guid_name for e in events], ["rock&amp;roll&#39;tildawn", "democompo"])
+        party = pm.uuid.uuid5(pm.RootNamespaceUUID, "party2024")
+        self.assertEqual(str(pm.uuid.uuid5(party, events[0].guid_name)), "c806f623-6791-55d1-99cd-f0f6b548e99d")
+
+class MergeSourcesTest(unittest.TestCase):
+    def test_overlapping_record_ids_are_made_unique(self):
+        main = pm.parse_events(events_html(
+            (1, "Opening", "Event", "2024-05-10 18:00"),
+            (2, "Demo Compo", "Competition", "2024-05-10 20:00"),
+            (3, "Graphics Compo", "Competition", "2024-05-11 20:00"),
+        ), {"event": ("generic", None), **TYPE_MAP}, "main", source=0)
+        seminar = pm.parse_events(events_html(
+            (1, "Shader Workshop", "Seminar", "2024-05-10 14:00"),
+            (2, "Demo Compo", "Competition", "2024-05-10 20:00"),  # duplicate of the main stage entry
+            (7, "Music Talk", "Seminar", "2024-05-11 15:00"),
+        ), TYPE_MAP, "seminar", source=1)
+        # the duplicate is in another room, so it's kept
+        events, duplicates = pm.merge_sources([main, seminar])
+        self.assertEqual(duplicates, 0)
+        self.assertEqual(pm.assign_ids(events), 2)
+        ids = [e.eid for e in events]
+        self.assertEqual(len(ids), len(set(ids)))
+        # the first source keeps its record IDs
+        self.assertEqual(sorted(e.eid for e in events if e.source == 0), [1, 2, 3])
+        self.assertIn(7, ids)
+
+    def test_missing_ids_are_filled_in(self):
+        events = [pm.Event("A", 1e9, "event", "generic", "main", 5),
+                  pm.Event("B", 1e9 + 60, "event", "generic", "main")]
+        self.assertEqual(pm.assign_ids(events), 0)
+        self.assertEqual([e.eid for e in events], [5, 105])
+
+def nested_loop_end_times(events, end_of_party, max_duration):
+    "the end time assignment before the single sweep: one pass over all events per room"
+    ends = {}
+    for room in set(e.room for e in events):
+        t = end_of_party
+        for e in reversed(events):
+            if e.room != room: continue
+            ends[id(e)] = min(t, e.start + max_duration)
+            t = e.start
+    return ends
+
+class EndTimesTest(unittest.TestCase):
+    def test_sweep_matches_nested_loop(self):
+        def at(day, hour, minute=0):
+            return time.mktime((2024, 5, day, hour, minute, 0, 0, 0, -1))
+        events = [pm.Event(title, at(*start), "event", "generic", room)
+                  for title, room, start in [
+            ("Opening", "main", (10, 18)),
+            ("Workshop", "seminar", (10, 18, 30)),  # runs longer than the next seminar allows
+            ("Demo Compo", "main", (10, 20)),
+            ("Talk", "seminar", (10, 19)),
+            ("Late Talk", "seminar", (10, 23, 30)),  # spans midnight
+            ("Concert", "main", (10, 23)),
+            ("Night Talk", "seminar", (11, 0, 15)),
+            ("DJ Set", "main", (11, 1)),
+            ("Graphics Compo", "main", (11, 20)),
+            ("Closing", "main", (11, 22, 45)),
+        ]]
+        events.sort(key=lambda e: e.start)
+        end_of_party, max_duration = at(12, 2), 2 * 3600
+        expected = nested_loop_end_times(events, end_of_party, max_duration)
+        self.assertEqual(pm.assign_end_times(events, {0: end_of_party}, max_duration), [])
+        self.assertEqual([e.end for e in events], [expected[id(e)] for e in events])
+        # events after midnight belong to the day before, and stay sorted per room
+        index = pm.index_events(events)
+        self.assertEqual(sorted(index), [(2024, 5, 10), (2024, 5, 11)])
+        self.assertEqual([e.title for e in index[2024, 5, 10]["main"]], ["Opening", "Demo Compo", "Concert", "DJ Set"])
+        self.assertEqual([e.title for e in index[2024, 5, 10]["seminar"]], ["Workshop", "Talk", "Late Talk", "Night Talk"])
+        self.assertEqual(index[2024, 5, 10]["seminar"][2].end, at(11, 0, 15))
+
+if __name__ == "__main__":
+    unittest.main()